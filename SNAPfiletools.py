@@ -1,6 +1,10 @@
 import glob, time, datetime, os, re
 import numpy as np
 from scio import scio
+from concurrent.futures import ThreadPoolExecutor
+from utils import direct_cache
+
+DIRECT_PRODUCTS = ['pol00', 'pol11', 'pol01r', 'pol01i']
 
 #============================================================
 def read_field_many_fast(dirs,tag,dtype='float64',return_missing=False):
@@ -37,32 +41,137 @@ def read_field_many_fast(dirs,tag,dtype='float64',return_missing=False):
 #============================================================
 def read_pol_fast(dirs,tag):
     ndir=len(dirs)
-    fnames=[None]*ndir
-    for i in range(ndir):
-        fnames[i]=dirs[i]+'/'+tag
+    product=tag.replace('.scio.bz2','')
     t0=time.time()
-    all_dat=scio.read_files(fnames)
+    if tag.endswith('.scio.bz2') and product in DIRECT_PRODUCTS:
+        #memory-mapped from the direct data cache, so the only copy in memory is big_dat
+        all_dat=read_direct_parallel(dirs,[product])[product]
+    else:
+        fnames=[None]*ndir
+        for i in range(ndir):
+            fnames[i]=dirs[i]+'/'+tag
+        all_dat=scio.read_files(fnames)
     t1=time.time()
     print('read files in ',t1-t0)
-    ndat=0
-    for dat in all_dat:
-        if not(dat is None):
-            ndat=ndat+dat.shape[0]
-            nchan=dat.shape[1]
+    nrows=[0 if dat is None else dat.shape[0] for dat in all_dat]
+    ndat=sum(nrows)
 
     if ndat>0:
-        big_dat=np.zeros([ndat,nchan])
+        nchan=[dat.shape[1] for dat in all_dat if dat is not None][0]
+        big_dat=np.empty([ndat,nchan])
         ii=0
-        for dat in all_dat:
-            if not(dat is None):
-                nn=dat.shape[0]
-                big_dat[ii:(ii+nn),:]=dat
-                ii=ii+nn
+        for i in range(ndir):
+            if nrows[i]>0:
+                big_dat[ii:(ii+nrows[i]),:]=all_dat[i]
+                ii=ii+nrows[i]
+            all_dat[i]=None #drop each file as soon as it's copied
     else:
         print('no files found in read_pol_fast.')
         big_dat=None
     return big_dat
-    
+
+#============================================================
+def get_gap_layout(tstamps, nrows, row_time):
+    """Place files end to end on one time series, leaving empty rows for gaps.
+
+    A gap is added whenever the next file starts at least row_time after the
+    previous one ended. Gaps shorter than one row can't be seen.
+
+    - tstamps = start ctime of every file
+    - nrows = rows in every file (0 if it has no data)
+    - row_time = time per row in seconds
+
+    Returns the start row of every file (None if it has no rows), the total
+    number of rows, and the start and end time of the series.
+    """
+    starts = []
+    n = 0
+    tstart = None
+    tend = None
+    for t, r in zip(tstamps, nrows):
+        if r == 0:
+            starts.append(None)
+            continue
+        if tstart is None:
+            tstart = t
+        else:
+            diff = int((t-tend)/row_time)
+            if diff > 0:
+                print(f"significant diff b/w files {tstart} and {t} of:", diff, "rows")
+                n += diff
+        starts.append(n)
+        n += r
+        tend = t + r*row_time
+    return starts, n, tstart, tend
+
+def assemble_blocks(blocks, starts, nrows, total, nchan, dtype='float64'):
+    """Allocate one (total, nchan) array and copy every file's block to its
+    start row from get_gap_layout. Rows without data are NaN. Blocks longer
+    than the rows given to that file in the layout are cut.
+
+    nchan is passed in (from the product the layout came from) so a product
+    with no blocks at all still comes back as an all-NaN array.
+    """
+    out = np.full((total, nchan), np.nan, dtype=dtype)
+    for blk, st, r in zip(blocks, starts, nrows):
+        if blk is None or st is None:
+            continue
+        n = min(r, blk.shape[0])
+        out[st:st+n] = blk[:n]
+    return out
+
+#============================================================
+def _read_scio(fname):
+    try:
+        return scio.read(fname)
+    except Exception as error:
+        print("failed to read", fname, error)
+        return None
+
+def read_direct_parallel(dirs, products=DIRECT_PRODUCTS, nthreads=None, suffix='.scio.bz2', cache=True, reduce=None):
+    """Read direct data products of many directories at once.
+
+    All (directory, product) files go into one thread pool with at most nthreads
+    files being decompressed at a time. bz2 decompression releases the GIL so this
+    uses as many cores as there are threads, without pickling arrays between processes.
+    With cache=True directories go through utils.direct_cache, so products that were
+    read before are memory-mapped from the local cache instead of decompressed again,
+    and only the files of the requested products are decompressed.
+
+    - dirs = list of 10-digit direct data directories
+    - products = product names, files are <dir>/<product><suffix>
+    - nthreads = max concurrent reads, default number of cores
+    - reduce = function applied to every array by the thread that read it (e.g. block
+      averaging), so only its output is kept and memory scales with the output
+
+    Returns dict product -> list of arrays, one per directory in order (None if missing).
+    """
+    def _reduce(arr):
+        if reduce is None or arr is None:
+            return arr
+        return reduce(arr)
+
+    if nthreads is None:
+        nthreads = os.cpu_count()
+    t0 = time.time()
+    ndir = len(dirs)
+    if cache and all(p in DIRECT_PRODUCTS for p in products):
+        # one pool walks the directories and a second one does all the decompression, so the files of
+        # one directory are decompressed at the same time and at most nthreads files are in flight
+        with ThreadPoolExecutor(nthreads) as ex, ThreadPoolExecutor(nthreads) as decomp:
+            def _read(d):
+                x = direct_cache.get_direct(d, suffix=suffix, do_evict=False, products=products, pool=decomp)
+                return {p:_reduce(x[p]) for p in products}
+            dat = list(ex.map(_read, dirs))
+        direct_cache.evict(keep=[direct_cache.get_entry_path(d) for d in dirs])
+        print(f'read {ndir} dirs in {time.time()-t0:5.2f}s with {nthreads} threads')
+        return {p:[x[p] for x in dat] for p in products}
+    fnames = [os.path.join(d, p+suffix) for p in products for d in dirs]
+    with ThreadPoolExecutor(nthreads) as ex:
+        dat = list(ex.map(lambda f: _reduce(_read_scio(f)), fnames))
+    print(f'read {len(fnames)} files in {time.time()-t0:5.2f}s with {nthreads} threads')
+    return {p:dat[i*ndir:(i+1)*ndir] for i, p in enumerate(products)}
+
 #============================================================
 def ctime2timestamp(ctimes):
     """Given a (list of) ctime, convert to human friendly format.
@@ -4,41 +4,118 @@ import glob
 import time
 from correlations import baseband_data_classes as bdc
 from correlations import correlations as cr
+from correlations import products
 from utils import baseband_utils as butils
 import argparse
+import multiprocessing as mp
+import os
 
-def get_avg_fast(path, init_t, end_t, acclen, nchunks, chanstart=0, chanend=None):
-    
-    idxstart, fileidx, files = butils.get_init_info(init_t, end_t, path)
-    print("Starting at: ",idxstart, "in filenum: ",fileidx)
-    print(files[fileidx])
+def get_avg_shard(files, fileidx, spec_start, acclen, chunk0, nchunks, chanstart=0, chanend=None, checkpoint=None, ckpt_every=100, writer=None):
+    '''
+    Average nchunks chunks starting at chunk chunk0 of a run whose first spectrum number is spec_start.
+    Each shard opens its own iterator, so shards can run in separate processes.
 
-    ant1 = bdc.BasebandFileIterator(files,fileidx,idxstart,acclen,nchunks=nchunks,chanstart=chanstart,chanend=chanend)
+    checkpoint: path to a .npz. The iterator position is saved there every ckpt_every chunks and at the end, and the
+    chunks finished since the previous checkpoint go to their own file next to it (see butils.save_checkpoint_rows).
+    If it already exists, the run continues from it instead of starting over.
+    writer: optional products.ProductWriter. Rows are appended to it as they are produced instead of being kept in memory,
+    and None is returned in place of the arrays.
+    '''
+    ckpt = None
+    if(checkpoint):
+        ckpt = butils.load_checkpoint(checkpoint, spec_start=spec_start, acclen=acclen, chunk0=chunk0, nchunks=nchunks)
+    if(ckpt is not None):
+        done = int(ckpt['chunksdone'])
+        fileidx = int(ckpt['fileidx'])
+        idxstart = int(ckpt['spec_num_start']) - bdc.get_specnum_bounds(files[fileidx])[0]
+    else:
+        done = 0
+        fileidx, idxstart = bdc.seek_specnum(files, fileidx, spec_start + chunk0*acclen)
+    print("Shard at chunk", chunk0, "starting at: ",idxstart, "in filenum: ",fileidx)
+    ant1 = bdc.BasebandFileIterator(files,fileidx,idxstart,acclen,nchunks=nchunks-done,chanstart=chanstart,chanend=chanend)
     if(ant1.obj.bit_mode!=4):
         raise NotImplementedError(f"BIT MODE {ant1.obj.bit_mode} IS NOT SUPPORTED BY THIS SCRIPT. Do you want to use autocorravg1bit.py?")
+    if(writer is not None):
+        # rows already on disk past the last checkpoint are redone
+        writer.truncate(done)
     ncols=ant1.obj.chanend-ant1.obj.chanstart
-    pol00=np.zeros((nchunks,ncols),dtype='float64',order='c')
-    pol11=np.zeros((nchunks,ncols),dtype='float64',order='c')
-    pol01=np.zeros((nchunks,ncols),dtype='complex64',order='c')
+    nrows = 1 if writer is not None else nchunks
+    pol00=np.zeros((nrows,ncols),dtype='float64',order='c')
+    pol11=np.zeros((nrows,ncols),dtype='float64',order='c')
+    pol01=np.zeros((nrows,ncols),dtype='complex64',order='c')
+    if(ckpt is not None and writer is None):
+        butils.load_checkpoint_rows(checkpoint, done, {'pol00':pol00, 'pol11':pol11, 'pol01':pol01})
+    saved = done
     j=ant1.spec_num_start
-    m=ant1.spec_num_start
+    m=spec_start + chunk0*acclen
     st=time.time()
-    for i, chunk in enumerate(ant1):
+    for i in range(done, nchunks):
         t1=time.time()
-        pol00[i,:] = cr.avg_autocorr_4bit(chunk['pol0'],chunk['specnums'])
-        pol11[i,:] = cr.avg_autocorr_4bit(chunk['pol1'],chunk['specnums'])
-        pol01[i,:] = cr.avg_xcorr_4bit(chunk['pol0'], chunk['pol1'],chunk['specnums'])
+        chunk = next(ant1)
+        k = 0 if writer is not None else i
+        pol00[k,:] = cr.avg_autocorr_4bit(chunk['pol0'],chunk['specnums'])
+        pol11[k,:] = cr.avg_autocorr_4bit(chunk['pol1'],chunk['specnums'])
+        pol01[k,:] = cr.avg_xcorr_4bit(chunk['pol0'], chunk['pol1'],chunk['specnums'])
+        if(writer is not None):
+            writer.append(pol00=pol00, pol11=pol11, pol01=pol01)
         t2=time.time()
         print("time taken for one loop", t2-t1)
         j=ant1.spec_num_start
         print("After a loop spec_num start at:", j, "Expected at", m+(i+1)*acclen)
         print(i+1,"CHUNK READ")
+        if(checkpoint and ((i+1)%ckpt_every==0 or i+1==nchunks)):
+            if(writer is not None):
+                writer.flush()
+            else:
+                butils.save_checkpoint_rows(checkpoint, saved, pol00=pol00[saved:i+1], pol11=pol11[saved:i+1], pol01=pol01[saved:i+1])
+            saved = i+1
+            butils.save_checkpoint(checkpoint, chunksdone=i+1, fileidx=ant1.fileidx, spec_num_start=ant1.spec_num_start,\
+                spec_start=spec_start, acclen=acclen, chunk0=chunk0, nchunks=nchunks)
     print("Time taken final:", time.time()-st)
-    pol00 = np.ma.masked_invalid(pol00)
-    pol11 = np.ma.masked_invalid(pol11)
-    pol01 = np.ma.masked_invalid(pol01)
+    if(writer is not None):
+        return None,None,None,ant1.obj.channels
     return pol00,pol11,pol01,ant1.obj.channels
 
+def _get_avg_shard(args):
+    return get_avg_shard(*args)
+
+def get_avg_fast(path, init_t, end_t, acclen, nchunks, chanstart=0, chanend=None, nproc=1, checkpoint=None, ckpt_every=100, stream=None):
+    '''
+    nproc: number of worker processes. The run is split into nproc contiguous shards on chunk boundaries,
+    so no chunk is shared between shards, and the partial outputs are stitched back in time order.
+    checkpoint: prefix for checkpoint files. Each shard checkpoints to checkpoint_<chunk0>.npz.
+    stream: product directory. Rows are written there as they are produced (see correlations/products.py)
+    and the returned arrays are memory-mapped from it. Needs nproc=1.
+    '''
+    idxstart, fileidx, files = butils.get_init_info(init_t, end_t, path)
+    print("Starting at: ",idxstart, "in filenum: ",fileidx)
+    print(files[fileidx])
+    spec_start = idxstart + bdc.get_specnum_bounds(files[fileidx])[0]
+    if(stream):
+        if(nproc>1):
+            raise ValueError("Streaming output needs nproc=1")
+        channels = bdc.get_header(files[fileidx],verbose=False)['channels']
+        ncols = len(channels[chanstart:chanend])
+        meta = {'acclen':acclen, 'nchunks':nchunks, 'time_start':init_t, 't_acclen':acclen*4096/250e6, 'chans':[chanstart,chanend], 'channels':channels[chanstart:chanend]}
+        ckpt_fname = butils.get_ckpt_fname(checkpoint, 0)
+        append = ckpt_fname is not None and os.path.exists(ckpt_fname)
+        with products.ProductWriter(stream, {'pol00':'float64','pol11':'float64','pol01':'complex64'}, ncols, meta, append=append) as writer:
+            get_avg_shard(files, fileidx, spec_start, acclen, 0, nchunks, chanstart, chanend, ckpt_fname, ckpt_every, writer)
+        reader = products.ProductReader(stream)
+        return reader['pol00'],reader['pol11'],reader['pol01'],channels
+    shards = butils.get_shard_bounds(nchunks, nproc)
+    jobs = [(files, fileidx, spec_start, acclen, chunk0, n, chanstart, chanend, butils.get_ckpt_fname(checkpoint, chunk0), ckpt_every) for chunk0, n in shards]
+    if(len(jobs)==1):
+        results = [get_avg_shard(*jobs[0])]
+    else:
+        # spawn, not fork: the OpenMP runtime doesn't survive a fork once the parent has used it
+        with mp.get_context('spawn').Pool(len(jobs)) as pool:
+            results = pool.map(_get_avg_shard, jobs)
+    pol00 = np.ma.masked_invalid(np.concatenate([r[0] for r in results]))
+    pol11 = np.ma.masked_invalid(np.concatenate([r[1] for r in results]))
+    pol01 = np.ma.masked_invalid(np.concatenate([r[2] for r in results]))
+    return pol00,pol11,pol01,results[0][3]
+
 if __name__=="__main__":
 
     parser = argparse.ArgumentParser()
@@ -48,6 +125,10 @@ if __name__=="__main__":
     parser.add_argument('-n', '--nchunks', dest='nchunks',type=int, default=560, help='Number of chunks in output file. If stop time is specfied this is overwritten. Default 560 ~ 1 hr.')
     parser.add_argument('-t', '--time_stop', dest='time_stop',type=int, default=False, help='Stop time. Overwrites nchunks if specified')
     parser.add_argument("-c", '--chans', type=int, nargs=2, help="Indices of start and end channels.")
+    parser.add_argument("-p", "--nproc", dest='nproc', type=int, default=1, help="Number of worker processes. The run is split into this many time shards.")
+    parser.add_argument("-ck", "--checkpoint_every", dest='ckpt_every', type=int, default=0, help="Checkpoint finished chunks every this many chunks. 0 disables checkpointing.")
+    parser.add_argument("-r", "--resume", action="store_true", help="Continue from the checkpoint of a previous run with the same arguments")
+    parser.add_argument("-s", "--stream", action="store_true", help="Write rows to a product directory as they are produced instead of one npz at the end")
     parser.add_argument("-l", "--logplot", action="store_true", help="Plot in logscale")
     parser.add_argument('-o', '--outdir', dest='outdir',type=str, default='/scratch/s/sievers/mohanagr/',
               help='Output directory for data and plots')
@@ -64,15 +145,31 @@ if __name__=="__main__":
     
     print("nchunks is: ", args.nchunks,"and stop time is ", args.time_stop)
     # assert(1==0)
-    pol00,pol11,pol01,channels = get_avg_fast(args.data_dir, args.time_start, args.time_stop, args.acclen, args.nchunks, args.chans[0], args.chans[1])
-    print("RUN 1 DONE")
 
-    import os
+    tag = f"{str(args.time_start)}_{str(args.acclen)}_{str(args.nchunks)}_{args.chans[0]}_{args.chans[1]}"
+    checkpoint = None
+    if(args.ckpt_every>0 or args.resume):
+        checkpoint = os.path.join(args.outdir, f"ckpt_pols_4bit_{tag}")
+        if(not args.resume):
+            for f in glob.glob(checkpoint+"_*.npz"):
+                os.remove(f)
+    stream = None
+    if(args.stream):
+        stream = os.path.join(args.outdir, f"pols_4bit_{tag}")
+    pol00,pol11,pol01,channels = get_avg_fast(args.data_dir, args.time_start, args.time_stop, args.acclen, args.nchunks, args.chans[0], args.chans[1],\
+        args.nproc, checkpoint, args.ckpt_every or 100, stream)
+    print("RUN 1 DONE")
 
-    fname = f"pols_4bit_{str(args.time_start)}_{str(args.acclen)}_{str(args.nchunks)}_{args.chans[0]}_{args.chans[1]}.npz"
-    fpath = os.path.join(args.outdir,fname)
-    np.savez_compressed(fpath,datap01=pol01.data,maskp01=pol01.mask,datap00=pol00.data,maskp00=pol00.mask,\
-        datap11=pol11.data,maskp11=pol11.mask,chans=channels)
+    if(stream):
+        print(stream)
+    else:
+        fname = f"pols_4bit_{str(args.time_start)}_{str(args.acclen)}_{str(args.nchunks)}_{args.chans[0]}_{args.chans[1]}.npz"
+        fpath = os.path.join(args.outdir,fname)
+        np.savez_compressed(fpath,datap01=pol01.data,maskp01=pol01.mask,datap00=pol00.data,maskp00=pol00.mask,\
+            datap11=pol11.data,maskp11=pol11.mask,chans=channels)
+    if(checkpoint):
+        for f in glob.glob(checkpoint+"_*.npz"):
+            os.remove(f)
 
     fname=f'pols_4bit_{str(args.time_start)}_{str(args.acclen)}_{str(args.nchunks)}_{args.chans[0]}_{args.chans[1]}.png'
     fpath=os.path.join(args.outdir,fname)
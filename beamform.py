@@ -0,0 +1,132 @@
+import numpy as np
+import time
+from correlations import baseband_data_classes as bdc
+from correlations import correlations as cr
+from utils import baseband_utils as butils
+import argparse
+import os
+
+def get_beam_fast(paths, init_t, end_t, delays, weights, acclen, nchunks, chanstart=0, chanend=None, pol=0, volt_fname=None):
+    '''
+    Form a phased-array beam from several stations in one pass over the baseband files.
+
+    paths: parent data directories, one per station
+    delays: integer delay in spectra of each station. Only the differences matter.
+    weights: (nstation, nchan) complex weights for the channels being read
+    pol: which pol of every station goes into the beam
+    volt_fname: if given, beamformed voltages are appended to volt_fname+'.raw' (complex64, nchan per row) and
+                their spectrum numbers relative to the first station's start to volt_fname+'_specnums.raw' (int64)
+    '''
+    nstation = len(paths)
+    assert(len(delays)==nstation)
+    mindelay = np.min(delays)
+    ants=[]
+    for path, delay in zip(paths, delays):
+        idxstart, fileidx, files = butils.get_init_info(init_t, end_t, path)
+        idxstart += delay - mindelay
+        print("Station", path, "starting at", idxstart, "in filenum", fileidx)
+        ants.append(bdc.BasebandFileIterator(files,fileidx,idxstart,acclen,nchunks=nchunks,chanstart=chanstart,chanend=chanend))
+    if(ants[0].obj.bit_mode!=4):
+        raise NotImplementedError(f"BIT MODE {ants[0].obj.bit_mode} IS NOT SUPPORTED BY THIS SCRIPT.")
+    ncols=ants[0].obj.chanend-ants[0].obj.chanstart
+    weights=np.asarray(weights)
+    assert(weights.shape==(nstation,ncols))
+    beam=np.zeros((nchunks,ncols),dtype='float64',order='c')
+    starts=[ant.spec_num_start for ant in ants]
+    polkey=f'pol{pol}'
+    fvolt=None
+    fspec=None
+    if(volt_fname):
+        fvolt=open(volt_fname+'.raw','wb')
+        fspec=open(volt_fname+'_specnums.raw','wb')
+    st=time.time()
+    try:
+        for i in range(nchunks):
+            t1=time.time()
+            chunks=[next(ant) for ant in ants]
+            datas=[chunk[polkey] for chunk in chunks]
+            specnums=[chunk['specnums'] for chunk in chunks]
+            start_idxs=[m+i*acclen for m in starts]
+            if(fvolt):
+                beam[i,:], volt, common = cr.avg_beam_4bit(datas,specnums,start_idxs,weights,return_voltages=True)
+                (common+i*acclen).astype('int64').tofile(fspec)
+                volt.tofile(fvolt)
+            else:
+                beam[i,:] = cr.avg_beam_4bit(datas,specnums,start_idxs,weights)
+            t2=time.time()
+            print("time taken for one loop", t2-t1)
+            print(i+1,"CHUNK READ")
+    finally:
+        if(fvolt):
+            fvolt.close()
+            fspec.close()
+    print("Time taken final:", time.time()-st)
+    beam = np.ma.masked_invalid(beam)
+    return beam,ants[0].obj.channels
+
+def get_weights(channels, nstation, fname=None, delays_ns=None):
+    '''
+    Complex weights for the beam. Either load a (nstation, nchan) array from an .npy file or
+    phase up the stations for the given geometric delays (in ns) on top of the integer spectrum delays.
+    '''
+    if(fname):
+        return np.load(fname)
+    freqs = channels*125e6/2048
+    if(delays_ns is None):
+        delays_ns = np.zeros(nstation)
+    return np.exp(-2J*np.pi*np.outer(np.asarray(delays_ns)*1e-9,freqs)).astype('complex64')
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description="Beamform 4 bit baseband from several stations.")
+    parser.add_argument('data_dir', type=str,help='Parent data directory. Should have one folder per station, which have 5 digit time folders.')
+    parser.add_argument("time_start",type=int, help="Start timestamp ctime")
+    parser.add_argument("acclen", type=int, help="Accumulation length for averaging")
+    parser.add_argument("-s", "--stations", type=str, nargs='+', default=['snap1','snap3'], help="Station folder names inside data_dir")
+    parser.add_argument("-d", "--delays", type=int, nargs='+', help="Integer delay of each station in spectra")
+    parser.add_argument("-dn", "--delays_ns", type=float, nargs='+', help="Residual geometric delay of each station in ns used for the default weights")
+    parser.add_argument("-w", "--weights", type=str, default=None, help="Path to .npy file with (nstation, nchan) complex weights. Overrides -dn.")
+    parser.add_argument("-p", "--pol", type=int, default=0, help="Pol to beamform (0 or 1)")
+    parser.add_argument('-n', '--nchunks', dest='nchunks',type=int, default=560, help='Number of chunks in output file. If stop time is specfied this is overwritten. Default 560 ~ 1 hr.')
+    parser.add_argument('-t', '--time_stop', dest='time_stop',type=int, default=False, help='Stop time. Overwrites nchunks if specified')
+    parser.add_argument("-c", '--chans', type=int, nargs=2, help="Indices of start and end channels.")
+    parser.add_argument("-v", "--voltages", action="store_true", help="Also write the beamformed voltages")
+    parser.add_argument('-o', '--outdir', dest='outdir',type=str, default='/project/s/sievers/mohanagr/',
+              help='Output directory for data and plots')
+    args = parser.parse_args()
+
+    if(args.time_stop):
+        args.nchunks = int(np.floor((args.time_stop-args.time_start)*250e6/4096/args.acclen))
+    else:
+        args.time_stop = args.time_start + int(np.ceil(args.nchunks*args.acclen*4096/250e6))
+    if(not args.chans):
+        args.chans=[0,None]
+    if(not args.delays):
+        args.delays=[0]*len(args.stations)
+
+    paths=[os.path.join(args.data_dir,s) for s in args.stations]
+    idxstart, fileidx, files = butils.get_init_info(args.time_start, args.time_stop, paths[0])
+    channels=bdc.get_header(files[fileidx],verbose=False)['channels'][args.chans[0]:args.chans[1]]
+    weights=get_weights(channels, len(paths), args.weights, args.delays_ns)
+
+    tag=f"{str(args.time_start)}_{str(args.acclen)}_{str(args.nchunks)}_{args.chans[0]}_{args.chans[1]}_pol{args.pol}"
+    volt_fname=None
+    if(args.voltages):
+        volt_fname=os.path.join(args.outdir,f"beam_volt_{tag}")
+    beam,channels=get_beam_fast(paths, args.time_start, args.time_stop, args.delays, weights, args.acclen, args.nchunks,\
+        args.chans[0], args.chans[1], args.pol, volt_fname)
+
+    fpath = os.path.join(args.outdir,f"beam_4bit_{tag}.npz")
+    np.savez_compressed(fpath,databeam=beam.data,maskbeam=beam.mask,chans=channels,stations=args.stations,delays=args.delays,weights=weights)
+    print(fpath)
+
+    from matplotlib import pyplot as plt
+    t_acclen = args.acclen*4096/250e6
+    myext = np.array([np.min(channels)*125/2048,np.max(channels)*125/2048, beam.shape[0]*t_acclen, 0])
+    plt.figure(figsize=(5,5), dpi=200)
+    plt.imshow(np.log10(beam), aspect='auto', extent=myext, interpolation='none')
+    plt.title(f'Beam power pol{args.pol}, acclen {args.acclen}')
+    plt.colorbar()
+    fpath = os.path.join(args.outdir,f"beam_4bit_{tag}.png")
+    plt.savefig(fpath)
+    print(fpath)
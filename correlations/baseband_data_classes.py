@@ -133,6 +133,30 @@ class BasebandPacked(Baseband):
         # If you want different set of channels, create a new object
         return unpk.sortpols(self.raw_data, self.length_channels, self.bit_mode, rowstart, rowend, self.chanstart, self.chanend)
 
+def get_specnum_bounds(file_name):
+    '''
+    First and last spectrum number in a file, reading only the header and the first and last packets.
+    '''
+    obj=Baseband(file_name,readlen=0)
+    with open(file_name, "rb") as file_data:
+        file_data.seek(obj.header_bytes)
+        first = struct.unpack(">I", file_data.read(4))[0]
+        file_data.seek(obj.header_bytes + (obj.num_packets-1)*obj.bytes_per_packet)
+        last = struct.unpack(">I", file_data.read(4))[0] + obj.spectra_per_packet - 1
+    return int(first), int(last)
+
+def seek_specnum(file_paths, fileidx, specnum):
+    '''
+    Find the file that a spectrum number falls in, starting the search at fileidx.
+    Returns (fileidx, idxstart) to pass to BasebandFileIterator. idxstart is relative to the first spectrum of that file,
+    and is negative if specnum lies in a gap before the file.
+    '''
+    while(True):
+        first, last = get_specnum_bounds(file_paths[fileidx])
+        if(specnum<=last or fileidx==len(file_paths)-1):
+            return fileidx, specnum-first
+        fileidx+=1
+
 def get_rows_from_specnum(stidx,endidx,spec_arr):
     #follows numpy convention
     #endidx is assumed not included
@@ -165,6 +189,22 @@ class BasebandFileIterator():
     def __iter__(self):
         return self
 
+    def seek(self, specnum):
+        '''
+        Move the read pointer to spectrum number specnum, opening another file if it isn't in the current one.
+        Spectra before the current file are read from the earlier file they are in, not skipped as a gap.
+        '''
+        fileidx = self.fileidx
+        if(specnum < self.obj.spec_num[0]):
+            while(fileidx>0 and specnum<=get_specnum_bounds(self.file_paths[fileidx-1])[1]):
+                fileidx-=1
+        elif(specnum > self.obj.spec_idx[-1]):
+            fileidx, _ = seek_specnum(self.file_paths, fileidx, specnum)
+        if(fileidx!=self.fileidx):
+            self.fileidx=fileidx
+            self.obj = BasebandPacked(self.file_paths[fileidx],chanstart=self.chanstart,chanend=self.chanend, unpack=False)
+        self.spec_num_start=specnum
+
     def __next__(self):
         t1=time.time()
         print("Current obj first spec vs acc start", self.obj.spec_idx[0], self.spec_num_start)
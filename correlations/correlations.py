@@ -20,13 +20,28 @@ avg_autocorr_4bit_c = mylib.avg_autocorr_4bit
 xcorr_4bit_c = mylib.xcorr_4bit
 avg_xcorr_4bit_c = mylib.avg_xcorr_4bit
 avg_xcorr_4bit_2ant_c = mylib.avg_xcorr_4bit_2ant
+mylib.avg_xcorr_4bit_2ant_rot.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,\
+    ctypes.c_int64, ctypes.c_int64, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_int64]
+avg_xcorr_4bit_2ant_rot_c = mylib.avg_xcorr_4bit_2ant_rot
+mylib.avg_beam_4bit.argtypes = [ctypes.POINTER(ctypes.c_void_p), ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,\
+    ctypes.c_int, ctypes.c_int, ctypes.c_int]
+avg_beam_4bit_c = mylib.avg_beam_4bit
 
 mylib.avg_xcorr_1bit.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_uint32, ctypes.c_uint32]
 avg_xcorr_1bit_c = mylib.avg_xcorr_1bit
+mylib.avg_xcorr_1bit_2ant.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,\
+    ctypes.c_int64, ctypes.c_int64, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int]
+avg_xcorr_1bit_2ant_c = mylib.avg_xcorr_1bit_2ant
+mylib.binned_corr_4bit.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+binned_corr_4bit_c = mylib.binned_corr_4bit
+mylib.fold_autocorr_4bit.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int64, ctypes.c_int, ctypes.c_int, ctypes.c_double,\
+    ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p]
+fold_autocorr_4bit_c = mylib.fold_autocorr_4bit
 
 def autocorr_4bit(pol):
 
-    data = pol.copy()
+    # kernel only reads the data, no need to copy unless it isn't C contiguous uint8 already
+    data = np.ascontiguousarray(pol, dtype='uint8')
     print(data.shape)
     corr = np.zeros(data.shape,dtype='uint8',order='c') # ncols = nchan for 4 bit
     t1=time.time()
@@ -108,6 +123,68 @@ def avg_xcorr_4bit_2ant(data0, data1, specnum0, specnum1, start_idx0, start_idx1
         return xcorr
     return xcorr/row_count
 
+def avg_xcorr_4bit_2ant_rot(data0, data1, specnum0, specnum1, start_idx0, start_idx1, rot, blocklen):
+    # rot is a (nblock, nchan) array of phasors. Matched spectra are summed in sub-blocks of blocklen spectra
+    # counted from start_idx0, and sub-block b is multiplied by rot[b] before averaging.
+    assert(data0.shape[1]==data1.shape[1])
+    assert(rot.shape[1]==data0.shape[1])
+    rot = np.ascontiguousarray(rot,dtype='complex64')
+    xcorr = np.empty(data0.shape[1],dtype='complex64',order='c')
+    if(len(specnum0)==0 or len(specnum1)==0):
+        xcorr=np.nan
+        return xcorr
+    t1=time.time()
+    row_count = avg_xcorr_4bit_2ant_rot_c(data0.ctypes.data,data1.ctypes.data, xcorr.ctypes.data, specnum0.ctypes.data, specnum1.ctypes.data,\
+        start_idx0, start_idx1, len(specnum0), len(specnum1), data0.shape[1], rot.ctypes.data, rot.shape[0], blocklen)
+    t2=time.time()
+    print(f"time taken for avg_xcorr {t2-t1:5.3f}s")
+    if(row_count==0):
+        xcorr=np.nan
+        return xcorr
+    return xcorr/row_count
+
+def get_common_rows(specnums, start_idxs):
+    # rows of each station for spectra present at all stations, after subtracting each station's start index.
+    # returns (nstation, nrows) row indices and the common spectrum offsets.
+    common = specnums[0]-start_idxs[0]
+    for i in range(1,len(specnums)):
+        common = np.intersect1d(common, specnums[i]-start_idxs[i], assume_unique=True)
+    rownums = np.empty((len(specnums),len(common)),dtype='int64',order='c')
+    for i in range(len(specnums)):
+        rownums[i,:] = np.searchsorted(specnums[i]-start_idxs[i], common)
+    return rownums, common
+
+def avg_beam_4bit(datas, specnums, start_idxs, weights, return_voltages=False):
+    # datas: list of sortpol'd 4 bit arrays, one per station. weights: (nstation, nchan) complex.
+    # returns average beam power per channel, and optionally the (nrows, nchan) voltages plus their spectrum offsets.
+    nstation = len(datas)
+    ncol = datas[0].shape[1]
+    for d in datas:
+        assert(d.shape[1]==ncol)
+        assert(d.flags['C_CONTIGUOUS'])
+    weights = np.ascontiguousarray(weights,dtype='complex64')
+    assert(weights.shape==(nstation,ncol))
+    rownums, common = get_common_rows(specnums, start_idxs)
+    nrows = len(common)
+    if(nrows==0):
+        print("empty block")
+        if(return_voltages):
+            return np.nan, np.empty((0,ncol),dtype='complex64'), common
+        return np.nan
+    power = np.empty(ncol,dtype='float64',order='c')
+    volt = None
+    if(return_voltages):
+        volt = np.empty((nrows,ncol),dtype='complex64',order='c')
+    ptrs = (ctypes.c_void_p*nstation)(*[d.ctypes.data for d in datas])
+    t1=time.time()
+    avg_beam_4bit_c(ptrs, rownums.ctypes.data, weights.ctypes.data, power.ctypes.data, None if volt is None else volt.ctypes.data,\
+        nstation, nrows, ncol)
+    t2=time.time()
+    print(f"time taken for avg_beam {t2-t1:5.3f}s")
+    if(return_voltages):
+        return power/nrows, volt, common
+    return power/nrows
+
 def avg_xcorr_1bit(data0, data1, specnums, nchannels):
 
     #nchannels = num of channels contained in packed pol0/pol1 data
@@ -126,7 +203,71 @@ def avg_xcorr_1bit(data0, data1, specnums, nchannels):
     print(f"time taken for avg_xcorr {t2-t1:5.3f}s")
     return xcorr/nrows
 
+def avg_xcorr_1bit_2ant(data0, data1, specnum0, specnum1, start_idx0, start_idx1, nchannels):
 
+    #nchannels = num of channels contained in packed pol0/pol1 data
+    assert(data0.shape[1]==data1.shape[1])
+    xcorr = np.empty(nchannels,dtype='complex64',order='c')
+    if(len(specnum0)==0 or len(specnum1)==0):
+        xcorr=np.nan
+        return xcorr
+    t1=time.time()
+    row_count = avg_xcorr_1bit_2ant_c(data0.ctypes.data,data1.ctypes.data, xcorr.ctypes.data, specnum0.ctypes.data, specnum1.ctypes.data,\
+        start_idx0, start_idx1, len(specnum0), len(specnum1), nchannels, data0.shape[1])
+    t2=time.time()
+    print(f"time taken for avg_xcorr {t2-t1:5.3f}s")
+    print("ROW COUNT IS ", row_count)
+    if(row_count==0):
+        xcorr=np.nan
+        return xcorr
+    return xcorr/row_count
 
+def binned_corr_4bit(pol0, pol1, specnums, start_idx, binlen, nbin):
+    '''
+    Time-resolved autos and cross of one station. Spectrum s goes into bin (s-start_idx)//binlen.
+    Returns pol00, pol11 (nbin, ncol) float32, pol01 (nbin, ncol) complex64 and the number of spectra in each bin.
+    Bins with no spectra are NaN.
+    '''
+    assert(pol0.shape==pol1.shape)
+    ncol = pol0.shape[1]
+    edges = start_idx + binlen*np.arange(nbin+1, dtype='int64')
+    binstarts = np.searchsorted(specnums, edges, side='left').astype('int64')
+    pol00 = np.empty((nbin,ncol),dtype='float32',order='c')
+    pol11 = np.empty((nbin,ncol),dtype='float32',order='c')
+    pol01 = np.empty((nbin,ncol),dtype='complex64',order='c')
+    t1=time.time()
+    binned_corr_4bit_c(pol0.ctypes.data, pol1.ctypes.data, binstarts.ctypes.data, nbin, ncol, pol00.ctypes.data, pol11.ctypes.data, pol01.ctypes.data)
+    t2=time.time()
+    print(f"time taken for binned_corr {t2-t1:5.3f}s")
+    return pol00, pol11, pol01, np.diff(binstarts)
 
-
+def fold_autocorr_4bit(pol0, pol1, specnums, spec_ref, periods, pdots, nbin, profile=None, counts=None, dt=4096/250e6):
+    '''
+    Fold total power of every spectrum into nbin phase bins for several (period, pdot) trials in one pass.
+    Timing comes from specnums, relative to spec_ref, so missing spectra are simply not counted.
+    profile (ntrial, nbin, ncol) float64 and counts (ntrial, nbin) int64 are accumulated into if passed,
+    so the same arrays can be carried over a whole run. Average profile is profile/counts[...,None].
+    '''
+    assert(pol0.shape==pol1.shape)
+    periods = np.atleast_1d(np.asarray(periods, dtype='float64'))
+    pdots = np.broadcast_to(np.asarray(pdots, dtype='float64'), periods.shape)
+    f0 = np.ascontiguousarray(1/periods)
+    f1 = np.ascontiguousarray(-pdots/periods**2)
+    ntrial = len(periods)
+    ncol = pol0.shape[1]
+    if(profile is None):
+        profile = np.zeros((ntrial,nbin,ncol),dtype='float64',order='c')
+    if(counts is None):
+        counts = np.zeros((ntrial,nbin),dtype='int64',order='c')
+    assert(profile.shape==(ntrial,nbin,ncol) and profile.dtype==np.float64 and profile.flags['C_CONTIGUOUS'])
+    assert(counts.shape==(ntrial,nbin) and counts.dtype==np.int64 and counts.flags['C_CONTIGUOUS'])
+    nrows = len(specnums)
+    if(nrows==0):
+        return profile, counts
+    specnums = np.ascontiguousarray(specnums, dtype='int64')
+    t1=time.time()
+    fold_autocorr_4bit_c(pol0.ctypes.data, pol1.ctypes.data, specnums.ctypes.data, spec_ref, nrows, ncol, dt,\
+        f0.ctypes.data, f1.ctypes.data, ntrial, nbin, profile.ctypes.data, counts.ctypes.data)
+    t2=time.time()
+    print(f"time taken for fold {t2-t1:5.3f}s")
+    return profile, counts
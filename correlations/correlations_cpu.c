@@ -1,6 +1,7 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <stdint.h>
+#include <math.h>
 #include <omp.h>
 
 void autocorr_4bit(uint8_t * data, uint8_t * corr, uint32_t nspec, uint32_t ncol)
@@ -432,3 +433,360 @@ void avg_xcorr_1bit(uint8_t * data0, uint8_t * data1, float * xcorr, int nchan,
     }
 }
 
+
+int avg_xcorr_4bit_2ant_rot(uint8_t * data0, uint8_t * data1, float * xcorr, int64_t* specnum0, int64_t* specnum1, int64_t idxstart0, int64_t idxstart1, int nrows0, int nrows1, int ncol, float * rot, int nblock, int64_t blocklen)
+{
+    /*
+        Same row matching as avg_xcorr_4bit_2ant, but matched rows are summed separately in nblock sub-blocks
+        of blocklen spectra (counted from idxstart0). Each sub-block sum is multiplied by its complex phasor
+        rot[block*ncol+chan] (complex64 array, nblock x ncol) before being added to xcorr.
+        This applies a fringe rotation that changes during the chunk without unpacking the data to float.
+        Rows past the last sub-block are put in the last one.
+    */
+    int *rownums0 = (int *) malloc(sizeof(int)*(nrows0 < nrows1 ? nrows0 : nrows1));
+    int *rownums1 = (int *) malloc(sizeof(int)*(nrows0 < nrows1 ? nrows0 : nrows1));
+    int row_count=0, i=0, j=0;
+    uint8_t imask=15;
+    uint8_t rmask=255-15;
+
+    while((i<nrows0)&&(j<nrows1))
+    {
+        if((specnum0[i]-idxstart0)==(specnum1[j]-idxstart1))
+        {
+            rownums0[row_count]=i;
+            rownums1[row_count]=j;
+            row_count=row_count+1;
+            i=i+1;
+            j=j+1;
+        }
+        else if((specnum0[i]-idxstart0)>(specnum1[j]-idxstart1)) {j=j+1;}
+        else {i=i+1;}
+    }
+
+    for(int k=0; k<ncol; k++)
+    {
+        xcorr[2*k]=0;
+        xcorr[2*k+1]=0;
+    }
+
+    #pragma omp parallel
+    {
+        // sub-block sums are per thread, so keep them on the heap rather than the (small) thread stack
+        int32_t *sum_r_pvt = (int32_t *) calloc((size_t)nblock*ncol, sizeof(int32_t));
+        int32_t *sum_im_pvt = (int32_t *) calloc((size_t)nblock*ncol, sizeof(int32_t));
+
+        #pragma omp for nowait
+        for(int i=0; i<row_count; i++)
+        {
+            int64_t b = (specnum0[rownums0[i]]-idxstart0)/blocklen;
+            if(b<0) {b=0;}
+            if(b>=nblock) {b=nblock-1;}
+            int32_t *sr = sum_r_pvt + b*ncol;
+            int32_t *si = sum_im_pvt + b*ncol;
+            for(int j=0; j<ncol; j++)
+            {
+                int8_t im0=data0[rownums0[i]*ncol+j]&imask;
+                int8_t r0=(data0[rownums0[i]*ncol+j]&rmask)>>4;
+                if (r0 > 8){r0 = r0 - 16;}
+                if (im0 > 8){im0 = im0 - 16;}
+
+                int8_t im1=data1[rownums1[i]*ncol+j]&imask;
+                int8_t r1=(data1[rownums1[i]*ncol+j]&rmask)>>4;
+                if (r1 > 8){r1 = r1 - 16;}
+                if (im1 > 8){im1 = im1 - 16;}
+
+                sr[j] = sr[j] + r0*r1 + im0*im1;
+                si[j] = si[j] + r1*im0 - r0*im1;
+            }
+        }
+        #pragma omp critical
+        {
+            for(int b=0; b<nblock; b++)
+            {
+                for(int k=0; k<ncol; k++)
+                {
+                    float cr = rot[2*(b*ncol+k)], ci = rot[2*(b*ncol+k)+1];
+                    float sr = sum_r_pvt[b*ncol+k], si = sum_im_pvt[b*ncol+k];
+                    xcorr[2*k] = xcorr[2*k] + cr*sr - ci*si;
+                    xcorr[2*k+1] = xcorr[2*k+1] + cr*si + ci*sr;
+                }
+            }
+        }
+        free(sum_r_pvt);
+        free(sum_im_pvt);
+    }
+    free(rownums0);
+    free(rownums1);
+    return row_count;
+}
+
+void avg_beam_4bit(uint8_t ** data, int64_t * rownums, float * weights, double * power, float * volt, int nstation, int nrows, int ncol)
+{
+    /*
+        Phased-array beam from several stations' sortpol'd 4 bit data.
+        data: nstation pointers, each to that station's (nrows_s x ncol) packed data
+        rownums: nstation x nrows. Row of each station to use for beam spectrum i (spectra already aligned in python)
+        weights: nstation x ncol complex64 weights
+        power: ncol. Sum over spectra of |sum_s w_s*x_s|^2. Division by nrows is done in python.
+        volt: nrows x ncol complex64 beamformed voltages. Pass NULL if not needed.
+    */
+    uint8_t imask=15;
+    uint8_t rmask=255-15;
+
+    for(int k=0; k<ncol; k++)
+    {
+        power[k]=0;
+    }
+
+    #pragma omp parallel
+    {
+        double *sum_pvt = (double *) calloc(ncol, sizeof(double));
+        float *br = (float *) malloc(sizeof(float)*ncol);
+        float *bi = (float *) malloc(sizeof(float)*ncol);
+
+        #pragma omp for nowait
+        for(int i=0; i<nrows; i++)
+        {
+            for(int j=0; j<ncol; j++)
+            {
+                br[j]=0;
+                bi[j]=0;
+            }
+            for(int s=0; s<nstation; s++)
+            {
+                uint8_t *row = data[s] + rownums[s*(int64_t)nrows+i]*ncol;
+                float *w = weights + 2*s*ncol;
+                for(int j=0; j<ncol; j++)
+                {
+                    int8_t im=row[j]&imask;
+                    int8_t r=(row[j]&rmask)>>4;
+                    if (r > 8){r = r - 16;}
+                    if (im > 8){im = im - 16;}
+                    br[j] = br[j] + w[2*j]*r - w[2*j+1]*im;
+                    bi[j] = bi[j] + w[2*j]*im + w[2*j+1]*r;
+                }
+            }
+            for(int j=0; j<ncol; j++)
+            {
+                sum_pvt[j] = sum_pvt[j] + br[j]*br[j] + bi[j]*bi[j];
+            }
+            if(volt!=NULL)
+            {
+                for(int j=0; j<ncol; j++)
+                {
+                    volt[2*((int64_t)i*ncol+j)] = br[j];
+                    volt[2*((int64_t)i*ncol+j)+1] = bi[j];
+                }
+            }
+        }
+        #pragma omp critical
+        {
+            for(int k=0; k<ncol; k++)
+            {
+                power[k] = power[k] + sum_pvt[k];
+            }
+        }
+        free(sum_pvt);
+        free(br);
+        free(bi);
+    }
+}
+
+int avg_xcorr_1bit_2ant(uint8_t * data0, uint8_t * data1, float * xcorr, int64_t* specnum0, int64_t* specnum1, int64_t idxstart0, int64_t idxstart1, int nrows0, int nrows1, int nchan, int ncol)
+{
+    /*
+        1 bit version of avg_xcorr_4bit_2ant. Data is sortpol'd 1 bit, 4 channels per byte (c0r c0i c1r c1i c2r c2i c3r c3i).
+        Whole bytes are XOR'd at once:
+            x = d0 ^ d1                 -> r0^r1 and i0^i1 for 4 channels
+            y = d0 ^ (d1 with r/i bits swapped)  -> r0^i1 and i0^r1 for 4 channels
+        With bit 1 = +1 and bit 0 = -1, per channel re(x0*conj(x1)) = 2 - 2*(xr+xi) and im = 2*(yr-yi).
+        We only count bits in the loop and convert to +-1 products at the end.
+        Returns number of matched rows. Division by it is done in python.
+    */
+    int *rownums0 = (int *) malloc(sizeof(int)*(nrows0 < nrows1 ? nrows0 : nrows1));
+    int *rownums1 = (int *) malloc(sizeof(int)*(nrows0 < nrows1 ? nrows0 : nrows1));
+    int row_count=0, i=0, j=0;
+
+    while((i<nrows0)&&(j<nrows1))
+    {
+        if((specnum0[i]-idxstart0)==(specnum1[j]-idxstart1))
+        {
+            rownums0[row_count]=i;
+            rownums1[row_count]=j;
+            row_count=row_count+1;
+            i=i+1;
+            j=j+1;
+        }
+        else if((specnum0[i]-idxstart0)>(specnum1[j]-idxstart1)) {j=j+1;}
+        else {i=i+1;}
+    }
+
+    for(int k=0; k<nchan; k++)
+    {
+        xcorr[2*k]=0;
+        xcorr[2*k+1]=0;
+    }
+
+    #pragma omp parallel
+    {
+        int32_t *sum_r_pvt = (int32_t *) calloc(nchan, sizeof(int32_t));
+        int32_t *sum_im_pvt = (int32_t *) calloc(nchan, sizeof(int32_t));
+
+        #pragma omp for nowait
+        for(int i=0; i<row_count; i++)
+        {
+            uint8_t *row0 = data0 + (int64_t)rownums0[i]*ncol;
+            uint8_t *row1 = data1 + (int64_t)rownums1[i]*ncol;
+            for(int j=0; j<ncol; j++)
+            {
+                uint8_t d1 = row1[j];
+                uint8_t x = row0[j]^d1;
+                uint8_t y = row0[j]^(((d1&0xAA)>>1)|((d1&0x55)<<1));
+                int nc = nchan-4*j;
+                if(nc>4) {nc=4;}
+                for(int c=0; c<nc; c++)
+                {
+                    int sh = 6-2*c;
+                    sum_r_pvt[4*j+c] = sum_r_pvt[4*j+c] + ((x>>(sh+1))&1) + ((x>>sh)&1);
+                    sum_im_pvt[4*j+c] = sum_im_pvt[4*j+c] + ((y>>(sh+1))&1) - ((y>>sh)&1);
+                }
+            }
+        }
+        #pragma omp critical
+        {
+            for(int k=0; k<nchan; k++)
+            {
+                xcorr[2*k] = xcorr[2*k] - 2*sum_r_pvt[k];
+                xcorr[2*k+1] = xcorr[2*k+1] + 2*sum_im_pvt[k];
+            }
+        }
+        free(sum_r_pvt);
+        free(sum_im_pvt);
+    }
+    for(int k=0; k<nchan; k++)
+    {
+        xcorr[2*k] = xcorr[2*k] + 2*row_count;
+    }
+    free(rownums0);
+    free(rownums1);
+    return row_count;
+}
+
+void binned_corr_4bit(uint8_t * pol0, uint8_t * pol1, int64_t * binstarts, int nbin, int ncol, float * pol00, float * pol11, float * pol01)
+{
+    /*
+        Lightly averaged (time-resolved) autos and cross of one station in one pass over the data.
+        Rows binstarts[b] to binstarts[b+1] belong to time bin b. Rows are sortpol'd 4 bit, missing spectra are
+        simply absent so bins can have fewer rows than binlen. Each bin is independent, so we parallelize over bins.
+
+        pol00, pol11: nbin * ncol. pol01: nbin * ncol complex (interleaved re, im). Averaged here, NaN for empty bins.
+    */
+    #pragma omp parallel
+    {
+        int32_t *s00 = (int32_t *) malloc(sizeof(int32_t)*ncol);
+        int32_t *s11 = (int32_t *) malloc(sizeof(int32_t)*ncol);
+        int32_t *s01r = (int32_t *) malloc(sizeof(int32_t)*ncol);
+        int32_t *s01i = (int32_t *) malloc(sizeof(int32_t)*ncol);
+
+        #pragma omp for
+        for(int b=0; b<nbin; b++)
+        {
+            int64_t n = binstarts[b+1]-binstarts[b];
+            for(int j=0; j<ncol; j++)
+            {
+                s00[j]=0; s11[j]=0; s01r[j]=0; s01i[j]=0;
+            }
+            for(int64_t i=binstarts[b]; i<binstarts[b+1]; i++)
+            {
+                for(int j=0; j<ncol; j++)
+                {
+                    uint8_t d0 = pol0[i*ncol+j];
+                    uint8_t d1 = pol1[i*ncol+j];
+                    int8_t r0 = d0>>4;
+                    int8_t im0 = d0&15;
+                    int8_t r1 = d1>>4;
+                    int8_t im1 = d1&15;
+                    if (r0 > 8){r0 = r0 - 16;}
+                    if (im0 > 8){im0 = im0 - 16;}
+                    if (r1 > 8){r1 = r1 - 16;}
+                    if (im1 > 8){im1 = im1 - 16;}
+                    s00[j] += r0*r0 + im0*im0;
+                    s11[j] += r1*r1 + im1*im1;
+                    s01r[j] += r0*r1 + im0*im1;
+                    s01i[j] += r1*im0 - r0*im1;
+                }
+            }
+            for(int j=0; j<ncol; j++)
+            {
+                int64_t k = (int64_t)b*ncol+j;
+                if(n==0)
+                {
+                    pol00[k] = NAN; pol11[k] = NAN; pol01[2*k] = NAN; pol01[2*k+1] = NAN;
+                }
+                else
+                {
+                    pol00[k] = (float)s00[j]/n;
+                    pol11[k] = (float)s11[j]/n;
+                    pol01[2*k] = (float)s01r[j]/n;
+                    pol01[2*k+1] = (float)s01i[j]/n;
+                }
+            }
+        }
+        free(s00);
+        free(s11);
+        free(s01r);
+        free(s01i);
+    }
+}
+
+void fold_autocorr_4bit(uint8_t * pol0, uint8_t * pol1, int64_t * specnums, int64_t spec_ref, int nrows, int ncol, double dt,\
+    double * f0, double * f1, int ntrial, int nbin, double * profile, int64_t * counts)
+{
+    /*
+        Fold total power |pol0|^2 + |pol1|^2 of every spectrum into nbin phase bins for ntrial (f0, f1) trials at once.
+        Spectrum with specnum s is at t = (s-spec_ref)*dt and phase f0*t + f1*t^2/2.
+        profile: ntrial * nbin * ncol, counts: ntrial * nbin. Both are accumulated into, not zeroed, so this
+        can be called chunk by chunk on a long stream.
+    */
+    int32_t *ibin = (int32_t *) malloc(sizeof(int32_t)*(int64_t)ntrial*nrows);
+
+    #pragma omp parallel for
+    for(int k=0; k<ntrial; k++)
+    {
+        for(int i=0; i<nrows; i++)
+        {
+            double t = (specnums[i]-spec_ref)*dt;
+            double ph = f0[k]*t + 0.5*f1[k]*t*t;
+            ph = ph - floor(ph);
+            int b = (int)(ph*nbin);
+            if(b>=nbin) {b=nbin-1;}
+            ibin[(int64_t)k*nrows+i] = b;
+            counts[(int64_t)k*nbin+b] += 1;
+        }
+    }
+
+    // every thread owns a block of channels, so no two threads write to the same profile element
+    #pragma omp parallel for schedule(static)
+    for(int j=0; j<ncol; j++)
+    {
+        for(int i=0; i<nrows; i++)
+        {
+            uint8_t d0 = pol0[(int64_t)i*ncol+j];
+            uint8_t d1 = pol1[(int64_t)i*ncol+j];
+            int8_t r0 = d0>>4;
+            int8_t im0 = d0&15;
+            int8_t r1 = d1>>4;
+            int8_t im1 = d1&15;
+            if (r0 > 8){r0 = r0 - 16;}
+            if (im0 > 8){im0 = im0 - 16;}
+            if (r1 > 8){r1 = r1 - 16;}
+            if (im1 > 8){im1 = im1 - 16;}
+            int p = r0*r0 + im0*im0 + r1*r1 + im1*im1;
+            for(int k=0; k<ntrial; k++)
+            {
+                profile[((int64_t)k*nbin + ibin[(int64_t)k*nrows+i])*ncol + j] += p;
+            }
+        }
+    }
+    free(ibin);
+}
@@ -0,0 +1,38 @@
+import numpy as np
+
+class DelayModel():
+    '''
+    Relative delay between two stations, linear in time.
+    t is in seconds since the start of the correlation and channels are absolute channel numbers.
+
+    Integer delay in spectra:   delay(t) = delay0 + delay_rate*t  (rounded to nearest spectrum)
+    Phase in radians:           phase(t,chan) = phase0 + phase_rate*t + (slope0 + slope_rate*t)*chan
+
+    Positive delay follows the xcorravg convention: antenna 1 is read that many spectra later.
+    '''
+    def __init__(self, delay0=0, delay_rate=0., slope0=0., slope_rate=0., phase0=0., phase_rate=0.):
+        self.delay0 = delay0
+        self.delay_rate = delay_rate
+        self.slope0 = slope0
+        self.slope_rate = slope_rate
+        self.phase0 = phase0
+        self.phase_rate = phase_rate
+
+    def get_delay(self, t):
+        return int(np.round(self.delay0 + self.delay_rate*t))
+
+    def get_phase(self, t, channels):
+        #t can be a scalar or an array of times. output is (len(t), nchan) for array t
+        t = np.asarray(t,dtype='float64')[...,None]
+        channels = np.asarray(channels,dtype='float64')
+        return self.phase0 + self.phase_rate*t + (self.slope0 + self.slope_rate*t)*channels
+
+    def get_rot(self, t, channels):
+        '''
+        Phasors that undo the model phase. If x1 carries the model phase relative to x2,
+        multiply x1*conj(x2) by these to fringe-stop.
+        '''
+        return np.exp(-1J*self.get_phase(t,channels)).astype('complex64')
+
+    def is_static(self):
+        return self.delay_rate==0 and self.slope0==0 and self.slope_rate==0 and self.phase0==0 and self.phase_rate==0
@@ -0,0 +1,85 @@
+import numpy as np
+import scipy.fft
+
+class FineChannelizer():
+    '''
+    Upchannelize coarse PFB channels by FFTing along time within every channel, and accumulate
+    fine resolution auto and cross spectra of two pols. Feed it contiguous blocks of spectra with push().
+    The samples that don't fill a full FFT segment are carried over to the next push, so block edges
+    (chunk or file boundaries) make no difference.
+
+    nfft: fine channels per coarse channel
+    noverlap: samples shared by consecutive segments (default nfft//2)
+    window: apply a Hann window (normalized to preserve power) before the FFT
+    batch: segments FFT'd per call, to bound memory
+    workers: threads used by scipy.fft
+    '''
+    def __init__(self, ncol, nfft, noverlap=None, window=True, batch=256, workers=-1):
+        self.ncol = ncol
+        self.nfft = nfft
+        if(noverlap is None):
+            noverlap = nfft//2
+        self.step = nfft - noverlap
+        assert(self.step>0)
+        if(window):
+            win = np.hanning(nfft)
+        else:
+            win = np.ones(nfft)
+        self.win = (win/np.sqrt(np.mean(win**2))).astype('float32')
+        self.batch = batch
+        self.workers = workers
+        self.carry0 = np.zeros((0,ncol), dtype='complex64')
+        self.carry1 = np.zeros((0,ncol), dtype='complex64')
+        self.carry_present = np.zeros(0, dtype=bool)
+        self.auto00 = np.zeros((ncol,nfft), dtype='float64')
+        self.auto11 = np.zeros((ncol,nfft), dtype='float64')
+        self.cross01 = np.zeros((ncol,nfft), dtype='complex128')
+        self.nseg = 0
+        self.nskipped = 0
+
+    def push(self, x0, x1, present):
+        '''
+        x0, x1: (nspec, ncol) complex spectra of the two pols, contiguous in time (gaps zero filled)
+        present: (nspec,) bool, False for spectra that were missing. Segments with any missing spectrum are skipped.
+        '''
+        x0 = np.concatenate([self.carry0, x0])
+        x1 = np.concatenate([self.carry1, x1])
+        present = np.concatenate([self.carry_present, present])
+        n = x0.shape[0]
+        nseg = 0
+        if(n>=self.nfft):
+            nseg = (n-self.nfft)//self.step + 1
+            # (nseg, ncol, nfft) views, no copy
+            seg0 = np.lib.stride_tricks.sliding_window_view(x0, self.nfft, axis=0)[::self.step][:nseg]
+            seg1 = np.lib.stride_tricks.sliding_window_view(x1, self.nfft, axis=0)[::self.step][:nseg]
+            good = np.lib.stride_tricks.sliding_window_view(present, self.nfft)[::self.step][:nseg].all(axis=1)
+            idx = np.where(good)[0]
+            self.nskipped += nseg - len(idx)
+            for i in range(0, len(idx), self.batch):
+                b = idx[i:i+self.batch]
+                f0 = scipy.fft.fft(seg0[b]*self.win, axis=2, workers=self.workers)
+                f1 = scipy.fft.fft(seg1[b]*self.win, axis=2, workers=self.workers)
+                self.auto00 += np.sum(np.abs(f0)**2, axis=0)
+                self.auto11 += np.sum(np.abs(f1)**2, axis=0)
+                self.cross01 += np.sum(f0*np.conj(f1), axis=0)
+            self.nseg += len(idx)
+        consumed = nseg*self.step
+        self.carry0 = x0[consumed:].copy()
+        self.carry1 = x1[consumed:].copy()
+        self.carry_present = present[consumed:].copy()
+
+    def get_spectra(self):
+        '''
+        Average fine spectra, each (ncol*nfft,) with fine channels in increasing frequency order
+        (coarse channel major, fftshifted within each coarse channel).
+        '''
+        norm = max(self.nseg,1)*self.nfft
+        out = []
+        for s in (self.auto00, self.auto11, self.cross01):
+            out.append((np.fft.fftshift(s, axes=1)/norm).ravel())
+        return out
+
+    def get_freqs(self, channels, chan_bw=125/2048):
+        # fine channel centers in MHz for coarse channel numbers `channels`
+        offsets = np.fft.fftshift(np.fft.fftfreq(self.nfft))
+        return ((np.asarray(channels)[:,None] + offsets[None,:])*chan_bw).ravel()
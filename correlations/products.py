@@ -0,0 +1,175 @@
+import numpy as np
+import json
+import os
+
+'''
+Appendable on-disk format for averaged products (time x channel waterfalls).
+
+A product is a directory with
+    meta.json           number of rows, ncols, dtype of every product and whatever the writer adds (acclen, channels, times...)
+    <name>.dat          raw rows of product <name>, row-major, appended in time order
+    <name>.mask         packed bitmap (np.packbits along channels) of masked entries, one row per time row
+
+Rows are appended to the .dat/.mask files as they come and meta.json is rewritten atomically on every flush,
+so nrows in meta.json only ever counts rows that are fully on disk. Readers can memory-map a product while it is being written.
+'''
+
+def _to_json(val):
+    if(isinstance(val, np.ndarray)):
+        return val.tolist()
+    if(isinstance(val, np.generic)):
+        return val.item()
+    return val
+
+def _write_meta(path, meta):
+    fname = os.path.join(path, 'meta.json')
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp, fname)
+
+def _read_meta(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        return json.load(f)
+
+class ProductWriter():
+    def __init__(self, path, products, ncols, meta=None, flush_every=1, append=False):
+        '''
+        products: dict of product name -> dtype, e.g. {'pol00':'float64', 'pol01':'complex64'}
+        meta: extra metadata saved in meta.json (acclen, channels, time_start...)
+        flush_every: rows buffered by the OS before meta.json is updated
+        append: continue an existing product instead of starting a new one
+        '''
+        self.path = path
+        self.ncols = int(ncols)
+        self.flush_every = flush_every
+        self.products = {name:np.dtype(dt) for name, dt in products.items()}
+        self.nmaskbytes = int(np.ceil(self.ncols/8))
+        os.makedirs(path, exist_ok=True)
+        if(append and os.path.exists(os.path.join(path, 'meta.json'))):
+            self.meta = _read_meta(path)
+            if(self.meta['ncols']!=self.ncols or self.meta['products']!={name:dt.str for name, dt in self.products.items()}):
+                raise ValueError(f"Existing product at {path} has different columns or products")
+            self.nrows = self.meta['nrows']
+        else:
+            self.meta = {name:_to_json(val) for name, val in (meta or {}).items()}
+            self.meta['ncols'] = self.ncols
+            self.meta['products'] = {name:dt.str for name, dt in self.products.items()}
+            self.nrows = 0
+        self.files = {}
+        for name in self.products:
+            for ext in ('dat', 'mask'):
+                fname = os.path.join(path, f"{name}.{ext}")
+                mode = 'r+b' if os.path.exists(fname) else 'w+b'
+                f = open(fname, mode)
+                # anything past nrows is from a run that died before updating meta. drop it.
+                f.truncate(self._rowbytes(name, ext)*self.nrows)
+                f.seek(0, os.SEEK_END)
+                self.files[(name, ext)] = f
+        self.unflushed = 0
+        self._update_meta()
+
+    def _rowbytes(self, name, ext):
+        if(ext=='dat'):
+            return self.products[name].itemsize*self.ncols
+        return self.nmaskbytes
+
+    def _update_meta(self):
+        self.meta['nrows'] = self.nrows
+        _write_meta(self.path, self.meta)
+
+    def append(self, **rows):
+        '''
+        Append one row (ncols,) or a block of rows (n, ncols) of every product.
+        Masked entries, or non-finite ones if a plain array is passed, are marked in the mask bitmap.
+        '''
+        if(set(rows.keys())!=set(self.products.keys())):
+            raise ValueError(f"Need rows for {sorted(self.products.keys())}, got {sorted(rows.keys())}")
+        nnew = None
+        for name, row in rows.items():
+            if(np.ma.isMaskedArray(row)):
+                mask = np.atleast_2d(np.ma.getmaskarray(row))
+                data = np.atleast_2d(row.data)
+            else:
+                data = np.atleast_2d(row)
+                mask = ~np.isfinite(data)
+            if(data.shape[1]!=self.ncols):
+                raise ValueError(f"{name} has {data.shape[1]} columns, expected {self.ncols}")
+            if(nnew is None):
+                nnew = data.shape[0]
+            assert(data.shape[0]==nnew)
+            self.files[(name, 'dat')].write(np.ascontiguousarray(data, dtype=self.products[name]).tobytes())
+            self.files[(name, 'mask')].write(np.packbits(mask, axis=1).tobytes())
+        self.nrows += nnew
+        self.unflushed += nnew
+        if(self.unflushed>=self.flush_every):
+            self.flush()
+
+    def flush(self):
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        self._update_meta()
+        self.unflushed = 0
+
+    def truncate(self, nrows):
+        # roll back to nrows rows, e.g. to the last checkpoint
+        assert(nrows<=self.nrows)
+        for (name, ext), f in self.files.items():
+            f.flush()
+            f.truncate(self._rowbytes(name, ext)*nrows)
+            f.seek(0, os.SEEK_END)
+        self.nrows = nrows
+        self.flush()
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class ProductReader():
+    def __init__(self, path):
+        self.path = path
+        self.refresh()
+
+    def refresh(self):
+        # pick up rows written since the reader was opened
+        self.meta = _read_meta(self.path)
+        self.nrows = self.meta['nrows']
+        self.ncols = self.meta['ncols']
+        self.products = {name:np.dtype(dt) for name, dt in self.meta['products'].items()}
+
+    def data(self, name):
+        '''
+        Memory-mapped (nrows, ncols) array of product name. Nothing is read until it is sliced.
+        '''
+        if(self.nrows==0):
+            return np.zeros((0, self.ncols), dtype=self.products[name])
+        return np.memmap(os.path.join(self.path, f"{name}.dat"), dtype=self.products[name], mode='r', shape=(self.nrows, self.ncols))
+
+    def mask(self, name, start=None, stop=None):
+        start, stop, _ = slice(start, stop).indices(self.nrows)
+        nbytes = int(np.ceil(self.ncols/8))
+        if(stop<=start):
+            return np.zeros((0, self.ncols), dtype=bool)
+        packed = np.memmap(os.path.join(self.path, f"{name}.mask"), dtype='uint8', mode='r', shape=(self.nrows, nbytes))
+        return np.unpackbits(packed[start:stop], axis=1, count=self.ncols).astype(bool)
+
+    def get(self, name, start=None, stop=None):
+        '''
+        Masked array of rows start:stop of product name.
+        '''
+        s = slice(start, stop)
+        return np.ma.masked_array(self.data(name)[s], mask=self.mask(name, start, stop))
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __len__(self):
+        return self.nrows
@@ -0,0 +1,59 @@
+import os
+import sys
+import types
+
+def stub_module(name, **attrs):
+    '''
+    Make "import name" work when the package isn't installed here, so the pure functions of modules that import it
+    at the top can be tested. attrs are set on the stub. Nothing is stubbed if the real package imports.
+    '''
+    try:
+        __import__(name)
+        return sys.modules[name]
+    except ImportError:
+        pass
+    parent = None
+    parts = name.split('.')
+    for k in range(len(parts)):
+        full = '.'.join(parts[:k+1])
+        mod = sys.modules.get(full)
+        if(mod is None):
+            mod = types.ModuleType(full)
+            sys.modules[full] = mod
+        if(parent is not None):
+            setattr(parent, parts[k], mod)
+        parent = mod
+    for key, val in attrs.items():
+        setattr(mod, key, val)
+    return mod
+
+class FakeDirect():
+    '''
+    Direct data for tests: 10-digit directories under data_dir with empty product files (for directory listings and
+    mtimes) and the arrays in memory. install(monkeypatch) serves them through direct_cache.get_direct, which
+    SNAPfiletools.read_direct_parallel reads through too, and records every directory read in reads.
+    '''
+    def __init__(self, data_dir):
+        self.data_dir = os.path.abspath(data_dir)
+        self.dat = {}
+        self.reads = []
+
+    def add(self, tstamp, arrs):
+        # arrs: product -> (nrow, nchan) array or None for a missing product
+        d = os.path.join(self.data_dir, str(tstamp//100000), str(tstamp))
+        os.makedirs(d, exist_ok=True)
+        for p in arrs:
+            open(os.path.join(d, p+'.scio.bz2'), 'w').close()
+        self.dat[d] = arrs
+        return d
+
+    def get_direct(self, d, products=None, **kwargs):
+        d = os.path.abspath(d)
+        self.reads.append(d)
+        return {p:self.dat[d].get(p) for p in (products or self.dat[d])}
+
+    def install(self, monkeypatch):
+        from utils import direct_cache
+        monkeypatch.setattr(direct_cache, 'get_direct', self.get_direct)
+        monkeypatch.setattr(direct_cache, 'evict', lambda **kwargs: None)
+        return self
@@ -0,0 +1,54 @@
+import numpy as np
+import struct
+import os
+
+def write_baseband(fname, spec_num, raw, channels, spectra_per_packet, bit_mode=4):
+    '''
+    Write a baseband file in the albatros format.
+    spec_num: first spectrum number of each packet
+    raw: (npackets, bytes_per_packet-4) uint8 packet payloads
+    channels: channel numbers as they should come out of Baseband(). For 4 bit the header stores
+    each channel twice, for 1 bit only every other channel is stored.
+    '''
+    channels = np.asarray(channels)
+    if(bit_mode==4):
+        hdr_chans = np.repeat(channels,2)
+        length_channels = 2*len(channels)
+    elif(bit_mode==1):
+        hdr_chans = channels[::2]
+        length_channels = len(channels)//2
+    bytes_per_packet = raw.shape[1]+4
+    with open(fname,'wb') as f:
+        f.write(struct.pack(">Q", 80+8*len(hdr_chans)))
+        for v in [bytes_per_packet, length_channels, spectra_per_packet, bit_mode, 0]:
+            f.write(struct.pack(">Q", v))
+        f.write(hdr_chans.astype('>u8').tobytes())
+        f.write(struct.pack(">QQddd", 0, 0, 0., 0., 0.))
+        data = np.empty(len(spec_num), dtype=[("spec_num", ">u4"), ("spectra", "%dB"%(bytes_per_packet-4))])
+        data["spec_num"] = spec_num
+        data["spectra"] = raw
+        data.tofile(f)
+
+def make_station(parent, t0, nfiles, npackets, nchan=8, spectra_per_packet=4, spec0=1000, seed=0, drop_every=7):
+    '''
+    Write nfiles consecutive 4 bit files under parent/5digit/10digit.raw, with some packets
+    dropped inside every file and a gap of a few packets between files. File k is named t0+k.
+    Returns the sorted list of file paths.
+    '''
+    rng = np.random.default_rng(seed)
+    nbytes = spectra_per_packet*2*nchan
+    channels = np.arange(100,100+nchan)
+    spec = spec0
+    files = []
+    for k in range(nfiles):
+        spec_num = spec + spectra_per_packet*np.arange(npackets)
+        spec_num = spec_num[np.arange(npackets)%drop_every!=3]
+        tstamp = t0 + k
+        d = os.path.join(parent, str(tstamp//100000))
+        os.makedirs(d, exist_ok=True)
+        fname = os.path.join(d, f"{tstamp}.raw")
+        raw = rng.integers(0,256,(len(spec_num),nbytes)).astype('uint8')
+        write_baseband(fname, spec_num, raw, channels, spectra_per_packet)
+        files.append(fname)
+        spec = spec + spectra_per_packet*(npackets+3)
+    return files
@@ -0,0 +1,39 @@
+import pytest
+import numpy as np
+from correlations import correlations as cr
+
+def unpack_sorted_1bit(pol, nchan):
+    #bit 1 -> +1, bit 0 -> -1. 4 chans per byte: c0r c0i c1r c1i c2r c2i c3r c3i
+    bits=np.unpackbits(pol,axis=1).astype('float32')*2-1
+    return (bits[:,0::2]+1J*bits[:,1::2])[:,:nchan]
+
+@pytest.mark.parametrize("nchan", [16, 13])
+def test_1bit_2ant(nchan):
+    rng=np.random.default_rng(7)
+    nrows=300
+    ncol=int(np.ceil(nchan/4))
+    data0=rng.integers(0,256,(nrows,ncol)).astype('uint8')
+    data1=rng.integers(0,256,(nrows,ncol)).astype('uint8')
+    specnum0=np.arange(100,100+nrows+10,dtype='int64')
+    specnum0=np.delete(specnum0,np.arange(20,30))
+    specnum1=np.arange(700,700+nrows+10,dtype='int64')
+    specnum1=np.delete(specnum1,np.arange(200,210))
+    cr1=cr.avg_xcorr_1bit_2ant(data0,data1,specnum0,specnum1,100,702,nchan)
+    x0=unpack_sorted_1bit(data0,nchan)
+    x1=unpack_sorted_1bit(data1,nchan)
+    common,i0,i1=np.intersect1d(specnum0-100,specnum1-702,return_indices=True)
+    cr2=np.mean(x0[i0]*np.conj(x1[i1]),axis=0)
+    assert np.allclose(cr1,cr2,atol=1e-6)
+
+def test_1bit_2ant_autocorr():
+    rng=np.random.default_rng(3)
+    data0=rng.integers(0,256,(50,4)).astype('uint8')
+    specnum=np.arange(50,dtype='int64')
+    #|x|^2 = 2 for every 1 bit sample
+    cr1=cr.avg_xcorr_1bit_2ant(data0,data0.copy(),specnum,specnum,0,0,16)
+    assert np.allclose(cr1,2)
+
+def test_1bit_2ant_no_overlap():
+    data0=np.zeros((10,2),dtype='uint8')
+    specnum=np.arange(10,dtype='int64')
+    assert np.isnan(cr.avg_xcorr_1bit_2ant(data0,data0,specnum,specnum+100,0,0,8))
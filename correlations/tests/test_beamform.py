@@ -0,0 +1,57 @@
+import pytest
+import numpy as np
+from correlations import correlations as cr
+
+def unpack_sorted_4bit(pol):
+    re=np.asarray(np.right_shift(np.bitwise_and(pol, 0xf0), 4), dtype="int8")
+    re[re>8]=re[re>8]-16
+    im=np.asarray(np.bitwise_and(pol, 0x0f), dtype="int8")
+    im[im>8]=im[im>8]-16
+    return re+1J*im
+
+@pytest.fixture
+def stations():
+    rng=np.random.default_rng(7)
+    ncol=10
+    datas=[]
+    specnums=[]
+    starts=[100,2000,35]
+    for i,st in enumerate(starts):
+        spec=np.arange(st,st+150,dtype='int64')
+        spec=np.delete(spec,np.arange(20*i,20*i+7)) #missing spectra at different places
+        datas.append(rng.integers(0,256,(len(spec),ncol)).astype('uint8'))
+        specnums.append(spec)
+    weights=np.exp(1J*rng.uniform(-np.pi,np.pi,(3,ncol)))*rng.uniform(0.5,1.5,(3,ncol))
+    return datas,specnums,starts,weights.astype('complex64')
+
+def test_common_rows(stations):
+    datas,specnums,starts,weights=stations
+    rownums,common=cr.get_common_rows(specnums,starts)
+    assert rownums.shape==(3,len(common))
+    assert len(common)==150-21
+    for i in range(3):
+        assert np.all(specnums[i][rownums[i]]-starts[i]==common)
+
+def test_beam_power_and_voltages(stations):
+    datas,specnums,starts,weights=stations
+    power,volt,common=cr.avg_beam_4bit(datas,specnums,starts,weights,return_voltages=True)
+    rownums,_=cr.get_common_rows(specnums,starts)
+    ref=np.zeros(volt.shape,dtype='complex128')
+    for i in range(3):
+        ref=ref+weights[i]*unpack_sorted_4bit(datas[i])[rownums[i]]
+    assert np.allclose(volt,ref,rtol=1e-5,atol=1e-4)
+    assert np.allclose(power,np.mean(np.abs(ref)**2,axis=0),rtol=1e-5)
+    power2=cr.avg_beam_4bit(datas,specnums,starts,weights)
+    assert np.allclose(power,power2)
+
+def test_beam_single_station_is_autocorr(stations):
+    datas,specnums,starts,weights=stations
+    ones=np.ones((1,datas[0].shape[1]),dtype='complex64')
+    power=cr.avg_beam_4bit(datas[:1],specnums[:1],starts[:1],ones)
+    auto=cr.avg_autocorr_4bit(datas[0],specnums[0])
+    assert np.allclose(power,auto)
+
+def test_beam_no_overlap(stations):
+    datas,specnums,starts,weights=stations
+    power=cr.avg_beam_4bit(datas[:2],specnums[:2],[starts[0],starts[1]+1000],weights[:2])
+    assert np.isnan(power)
@@ -0,0 +1,58 @@
+import pytest
+import numpy as np
+import autocorravg
+import spectra_stream
+from correlations import correlations as cr
+from correlations import products
+from correlations.tests.synth_baseband import make_station
+
+t0 = 1700000000
+
+def unpack_sorted_4bit(pol):
+    re=np.asarray(np.right_shift(np.bitwise_and(pol, 0xf0), 4), dtype="int8")
+    re[re>8]=re[re>8]-16
+    im=np.asarray(np.bitwise_and(pol, 0x0f), dtype="int8")
+    im[im>8]=im[im>8]-16
+    return re+1J*im
+
+def test_binned_corr():
+    rng=np.random.default_rng(5)
+    nrows,ncol=300,9
+    pol0=rng.integers(0,256,(nrows,ncol)).astype('uint8')
+    pol1=rng.integers(0,256,(nrows,ncol)).astype('uint8')
+    specnums=np.arange(50,50+nrows+40,dtype='int64')
+    specnums=np.delete(specnums,np.r_[10:50,77])
+    binlen,nbin=8,45
+    pol00,pol11,pol01,counts=cr.binned_corr_4bit(pol0,pol1,specnums,48,binlen,nbin)
+    x0=unpack_sorted_4bit(pol0)
+    x1=unpack_sorted_4bit(pol1)
+    b=(specnums-48)//binlen
+    for k in range(nbin):
+        rows=np.where(b==k)[0]
+        assert counts[k]==len(rows)
+        if(len(rows)==0):
+            assert np.all(np.isnan(pol00[k])) and np.all(np.isnan(pol01[k]))
+            continue
+        assert np.allclose(pol00[k],np.mean(np.abs(x0[rows])**2,axis=0))
+        assert np.allclose(pol11[k],np.mean(np.abs(x1[rows])**2,axis=0))
+        assert np.allclose(pol01[k],np.mean(x0[rows]*np.conj(x1[rows]),axis=0))
+
+def test_binlen1_matches_autocorr():
+    rng=np.random.default_rng(1)
+    pol0=rng.integers(0,256,(40,6)).astype('uint8')
+    pol00,pol11,pol01,counts=cr.binned_corr_4bit(pol0,pol0,np.arange(40,dtype='int64'),0,1,40)
+    assert np.all(counts==1)
+    assert np.allclose(pol00,cr.autocorr_4bit(pol0))
+
+def test_stream_matches_autocorravg(tmp_path):
+    data_dir=str(tmp_path/'snap1')
+    make_station(data_dir, t0, nfiles=3, npackets=60)
+    binlen,nbins=6,100
+    outpath=spectra_stream.stream_spectra(data_dir,t0,t0+10,binlen,nbins,str(tmp_path/'prod'),bins_per_chunk=7)
+    reader=products.ProductReader(outpath)
+    assert len(reader)==nbins
+    ref=autocorravg.get_avg_fast(data_dir,t0,t0+10,binlen,nbins)
+    for name,r in zip(['pol00','pol11','pol01'],ref[:3]):
+        res=reader[name]
+        assert np.all(res.mask==r.mask)
+        assert np.allclose(res.filled(0),r.filled(0),rtol=1e-5)
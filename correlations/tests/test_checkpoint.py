@@ -0,0 +1,71 @@
+import pytest
+import numpy as np
+import autocorravg
+import xcorravg
+from correlations import correlations as cr
+from correlations.tests.synth_baseband import make_station
+
+t0 = 1700000000
+
+def crash_after(monkeypatch, module, name, ncalls):
+    func=getattr(module,name)
+    count=[0]
+    def wrapped(*args):
+        count[0]+=1
+        if(count[0]>ncalls):
+            raise KeyboardInterrupt
+        return func(*args)
+    monkeypatch.setattr(module,name,wrapped)
+    return count
+
+def test_autocorr_resume(tmp_path, monkeypatch):
+    data_dir=str(tmp_path/'snap1')
+    make_station(data_dir, t0, nfiles=3, npackets=60)
+    acclen,nchunks=37,18
+    ref=autocorravg.get_avg_fast(data_dir,t0,t0+10,acclen,nchunks)
+    ckpt=str(tmp_path/'ckpt')
+    with monkeypatch.context() as m:
+        crash_after(m, cr, 'avg_autocorr_4bit', 2*12)
+        with pytest.raises(KeyboardInterrupt):
+            autocorravg.get_avg_fast(data_dir,t0,t0+10,acclen,nchunks,checkpoint=ckpt,ckpt_every=5)
+    with monkeypatch.context() as m:
+        count=crash_after(m, cr, 'avg_autocorr_4bit', 1000)
+        res=autocorravg.get_avg_fast(data_dir,t0,t0+10,acclen,nchunks,checkpoint=ckpt,ckpt_every=5)
+    #chunks 0-9 came from the checkpoint
+    assert count[0]==2*(nchunks-10)
+    #the iterator state has no rows in it, and each row file only has the chunks since the previous checkpoint
+    with np.load(ckpt+'_0.npz') as f:
+        assert 'pol00' not in f.files
+    for start in (0,5,10,15):
+        with np.load(ckpt+f'_0_rows_{start}.npz') as f:
+            assert f['pol00'].shape[0]==min(5,nchunks-start)
+    for a,b in zip(res[:3],ref[:3]):
+        assert np.all(a.mask==b.mask)
+        assert np.allclose(a.filled(0),b.filled(0))
+
+def test_xcorr_resume(tmp_path, monkeypatch):
+    paths=[]
+    for k in range(2):
+        paths.append(str(tmp_path/f"snap{k}"))
+        make_station(paths[-1], t0, nfiles=3, npackets=60, spec0=1000+500*k, seed=k)
+    acclen,nchunks=37,16
+    ref=xcorravg.get_avg_fast(paths[0],paths[1],t0,t0+10,5,acclen,nchunks)
+    ckpt=str(tmp_path/'ckpt')
+    with monkeypatch.context() as m:
+        crash_after(m, cr, 'avg_xcorr_4bit_2ant', 7)
+        with pytest.raises(KeyboardInterrupt):
+            xcorravg.get_avg_fast(paths[0],paths[1],t0,t0+10,5,acclen,nchunks,checkpoint=ckpt,ckpt_every=3)
+    with monkeypatch.context() as m:
+        count=crash_after(m, cr, 'avg_xcorr_4bit_2ant', 1000)
+        res=xcorravg.get_avg_fast(paths[0],paths[1],t0,t0+10,5,acclen,nchunks,checkpoint=ckpt,ckpt_every=3)
+    assert count[0]==nchunks-6
+    assert np.all(res[0].mask==ref[0].mask)
+    assert np.allclose(res[0].filled(0),ref[0].filled(0))
+
+def test_checkpoint_mismatch(tmp_path):
+    data_dir=str(tmp_path/'snap1')
+    make_station(data_dir, t0, nfiles=2, npackets=60)
+    ckpt=str(tmp_path/'ckpt')
+    autocorravg.get_avg_fast(data_dir,t0,t0+10,37,5,checkpoint=ckpt)
+    with pytest.raises(ValueError):
+        autocorravg.get_avg_fast(data_dir,t0,t0+10,41,5,checkpoint=ckpt)
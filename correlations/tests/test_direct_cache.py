@@ -0,0 +1,46 @@
+import os
+import numpy as np
+from correlations.tests.stubs import stub_module
+stub_module('scio.scio')
+from utils import direct_cache
+
+def make_dir(path, nrow=7, nchan=5, seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(path)
+    dat = {p:rng.normal(size=(nrow, nchan)) for p in direct_cache.SOURCES}
+    for p, arr in dat.items():
+        # the stubbed reader below reads npy, the name is what matters
+        with open(os.path.join(path, p+'.scio.bz2'), 'wb') as f:
+            np.save(f, arr)
+    return dat
+
+def test_get_direct(tmp_path, monkeypatch):
+    reads = []
+    def fake_read(fname):
+        reads.append(os.path.basename(fname).split('.')[0])
+        return np.load(fname)
+    monkeypatch.setattr(direct_cache.scio, 'read', fake_read, raising=False)
+    d = str(tmp_path/'1700000000')
+    ref = make_dir(d)
+    cache = str(tmp_path/'cache')
+    # only the requested product is decompressed
+    dat = direct_cache.get_direct(d, cache_dir=cache, products=['pol00'])
+    assert reads == ['pol00']
+    assert np.array_equal(dat['pol00'], ref['pol00']) and dat['pol01'] is None
+    # the rest is added to the entry, pol00 comes from the cache
+    dat = direct_cache.get_direct(d, cache_dir=cache)
+    assert sorted(reads) == sorted(direct_cache.SOURCES)
+    assert np.array_equal(dat['pol00'], ref['pol00'])
+    assert np.array_equal(dat['pol11'], ref['pol11'])
+    assert np.array_equal(dat['pol01r'], ref['pol01r'])
+    assert np.array_equal(dat['pol01i'], ref['pol01i'])
+    # all cached now
+    del reads[:]
+    dat = direct_cache.get_direct(d, cache_dir=cache, products=['pol01r'])
+    assert reads == []
+    assert isinstance(dat['pol01'], np.memmap)
+    # a changed source file rebuilds the entry
+    st = os.stat(os.path.join(d, 'pol11.scio.bz2'))
+    os.utime(os.path.join(d, 'pol11.scio.bz2'), (st.st_atime, st.st_mtime+10))
+    dat = direct_cache.get_direct(d, cache_dir=cache, products=['pol00'])
+    assert reads == ['pol00']
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import pytest
+import numpy as np
+from correlations.tests.stubs import stub_module, FakeDirect
+stub_module('scio.scio')
+from utils import direct_pyramid as dp
+from utils import direct_cache
+
+real_evict = direct_cache.evict
+
+# ten files of 350 rows every 400 s, across a 5-digit boundary
+t0 = 1700099000
+chunk_time = 1.
+nrow, nchan = 350, 4
+
+rng = np.random.default_rng(0)
+
+def add(fake, tstamp, bad_first_row=False):
+    arrs = {p:rng.lognormal(10, 1, (nrow, nchan)) for p in dp.PRODUCTS}
+    if(bad_first_row):
+        for p in dp.PRODUCTS:
+            arrs[p][0] *= 1e4
+    return fake.add(tstamp, arrs)
+
+def brute(fake, ctime_start, ctime_stop, blocklen):
+    # every row with its time, first rows dropped the same way, averaged straight on the global grid
+    width = blocklen*chunk_time
+    b0, b1 = int(np.floor(ctime_start/width)), int(np.floor(ctime_stop/width))+1
+    res = {}
+    for p in dp.PRODUCTS:
+        t, rows = [], []
+        for d, arrs in fake.dat.items():
+            arr, skip = dp.drop_bad_first_row(arrs[p])
+            t.append(int(os.path.basename(d)) + (skip+np.arange(len(arr)))*chunk_time)
+            rows.append(arr)
+        t, rows = np.concatenate(t), np.concatenate(rows)
+        b = np.floor(t/width).astype(int)
+        mean = np.full((b1-b0, nchan), np.nan)
+        mn, mx = mean.copy(), mean.copy()
+        count = np.zeros(b1-b0, dtype=int)
+        for k in range(b1-b0):
+            sel = b==b0+k
+            count[k] = sel.sum()
+            if(count[k]>0):
+                mean[k], mn[k], mx[k] = rows[sel].mean(axis=0), rows[sel].min(axis=0), rows[sel].max(axis=0)
+        res[p] = {'mean':mean, 'min':mn, 'max':mx}
+    return np.arange(b0, b1), res, count
+
+@pytest.fixture
+def fake(tmp_path, monkeypatch):
+    monkeypatch.setattr(dp, 'PYRAMID_DIR', str(tmp_path/'pyramid'))
+    fake = FakeDirect(tmp_path/'data').install(monkeypatch)
+    for k in range(10):
+        add(fake, t0 + 400*k, bad_first_row=(k==3))
+    return fake
+
+def assert_matches(data, ctime_start, ctime_stop, blocklen, **kwargs):
+    bins, res, count = dp.get_binned(data.data_dir, ctime_start, ctime_stop, chunk_time, blocklen, **kwargs)
+    rbins, rres, rcount = brute(data, ctime_start, ctime_stop, blocklen)
+    assert np.array_equal(bins, rbins)
+    assert np.array_equal(count, rcount)
+    assert np.any(count>0)
+    for p in dp.PRODUCTS:
+        assert np.allclose(res[p]['mean'], rres[p]['mean'], equal_nan=True)
+        # min and max are stored as float32
+        assert np.allclose(res[p]['min'], rres[p]['min'], rtol=1e-6, equal_nan=True)
+        assert np.allclose(res[p]['max'], rres[p]['max'], rtol=1e-6, equal_nan=True)
+
+@pytest.mark.parametrize("blocklen", [100, 1000, 300])
+def test_get_binned(fake, blocklen):
+    assert dp.get_level(blocklen) == {100:100, 1000:1000, 300:100}[blocklen]
+    assert_matches(fake, t0+1500, t0+400*10, blocklen)
+    # the pyramids are built now, nothing is read again
+    del fake.reads[:]
+    assert_matches(fake, t0, t0+400*10, blocklen)
+    assert fake.reads == []
+
+def get_meta(dir5):
+    with open(os.path.join(dp.get_pyramid_path(dir5), 'meta.json')) as f:
+        return json.load(f)
+
+def test_update_pyramid(fake, monkeypatch):
+    dir5 = os.path.join(fake.data_dir, str((t0+4000)//100000))
+    assert dp.update_pyramid(dir5, chunk_time) == 7
+    version = get_meta(dir5)['version']
+    # a new directory is the only one read, and goes into a new version
+    del fake.reads[:]
+    new = add(fake, t0+4000)
+    assert dp.update_pyramid(dir5, chunk_time) == 1
+    assert fake.reads == [new]
+    assert get_meta(dir5)['version'] == version+1
+    assert sorted(os.listdir(dp.get_pyramid_path(dir5))) == ['meta.json', f"v{version+1}"]
+    assert dp.update_pyramid(dir5, chunk_time) == 0
+    assert_matches(fake, t0, t0+4400, 100)
+    # a changed directory rebuilds the whole pyramid with its new data
+    d = sorted(dd for dd in fake.dat if dd.startswith(dir5))[2]
+    fake.dat[d] = {p:2*a for p, a in fake.dat[d].items()}
+    fname = os.path.join(d, 'pol00.scio.bz2')
+    os.utime(fname, (os.stat(fname).st_atime, os.stat(fname).st_mtime+10))
+    del fake.reads[:]
+    assert dp.update_pyramid(dir5, chunk_time) == 8
+    assert sorted(fake.reads) == sorted(dd for dd in fake.dat if dd.startswith(dir5))
+    assert_matches(fake, t0, t0+4400, 1000)
+    # an update that dies while writing leaves the old version in place, and the retry counts the new rows once
+    version = get_meta(dir5)['version']
+    add(fake, t0+4400)
+    save = np.save
+    calls = [0]
+    def failing_save(*args, **kwargs):
+        calls[0] += 1
+        if(calls[0]>5):
+            raise KeyboardInterrupt
+        save(*args, **kwargs)
+    with monkeypatch.context() as m:
+        m.setattr(np, 'save', failing_save)
+        with pytest.raises(KeyboardInterrupt):
+            dp.update_pyramid(dir5, chunk_time)
+    assert get_meta(dir5)['version'] == version
+    meta, pyr = dp.load_pyramid(dir5, chunk_time)
+    assert str(t0+4400) not in meta['dirs']
+    assert dp.update_pyramid(dir5, chunk_time) == 1
+    assert_matches(fake, t0, t0+4800, 100)
+
+def test_live_directory(fake):
+    # without updates everything comes from the raw data
+    assert_matches(fake, t0, t0+4000, 1000, update=False)
+    assert not os.path.exists(dp.PYRAMID_DIR)
+    # the newest directory is still being written: it isn't ingested but read from the raw data
+    settle = time.time() - (t0+3500)
+    live = sorted(fake.dat)[-1]
+    dir5 = os.path.dirname(live)
+    assert_matches(fake, t0, t0+4000, 100, settle=settle)
+    assert str(t0+3600) not in get_meta(dir5)['dirs']
+    version = get_meta(dir5)['version']
+    # it grows, and the next plot only reads it again, without touching the pyramids
+    fake.dat[live] = {p:np.concatenate([a, rng.lognormal(10, 1, (200, nchan))]) for p, a in fake.dat[live].items()}
+    fname = os.path.join(live, 'pol00.scio.bz2')
+    os.utime(fname, (os.stat(fname).st_atime, os.stat(fname).st_mtime+10))
+    del fake.reads[:]
+    assert_matches(fake, t0, t0+4400, 100, settle=settle)
+    assert fake.reads == [live]
+    assert get_meta(dir5)['version'] == version
+    # once it has settled it's ingested on its own
+    del fake.reads[:]
+    assert dp.update_pyramid(dir5, chunk_time) == 1
+    assert fake.reads == [live]
+    del fake.reads[:]
+    assert_matches(fake, t0, t0+4400, 1000)
+    assert fake.reads == []
+
+def test_budget(fake, monkeypatch):
+    dir5s = sorted({os.path.dirname(d) for d in fake.dat})
+    dp.update_pyramid(dir5s[0], chunk_time)
+    assert os.path.exists(dp.get_pyramid_path(dir5s[0]))
+    # past the budget the least recently used pyramid goes, never the one just written
+    monkeypatch.setattr(direct_cache, 'evict', real_evict)
+    monkeypatch.setattr(dp, 'PYRAMID_BUDGET_GB', 1e-9)
+    dp.update_pyramid(dir5s[1], chunk_time)
+    assert not os.path.exists(dp.get_pyramid_path(dir5s[0]))
+    assert os.path.exists(dp.get_pyramid_path(dir5s[1]))
+    # and it's rebuilt when it's needed again
+    monkeypatch.setattr(dp, 'PYRAMID_BUDGET_GB', 20)
+    assert_matches(fake, t0, t0+4000, 100)
+
+def test_default_dir(monkeypatch):
+    monkeypatch.delenv('ALBATROS_PYRAMID_DIR', raising=False)
+    monkeypatch.setenv('SCRATCH', '/scratch/me')
+    assert direct_cache.default_cache_dir('ALBATROS_PYRAMID_DIR', 'albatros_pyramid') == '/scratch/me/albatros_pyramid'
+    monkeypatch.setenv('ALBATROS_PYRAMID_DIR', '/data/pyr')
+    assert direct_cache.default_cache_dir('ALBATROS_PYRAMID_DIR', 'albatros_pyramid') == '/data/pyr'
+    monkeypatch.delenv('SCRATCH')
+    monkeypatch.delenv('ALBATROS_PYRAMID_DIR')
+    assert not direct_cache.default_cache_dir('ALBATROS_PYRAMID_DIR', 'albatros_pyramid').startswith(os.path.expanduser('~'))
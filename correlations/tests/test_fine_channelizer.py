@@ -0,0 +1,55 @@
+import pytest
+import numpy as np
+import fine_spectra
+from correlations import unpacking as unpk
+from correlations.fine_channelizer import FineChannelizer
+from correlations.tests.synth_baseband import make_station
+from correlations.tests.test_binned_corr import unpack_sorted_4bit
+
+t0 = 1700000000
+
+def test_lut_unpack():
+    rng = np.random.default_rng(0)
+    pol = rng.integers(0,256,(30,7)).astype('uint8')
+    specnums = np.delete(np.arange(98,98+35), np.r_[5:10])
+    x, present = unpk.unpack_sorted_4bit(pol, specnums[:25], 100, 28)
+    assert x.shape == (28,7)
+    rows = specnums[:25]-100
+    keep = (rows>=0)&(rows<28)
+    assert np.all(x[rows[keep]] == unpack_sorted_4bit(pol[:25][keep]))
+    assert np.all(present == np.isin(np.arange(28), rows[keep]))
+    assert np.all(x[~present] == 0)
+
+def test_tone_and_block_edges():
+    rng = np.random.default_rng(1)
+    nfft, ncol, n = 32, 4, 2000
+    t = np.arange(n)
+    x0 = (rng.normal(size=(n,ncol)) + 1J*rng.normal(size=(n,ncol))).astype('complex64')*0.1
+    x0[:,2] += np.exp(2J*np.pi*5/nfft*t)
+    x1 = x0*np.exp(0.7J)
+    present = np.ones(n, dtype=bool)
+    present[700:710] = False
+    fc1 = FineChannelizer(ncol, nfft)
+    fc1.push(x0, x1, present)
+    fc2 = FineChannelizer(ncol, nfft, batch=3)
+    edges = np.r_[0, np.sort(rng.choice(np.arange(1,n), 12, replace=False)), n]
+    for a, b in zip(edges[:-1], edges[1:]):
+        fc2.push(x0[a:b], x1[a:b], present[a:b])
+    assert fc1.nseg == fc2.nseg and fc1.nskipped == fc2.nskipped > 0
+    for s1, s2 in zip(fc1.get_spectra(), fc2.get_spectra()):
+        assert np.allclose(s1, s2, rtol=1e-4)
+    auto00, auto11, cross01 = fc1.get_spectra()
+    assert np.argmax(auto00) == 2*nfft + nfft//2 + 5
+    assert np.isclose(np.angle(cross01[np.argmax(auto00)]), -0.7, atol=1e-3)
+    freqs = fc1.get_freqs(np.array([10,11,12,13]))
+    assert np.isclose(freqs[np.argmax(auto00)], (12+5/nfft)*125/2048)
+    assert np.all(np.diff(freqs) > 0)
+
+def test_driver_chunking(tmp_path):
+    data_dir = str(tmp_path/'snap1')
+    make_station(data_dir, t0, nfiles=3, npackets=60)
+    r1 = fine_spectra.get_fine_spectra(data_dir, t0, t0+10, 8, 37, 18)
+    r2 = fine_spectra.get_fine_spectra(data_dir, t0, t0+10, 8, 111, 6)
+    assert r1[4] == r2[4] > 0
+    for a, b in zip(r1[:4], r2[:4]):
+        assert np.allclose(a, b)
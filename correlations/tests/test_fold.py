@@ -0,0 +1,56 @@
+import pytest
+import numpy as np
+import fold_baseband
+from correlations import correlations as cr
+from correlations.tests.synth_baseband import make_station
+from correlations.tests.test_binned_corr import unpack_sorted_4bit
+
+t0 = 1700000000
+dt = 4096/250e6
+
+def fold_ref(pol0, pol1, specnums, spec_ref, period, pdot, nbin):
+    power = np.abs(unpack_sorted_4bit(pol0[:len(specnums)]))**2 + np.abs(unpack_sorted_4bit(pol1[:len(specnums)]))**2
+    t = (specnums-spec_ref)*dt
+    ph = (1/period)*t + 0.5*(-pdot/period**2)*t*t
+    b = np.floor((ph-np.floor(ph))*nbin).astype(int)
+    profile = np.zeros((nbin,pol0.shape[1]))
+    np.add.at(profile, b, power)
+    return profile, np.bincount(b, minlength=nbin)
+
+def test_fold_trials():
+    rng = np.random.default_rng(2)
+    nrows, ncol, nbin = 2000, 5, 16
+    specnums = np.sort(rng.choice(np.arange(100, 100+2500), nrows, replace=False)).astype('int64')
+    pol0 = rng.integers(0,256,(nrows,ncol)).astype('uint8')
+    pol1 = rng.integers(0,256,(nrows,ncol)).astype('uint8')
+    periods = [37.13*dt, 101.57*dt, 250.31*dt]
+    pdots = [0., 1e-3, -2e-3]
+    # fold in two pieces to check accumulation
+    profile, counts = cr.fold_autocorr_4bit(pol0[:700], pol1[:700], specnums[:700], 100, periods, pdots, nbin)
+    profile, counts = cr.fold_autocorr_4bit(pol0[700:], pol1[700:], specnums[700:], 100, periods, pdots, nbin, profile, counts)
+    for k in range(3):
+        p, c = fold_ref(pol0, pol1, specnums, 100, periods[k], pdots[k], nbin)
+        assert np.all(counts[k]==c)
+        assert np.allclose(profile[k], p)
+
+def test_fold_finds_pulse():
+    # one channel lights up for 2 of every 40 spectra
+    nrows, ncol, nbin = 4000, 3, 20
+    specnums = np.arange(nrows, dtype='int64')
+    pol0 = np.full((nrows,ncol), 0x11, dtype='uint8')
+    pol0[(specnums%40)<2, 1] = 0x77
+    profile, counts = cr.fold_autocorr_4bit(pol0, pol0, specnums, 0, [40*dt, 41*dt], 0., nbin)
+    avg = profile/counts[...,None]
+    assert np.argmax(avg[0,:,1])==0
+    assert avg[0,0,1] > 10*avg[0,5,1]
+    assert avg[1,:,1].max() < avg[0,0,1]/2
+
+def test_fold_driver(tmp_path):
+    data_dir = str(tmp_path/'snap1')
+    make_station(data_dir, t0, nfiles=2, npackets=60)
+    periods = [13*dt, 27.3*dt]
+    profile, counts, chans = fold_baseband.fold_fast(data_dir, t0, t0+10, periods, [0., 1e-2], 8, 50, 8)
+    assert profile.shape == (2, 8, 8)
+    assert len(chans) == 8
+    # every spectrum read is folded once per trial
+    assert counts[0].sum() == counts[1].sum() > 0
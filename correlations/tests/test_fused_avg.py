@@ -0,0 +1,59 @@
+import os
+import types
+import datetime
+import pytest
+import numpy as np
+from correlations.tests.stubs import stub_module, FakeDirect
+stub_module('scio.scio')
+stub_module('pytz')
+import SNAPfiletools as sft
+import plot_overnight_new as pon
+
+t0 = 1700000000
+chunk_time = 6.44
+
+@pytest.fixture
+def fake_dirs(tmp_path, monkeypatch):
+    # a bad first row, leftover partial blocks, a gap, a file too short to average and a missing product
+    rng = np.random.default_rng(0)
+    nrows = [95, 203, 7, 120]
+    starts = [0, 95, 400, 420]
+    fake = FakeDirect(tmp_path).install(monkeypatch)
+    for k, (n, st) in enumerate(zip(nrows, starts)):
+        arrs = {p:rng.lognormal(10, 1, (n, 6)) for p in sft.DIRECT_PRODUCTS}
+        if(k==1):
+            for p in sft.DIRECT_PRODUCTS:
+                arrs[p][0] *= 1e4
+        if(k==3):
+            arrs['pol11'] = None
+        fake.add(int(t0+st*chunk_time), arrs)
+    monkeypatch.setattr(pon, 'get_localtime_from_UTC', lambda tstamp, mytz: datetime.datetime.fromtimestamp(int(tstamp)))
+    return fake.data_dir, fake.dat
+
+@pytest.mark.parametrize("blocklen", [1, 10, 32])
+def test_fused_matches_read_then_avg(fake_dirs, blocklen):
+    data_dir, dat = fake_dirs
+    dirs = sorted(dat)
+    # the old way: read everything, then average every file
+    raw = sft.read_direct_parallel(dirs)
+    ref = {p:[pon.get_avg(a, blocklen) if blocklen>1 else a for a in raw[p]] for p in sft.DIRECT_PRODUCTS}
+    fused = sft.read_direct_parallel(dirs, reduce=lambda a: pon.get_avg(a, blocklen) if blocklen>1 else a)
+    for p in sft.DIRECT_PRODUCTS:
+        for a, b in zip(ref[p], fused[p]):
+            assert (a is None and b is None) or np.array_equal(a, b)
+    if(blocklen==10):
+        # leftover partial block and the bad first row left out of the first block
+        assert ref['pol00'][0].shape[0] == 10 and np.allclose(ref['pol00'][0][-1], raw['pol00'][0][90:].mean(axis=0))
+        assert np.allclose(ref['pol00'][1][0], raw['pol00'][1][1:10].mean(axis=0))
+    # and the same through get_data_arrs, laid out on one time axis
+    out = pon.get_data_arrs(data_dir, t0, t0+3600, chunk_time, blocklen, types.SimpleNamespace(zone='UTC'))
+    tstamps = [int(os.path.basename(d)) for d in dirs]
+    nrows = [0 if a is None else a.shape[0] for a in ref['pol00']]
+    starts, total, tstart, tend = sft.get_gap_layout(tstamps, nrows, chunk_time*blocklen)
+    assert out[4] == tstart and out[5] == tend
+    for p, arr in zip(sft.DIRECT_PRODUCTS, out[:4]):
+        expect = np.ma.masked_invalid(sft.assemble_blocks(ref[p], starts, nrows, total, 6))
+        assert arr.shape == (total, 6)
+        assert np.array_equal(arr.mask, expect.mask)
+        assert np.array_equal(arr.filled(0), expect.filled(0))
+    assert np.all(out[1].mask[starts[3]:])
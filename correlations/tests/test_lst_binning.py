@@ -0,0 +1,151 @@
+import os
+import json
+import types
+import pytest
+import numpy as np
+from correlations.tests.stubs import stub_module, FakeDirect
+stub_module('scio.scio')
+stub_module('pytz')
+stub_module('skyfield.api')
+import lst_binning
+
+t0 = 1700000000
+nbins, nchan, nrow, chunk_time = 12, 16, 30, 60.
+
+@pytest.fixture
+def fake_data(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    level = 10**np.linspace(6, 8, nchan)
+    fake = FakeDirect(tmp_path/'data').install(monkeypatch)
+    dirs = []
+    for k in range(6):
+        auto = level*rng.lognormal(0, 0.2, (nrow, nchan))
+        cross = level*(0.1 + rng.normal(size=(nrow, nchan)))
+        dirs.append(fake.add(t0+k*nrow*int(chunk_time), {'pol00':auto, 'pol11':2*auto, 'pol01r':cross, 'pol01i':-cross}))
+    # LST bin from the time of day instead of skyfield
+    monkeypatch.setattr(lst_binning, 'sf', types.SimpleNamespace(load=types.SimpleNamespace(timescale=lambda: None),
+        wgs84=types.SimpleNamespace(latlon=lambda *coords: None)))
+    monkeypatch.setattr(lst_binning, 'get_lst_bins', lambda tstamp, n, earth_loc, ts, nb, ct:
+        ((tstamp + np.arange(n)*ct)%86400*nb/86400).astype(int))
+    return fake.data_dir, dirs, fake.reads
+
+def binned(data_dir, stop, acc=None):
+    return lst_binning.get_binned_all(data_dir, [0,0,0], t0, stop, nbins, nchan=nchan, nthreads=3, chunk_time=chunk_time, acc=acc)
+
+def assert_same(a, b):
+    assert a.dirs == b.dirs
+    for p in lst_binning.LST_PRODUCTS:
+        assert np.array_equal(a.sums[p], b.sums[p])
+        assert np.array_equal(a.counts[p], b.counts[p])
+    assert a.sketch_products == b.sketch_products
+    for p in a.sketch_products:
+        da, db = a.get_sketch(p, a.bins).to_dict(), b.get_sketch(p, b.bins).to_dict()
+        for k in da:
+            # sums come out in a different order when the data went in as several parts
+            same = np.allclose if k=='sum' else np.array_equal
+            assert same(da[k], db[k], equal_nan=True)
+
+def test_save_load_merge(fake_data, tmp_path):
+    data_dir, dirs, reads = fake_data
+    full = binned(data_dir, t0+10**6)
+    part = binned(data_dir, int(dirs[2].split('/')[-1]))
+    fname = str(tmp_path/'acc.npz')
+    part.save(fname, chunk_time=chunk_time)
+    acc, meta = lst_binning.LSTAccumulator.load(fname, nbins=nbins, chunk_time=chunk_time, alpha=part.alpha)
+    assert meta['max_bins'] == part.max_bins
+    assert_same(acc, part)
+    acc = binned(data_dir, t0+10**6, acc)
+    # same as binning everything in one go, the counts down to the bit
+    assert_same(acc, full)
+    for p in lst_binning.LST_PRODUCTS:
+        r1, r2 = acc.reduce(p), full.reduce(p)
+        assert np.array_equal(r1['median'], r2['median'], equal_nan=True)
+    # only the autos get medians by default
+    assert np.all(np.isnan(acc.reduce('pol01r')['median']))
+    r = acc.reduce('pol00')
+    assert np.all(r['median'][r['counts']>0] > 0)
+
+def test_parts(fake_data, tmp_path):
+    data_dir, dirs, reads = fake_data
+    stops = [int(d.split('/')[-1]) for d in dirs[1::2]]
+    full = binned(data_dir, t0+10**6)
+    fname = str(tmp_path/'acc.npz')
+    acc = None
+    for k, stop in enumerate(stops):
+        if(acc is not None):
+            acc, meta = lst_binning.LSTAccumulator.load(fname)
+            assert len(acc.parts) == k
+        acc = binned(data_dir, stop, acc)
+        acc.save(fname, chunk_time=chunk_time)
+        parts = sorted(os.listdir(fname + '.parts'))
+        if(k==0):
+            first = {f:os.path.getmtime(os.path.join(fname + '.parts', parts[0], f)) for f in os.listdir(os.path.join(fname + '.parts', parts[0]))}
+    # every update added a part and left the earlier ones alone
+    assert len(parts) == len(stops)
+    assert {f:os.path.getmtime(os.path.join(fname + '.parts', parts[0], f)) for f in first} == first
+    acc, meta = lst_binning.LSTAccumulator.load(fname)
+    assert_same(acc, full)
+    # compacting merges them into one with the same content
+    acc.save(fname, compact=True, chunk_time=chunk_time)
+    assert len(os.listdir(fname + '.parts')) == 1
+    acc, meta = lst_binning.LSTAccumulator.load(fname)
+    assert_same(acc, full)
+    # with sketches of the crosses too
+    full = binned(data_dir, t0+10**6, lst_binning.LSTAccumulator(nbins, nchan, sketch_products=lst_binning.LST_PRODUCTS))
+    assert np.all(np.isfinite(full.reduce('pol01i')['median']))
+    full.save(fname, chunk_time=chunk_time)
+    acc, meta = lst_binning.LSTAccumulator.load(fname)
+    assert_same(acc, full)
+
+def test_skip_ingested(fake_data, tmp_path):
+    data_dir, dirs, reads = fake_data
+    acc = binned(data_dir, int(dirs[3].split('/')[-1]))
+    assert sorted(reads) == sorted(dirs[:4])
+    fname = str(tmp_path/'acc.npz')
+    acc.save(fname, chunk_time=chunk_time)
+    acc, meta = lst_binning.LSTAccumulator.load(fname)
+    del reads[:]
+    acc = binned(data_dir, t0+10**6, acc)
+    # only the two new directories are read
+    assert sorted(reads) == sorted(dirs[4:])
+    assert acc.dirs == dirs
+    del reads[:]
+    binned(data_dir, t0+10**6, acc)
+    assert reads == []
+
+def test_load_mismatch(fake_data, tmp_path):
+    data_dir, dirs, reads = fake_data
+    acc = binned(data_dir, t0+10**6)
+    fname = str(tmp_path/'acc.npz')
+    acc.save(fname, chunk_time=chunk_time)
+    with pytest.raises(ValueError):
+        lst_binning.LSTAccumulator.load(fname, chunk_time=6.44)
+    with pytest.raises(ValueError):
+        lst_binning.LSTAccumulator.load(fname, alpha=0.01)
+    with pytest.raises(ValueError):
+        lst_binning.LSTAccumulator.load(fname, nbins=720)
+    # partials with other sketch settings can't go in
+    other = lst_binning.LSTAccumulator(nbins, nchan, alpha=0.01)
+    with pytest.raises(ValueError):
+        acc.merge(other)
+
+def test_load_dense(fake_data, tmp_path):
+    # accumulators from before the parts kept a dense sketch of every product in the .npz
+    data_dir, dirs, reads = fake_data
+    full = binned(data_dir, t0+10**6, lst_binning.LSTAccumulator(nbins, nchan, sketch_products=lst_binning.LST_PRODUCTS))
+    arrs = {'bins':full.bins, 'products':np.array(full.products), 'dirs':np.array(full.dirs),
+        'meta':json.dumps({'nbins':nbins, 'nchan':nchan, 'sketch':True, 'alpha':full.alpha, 'max_bins':full.max_bins})}
+    for p in full.products:
+        arrs[f'{p}_sums'], arrs[f'{p}_counts'] = full.sums[p], full.counts[p]
+        sk = full.get_sketch(p, full.bins)
+        for k in ('alpha','max_bins','kmin','kmax','collapsed','pos','neg','zero','count','sum','min','max'):
+            arrs[f'{p}_sketch_{k}'] = getattr(sk, k)
+    fname = str(tmp_path/'acc.npz')
+    np.savez(fname, **arrs)
+    acc, meta = lst_binning.LSTAccumulator.load(fname)
+    assert_same(acc, full)
+    # and the next save moves them into a part
+    acc.save(fname)
+    acc, meta = lst_binning.LSTAccumulator.load(fname)
+    assert len(acc.parts) == 1
+    assert_same(acc, full)
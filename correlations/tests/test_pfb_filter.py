@@ -0,0 +1,71 @@
+import pytest
+import numpy as np
+from legacy import pfb_helper
+
+def filter_mat_svd(nchan, ntap, nblock, frac=0.85):
+    mat = pfb_helper.make_large_pfb_mat(nchan, ntap, nblock)
+    u, s, v = np.linalg.svd(mat)
+    s_filt = np.minimum(s/s[int(frac*len(s))], 1)**2
+    return np.conj(u)@(np.diag(s_filt)@(u.T))
+
+def apply_patches_loop(mypfb, patches):
+    # one 2D FFT convolution per channel, keeping that channel's column
+    out = 0*mypfb
+    nchan = mypfb.shape[1]
+    nblock = patches[0].shape[0]
+    for i in range(nchan):
+        tmp = 0*mypfb
+        patch = np.roll(patches[i], -i, 1)
+        tmp[:nblock//2,:] = patch[nblock//2:,:]
+        tmp[-nblock//2:,:] = patch[:nblock//2,:]
+        out[:,i] = np.fft.ifft2(np.fft.fft2(tmp)*np.fft.fft2(mypfb))[:,i]
+    return out
+
+def test_filter_mat_gram(tmp_path, monkeypatch):
+    monkeypatch.setattr(pfb_helper, 'PFB_CACHE_DIR', str(tmp_path))
+    ref = filter_mat_svd(9, 4, 8)
+    filt = pfb_helper.get_pfb_filter_mat(9, 4, 8)
+    assert np.allclose(filt, ref)
+    assert len(list(tmp_path.iterdir())) == 1
+    # second call comes from the cache
+    monkeypatch.setattr(pfb_helper, 'get_pfb_gram_blocks', None)
+    assert np.array_equal(pfb_helper.get_pfb_filter_mat(9, 4, 8), filt)
+    patches = pfb_helper.get_pfb_patches(9, 4, 8)
+    for p1, p2 in zip(patches, pfb_helper.make_conv_patches(9, 8, ref)):
+        assert np.allclose(p1, p2)
+
+def test_circulant_patches(tmp_path, monkeypatch):
+    monkeypatch.setattr(pfb_helper, 'PFB_CACHE_DIR', str(tmp_path))
+    exact = pfb_helper.get_pfb_patches(17, 4, 16, method='gram')
+    circ = pfb_helper.get_pfb_patches(17, 4, 16, method='circulant')
+    assert len(circ) == 17 and circ[0].shape == (16, 17)
+    peak = max(np.abs(p).max() for p in exact)
+    assert max(np.abs(p1-p2).max() for p1, p2 in zip(exact, circ)) < 0.02*peak
+    with pytest.raises(ValueError):
+        pfb_helper.get_pfb_patches(17, 4, 16, method='dense')
+
+def test_apply_patches(tmp_path, monkeypatch):
+    monkeypatch.setattr(pfb_helper, 'PFB_CACHE_DIR', str(tmp_path))
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(50,17)) + 1J*rng.normal(size=(50,17))
+    patches = pfb_helper.get_pfb_patches(17, 4, 16)
+    ref = apply_patches_loop(x, patches)
+    assert np.allclose(pfb_helper.filter_pfb_patches(x, ntap=4, nblock=16), ref)
+    stat = pfb_helper.apply_pfb_filter_patches(x, patches, stationary=True)
+    assert np.allclose(stat[:,8], ref[:,8])
+
+def test_auto_method_and_window_key(tmp_path, monkeypatch):
+    monkeypatch.setattr(pfb_helper, 'PFB_CACHE_DIR', str(tmp_path))
+    # past the size limit the dense Gram matrix is never built
+    monkeypatch.setattr(pfb_helper, 'GRAM_MAX_SIZE', 100)
+    monkeypatch.setattr(pfb_helper, 'get_pfb_filter_mat', None)
+    auto = pfb_helper.get_pfb_patches(17, 4, 16)
+    circ = pfb_helper.get_pfb_patches(17, 4, 16, method='circulant', cache=False)
+    assert all(np.allclose(p1, p2) for p1, p2 in zip(auto, circ))
+    # windows with the same name but different coefficients get their own cache entries
+    w1 = lambda ntap, lblock: pfb_helper.sinc_hamming(ntap, lblock)
+    w2 = lambda ntap, lblock: pfb_helper.sinc_hanning(ntap, lblock)
+    p1 = pfb_helper.get_pfb_patches(17, 4, 16, window=w1)
+    p2 = pfb_helper.get_pfb_patches(17, 4, 16, window=w2)
+    assert not np.allclose(p1[0], p2[0])
+    assert np.allclose(p1[0], auto[0])
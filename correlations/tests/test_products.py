@@ -0,0 +1,81 @@
+import pytest
+import numpy as np
+import autocorravg
+import xcorravg
+from correlations import correlations as cr
+from correlations import products
+from correlations.tests.synth_baseband import make_station
+from correlations.tests.test_checkpoint import crash_after
+
+t0 = 1700000000
+
+def test_write_read(tmp_path):
+    path=str(tmp_path/'prod')
+    rng=np.random.default_rng(0)
+    a=rng.normal(size=(20,13))
+    b=(rng.normal(size=(20,13))+1J*rng.normal(size=(20,13))).astype('complex64')
+    a[3,5]=np.nan
+    b=np.ma.masked_array(b,mask=rng.uniform(size=b.shape)<0.2)
+    meta={'acclen':100,'channels':np.arange(13)+64}
+    writer=products.ProductWriter(path,{'a':'float64','b':'complex64'},13,meta,flush_every=5)
+    reader=products.ProductReader(path)
+    assert len(reader)==0
+    for i in range(12):
+        writer.append(a=a[i],b=b[i])
+    #reader sees the flushed rows only, while the job is still running
+    reader.refresh()
+    assert len(reader)==10
+    assert np.allclose(reader.data('a'),a[:10],equal_nan=True)
+    writer.append(a=a[12:],b=b[12:])
+    writer.close()
+    reader.refresh()
+    assert reader.meta['acclen']==100
+    assert reader.meta['channels']==list(range(64,77))
+    ra=reader['a']
+    assert ra.mask[3,5] and ra.mask.sum()==1
+    rb=reader.get('b',4,17)
+    assert np.all(rb.mask==b.mask[4:17])
+    assert np.allclose(rb.data,b.data[4:17])
+
+def test_append_truncate(tmp_path):
+    path=str(tmp_path/'prod')
+    x=np.arange(30,dtype='float64').reshape(10,3)
+    with products.ProductWriter(path,{'x':'float64'},3) as writer:
+        writer.append(x=x[:6])
+    with products.ProductWriter(path,{'x':'float64'},3,append=True) as writer:
+        assert writer.nrows==6
+        writer.truncate(4)
+        writer.append(x=x[4:])
+    assert np.all(products.ProductReader(path)['x']==x)
+    with pytest.raises(ValueError):
+        products.ProductWriter(path,{'x':'float32'},3,append=True)
+
+def test_autocorr_stream(tmp_path, monkeypatch):
+    data_dir=str(tmp_path/'snap1')
+    make_station(data_dir, t0, nfiles=3, npackets=60)
+    acclen,nchunks=37,18
+    ref=autocorravg.get_avg_fast(data_dir,t0,t0+10,acclen,nchunks)
+    stream=str(tmp_path/'prod')
+    ckpt=str(tmp_path/'ckpt')
+    with monkeypatch.context() as m:
+        crash_after(m, cr, 'avg_autocorr_4bit', 2*12)
+        with pytest.raises(KeyboardInterrupt):
+            autocorravg.get_avg_fast(data_dir,t0,t0+10,acclen,nchunks,checkpoint=ckpt,ckpt_every=5,stream=stream)
+    #12 rows were written but only 10 are covered by the checkpoint
+    assert len(products.ProductReader(stream))>=10
+    res=autocorravg.get_avg_fast(data_dir,t0,t0+10,acclen,nchunks,checkpoint=ckpt,ckpt_every=5,stream=stream)
+    for a,b in zip(res[:3],ref[:3]):
+        assert a.shape==b.shape
+        assert np.all(a.mask==b.mask)
+        assert np.allclose(a.filled(0),b.filled(0))
+    assert products.ProductReader(stream).meta['acclen']==acclen
+
+def test_xcorr_stream(tmp_path):
+    paths=[]
+    for k in range(2):
+        paths.append(str(tmp_path/f"snap{k}"))
+        make_station(paths[-1], t0, nfiles=2, npackets=60, spec0=1000+500*k, seed=k)
+    ref=xcorravg.get_avg_fast(paths[0],paths[1],t0,t0+10,5,37,10)
+    res=xcorravg.get_avg_fast(paths[0],paths[1],t0,t0+10,5,37,10,stream=str(tmp_path/'prod'))
+    assert np.all(res[0].mask==ref[0].mask)
+    assert np.allclose(res[0].filled(0),ref[0].filled(0))
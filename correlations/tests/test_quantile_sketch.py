@@ -0,0 +1,148 @@
+import pytest
+import numpy as np
+from utils.stats_utils import QuantileSketch, sketch_percentiles, sketch_clipped_stats, channel_stats
+
+def make_data(nrow=5000, nchan=6, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.lognormal(15, 1, (nrow, nchan))
+    x[:,1] *= -1
+    x[:,2] = rng.normal(0, 1e6, nrow) # both signs
+    x[:50,3] = 0
+    x[::7,4] = np.nan
+    return x
+
+@pytest.mark.parametrize("q", [0.01, 0.25, 0.5, 0.9, 0.99])
+def test_relative_accuracy(q):
+    alpha = 0.01
+    x = make_data()
+    sk = QuantileSketch(x.shape[1], alpha).update(x)
+    exact = np.nanquantile(x, q, axis=0, method='lower')
+    exact_hi = np.nanquantile(x, q, axis=0, method='higher')
+    est = sk.quantile(q)
+    # within alpha of a value at the right rank
+    ok = (np.abs(est-exact) <= alpha*np.abs(exact)+1e-12) | (np.abs(est-exact_hi) <= alpha*np.abs(exact_hi)+1e-12)
+    assert np.all(ok)
+
+def test_multi_decade_spectrum():
+    # LST-style use: many (bin, channel) sketches in one, band levels over 5 decades, an RFI channel and
+    # signed cross products with a small mean
+    alpha = 0.02
+    rng = np.random.default_rng(3)
+    nchan, nbin, nrow = 2048, 4, 400
+    level = 10**np.linspace(4, 9, nchan)
+    auto = level*rng.lognormal(0, 0.3, (nrow, nchan))
+    auto[::10, 1000] *= 1e6 # RFI spikes
+    cross = level*(0.05 + rng.normal(size=(nrow, nchan)))
+    groups = np.sort(rng.integers(0, nbin, nrow))
+    for x, name in ((auto, 'auto'), (cross, 'cross')):
+        sk = QuantileSketch(nbin*nchan, alpha, max_bins=256, dtype='int32')
+        for i in range(0, nrow, 64):
+            sk.update(x[i:i+64], groups=groups[i:i+64])
+        med = sk.median().reshape(nbin, nchan)
+        for b in range(nbin):
+            xs = np.sort(x[groups==b], axis=0)
+            exact = xs[(len(xs)-1)//2] # the order statistic the sketch estimates
+            ok = np.abs(med[b]-exact) <= alpha*np.abs(exact)*(1+1e-9)
+            # a signed median that happens to sit in the folded near-zero tail is only good to the fold edge
+            chans = b*nchan + np.arange(nchan)
+            edge = sk.gamma**sk.kmin[chans]*(1+1e-9)
+            ok |= sk.collapsed[chans] & (np.abs(exact) <= edge) & (np.abs(med[b]) <= edge)
+            assert np.all(ok)
+        if(name=='auto'):
+            # only the RFI channel needs more than max_bins keys, and its median is still fine
+            assert set(np.nonzero(sk.collapsed.reshape(nbin, nchan))[1]) == {1000}
+
+def test_merge_matches_single_pass():
+    x = make_data()
+    full = QuantileSketch(x.shape[1]).update(x)
+    parts = [QuantileSketch(x.shape[1]).update(x[i:i+700]) for i in range(0, len(x), 700)]
+    merged = parts[0]
+    for p in parts[1:]:
+        merged.merge(p)
+    assert np.array_equal(merged.count, full.count)
+    assert np.array_equal(merged.pos, full.pos)
+    assert np.array_equal(merged.neg, full.neg)
+    assert np.allclose(merged.quantile([0.1,0.5,0.9]), full.quantile([0.1,0.5,0.9]))
+    assert np.allclose(merged.mean(), np.nanmean(x, axis=0))
+
+def test_bounded_and_masked():
+    x = np.ma.masked_invalid(make_data())
+    x[:100] = np.ma.masked
+    sk = QuantileSketch(x.shape[1], max_bins=64).update(x)
+    assert sk.pos.shape[1] <= 64
+    assert np.array_equal(sk.count, x.count(axis=0))
+    assert np.all(np.isnan(QuantileSketch(3).median()))
+    restored = QuantileSketch.from_dict(sk.to_dict())
+    assert np.allclose(restored.median(), sk.median())
+
+def test_sketch_percentiles():
+    x = np.abs(make_data())
+    est = sketch_percentiles(x, [1,50,99], chunk=333)
+    exact = np.nanpercentile(x, [1,50,99])
+    assert np.allclose(est, exact, rtol=0.02)
+
+def test_sketch_clipped_stats():
+    # waterfall-like: band levels over two decades on a big mean, a few missing rows
+    rng = np.random.default_rng(2)
+    x = np.ma.masked_invalid(1e9*np.linspace(1, 100, 40)*rng.lognormal(0, 0.1, (3000, 40)))
+    x[100:130] = np.ma.masked
+    b, med, u, stddev = sketch_clipped_stats(x, chunk=333)
+    xx = x.compressed()
+    eb, emed, eu = np.percentile(xx, [1,50,99])
+    assert np.allclose([b, med, u], [eb, emed, eu], rtol=0.005)
+    assert np.isclose(stddev, np.ma.masked_outside(x, b, u).std(), rtol=1e-9)
+    assert np.isclose(stddev, xx[(xx>=eb)&(xx<=eu)].std(), rtol=0.01)
+
+def test_channel_stats():
+    x = np.ma.masked_invalid(make_data(nrow=1001, nchan=130))
+    x[5:9, 7] = np.ma.masked
+    x[:, 100] = np.ma.masked
+    stats = channel_stats(x, nthreads=3, block=16)
+    ref = {"min":np.ma.min(x,axis=0), "median":np.ma.median(x,axis=0), "mean":np.ma.mean(x,axis=0), "max":np.ma.max(x,axis=0)}
+    for k in ref:
+        assert np.allclose(stats[k], ref[k].filled(np.nan), equal_nan=True)
+    assert np.isnan(stats['median'][100])
+    # plain arrays with NaNs give the same
+    stats2 = channel_stats(x.filled(np.nan))
+    assert np.allclose(stats2['median'], stats['median'], equal_nan=True)
+
+def test_groups_and_partial_merge():
+    x = make_data(nrow=600)
+    nchan = x.shape[1]
+    groups = np.sort(np.random.default_rng(1).integers(0, 5, len(x)))
+    big = QuantileSketch(5*nchan, dtype='int32').update(x, groups=groups)
+    for b in range(5):
+        sk = QuantileSketch(nchan).update(x[groups==b])
+        assert np.allclose(big.median()[b*nchan:(b+1)*nchan], sk.median(), equal_nan=True)
+    # small sketches of only the groups in a slice, merged into channels of the big one
+    merged = QuantileSketch(5*nchan, dtype='int32')
+    for i in range(0, len(x), 250):
+        bins, loc = np.unique(groups[i:i+250], return_inverse=True)
+        part = QuantileSketch(len(bins)*nchan).update(x[i:i+250], groups=loc)
+        merged.merge(part, chans=(bins[:,None]*nchan + np.arange(nchan)).ravel())
+    assert np.array_equal(merged.pos, big.pos)
+    assert np.array_equal(merged.neg, big.neg)
+    assert np.array_equal(merged.count, big.count)
+    assert np.allclose(merged.quantile([0.2,0.5]), big.quantile([0.2,0.5]), equal_nan=True)
+
+def test_ragged_dict():
+    # one channel over many decades: it folds and is max_bins wide, the others only take their own key range
+    rng = np.random.default_rng(4)
+    x = rng.lognormal(10, 0.2, (2000, 300))
+    x[::5, 7] *= 10.**rng.integers(-5, 6, 400)
+    x[:, 9] *= -1
+    sk = QuantileSketch(300, 0.02, max_bins=256, dtype='int32').update(x)
+    assert sk.collapsed[7] and sk.pos.shape[1] == 256
+    d = sk.to_dict()
+    assert len(d['pos']) < sk.pos.size/4
+    assert len(d['neg']) == len(d['pos'])
+    restored = QuantileSketch.from_dict(d)
+    assert np.array_equal(restored.quantile([0.1,0.5,0.9]), sk.quantile([0.1,0.5,0.9]))
+    # a few channels only, narrower than the full sketch
+    chans = np.array([250, 3, 9, 100])
+    part = QuantileSketch.from_dict(d, chans)
+    assert part.pos.shape[1] < 256
+    assert np.array_equal(part.quantile([0.1,0.5,0.9]), sk.quantile([0.1,0.5,0.9])[:, chans])
+    # and merged back into the channels they came from
+    merged = QuantileSketch(300, 0.02, max_bins=256, dtype='int32').merge(part, chans=chans)
+    assert np.array_equal(merged.median()[chans], sk.median()[chans])
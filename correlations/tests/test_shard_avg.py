@@ -0,0 +1,55 @@
+import pytest
+import glob
+import os
+import sys
+import json
+import subprocess
+import numpy as np
+import autocorravg
+import shard_avg
+from correlations.tests.synth_baseband import make_station
+
+t0 = 1700000000
+rootdir = os.path.dirname(os.path.abspath(shard_avg.__file__))
+
+def run(*args):
+    subprocess.run([sys.executable, os.path.join(rootdir,'shard_avg.py')]+[str(a) for a in args], check=True, cwd=rootdir, capture_output=True)
+
+def test_plan_run_merge(tmp_path):
+    data_dir=str(tmp_path/'snap1')
+    outdir=str(tmp_path/'out')
+    make_station(data_dir, t0, nfiles=4, npackets=50)
+    acclen,nchunks=37,20
+    run('plan', data_dir, t0, acclen, 3, '-n', nchunks, '-o', outdir)
+    mfile=glob.glob(os.path.join(outdir,'manifest_*.json'))[0]
+    with open(mfile) as f:
+        manifest=json.load(f)
+    shards=manifest['shards']
+    assert len(shards)==3
+    assert sum(s['nchunks'] for s in shards)==nchunks
+    #every shard after the first starts on the first chunk inside a new file
+    for s in shards[1:]:
+        assert 0<=s['idxstart']<acclen
+    for s in shards[::-1]:
+        run('run', mfile, s['id'])
+    pol00,pol11,pol01,chans=shard_avg.merge_shards(manifest,outdir)
+    ref=autocorravg.get_avg_fast(data_dir,t0,t0+10,acclen,nchunks)
+    for a,b in zip((pol00,pol11,pol01),ref[:3]):
+        assert np.all(a.mask==b.mask)
+        assert np.allclose(a.filled(0),b.filled(0))
+
+def test_run_slurm_and_missing_shard(tmp_path):
+    data_dir=str(tmp_path/'snap1')
+    outdir=str(tmp_path/'out')
+    make_station(data_dir, t0, nfiles=3, npackets=50)
+    manifest=shard_avg.plan_shards(data_dir, t0, t0+10, 37, 12, 2)
+    manifest['outdir']=outdir
+    os.makedirs(outdir)
+    mfile=os.path.join(outdir,'manifest.json')
+    with open(mfile,'w') as f:
+        json.dump(manifest,f)
+    env=dict(os.environ, SLURM_ARRAY_TASK_ID='0')
+    subprocess.run([sys.executable, os.path.join(rootdir,'shard_avg.py'), 'run', mfile], check=True, cwd=rootdir, env=env, capture_output=True)
+    assert os.path.exists(shard_avg.get_shard_fname(outdir,0))
+    with pytest.raises(RuntimeError):
+        shard_avg.merge_shards(manifest,outdir)
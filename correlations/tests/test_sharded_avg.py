@@ -0,0 +1,67 @@
+import pytest
+import glob
+import os
+import numpy as np
+import autocorravg
+import xcorravg
+from correlations import baseband_data_classes as bdc
+from correlations.delay_model import DelayModel
+from correlations.tests.synth_baseband import make_station
+
+t0 = 1700000000
+
+@pytest.fixture
+def stations(tmp_path):
+    paths=[]
+    for k in range(2):
+        path=tmp_path/f"snap{k}"
+        make_station(str(path), t0, nfiles=3, npackets=60, spec0=1000+500*k, seed=k)
+        paths.append(str(path))
+    return paths
+
+def test_seek_specnum(stations):
+    files=sorted(glob.glob(os.path.join(stations[0],'*','*.raw')))
+    first,last=bdc.get_specnum_bounds(files[1])
+    assert bdc.seek_specnum(files,0,first+10)==(1,10)
+    #in the gap before file 1
+    assert bdc.seek_specnum(files,0,first-2)==(1,-2)
+    assert bdc.seek_specnum(files,0,1000+5)==(0,5)
+
+def test_iterator_seek_back(stations):
+    files=sorted(glob.glob(os.path.join(stations[0],'*','*.raw')))
+    first0,last0=bdc.get_specnum_bounds(files[0])
+    first1,last1=bdc.get_specnum_bounds(files[1])
+    acclen=40
+    ant=bdc.BasebandFileIterator(files,0,last0-first0-10,acclen)
+    next(ant)
+    assert ant.fileidx==1
+    #a delay going back across the file boundary reads the end of file 0 again, not a gap
+    ant.seek(last0-20)
+    assert ant.fileidx==0
+    specnums=next(ant)['specnums']
+    assert specnums[0]==last0-20
+    ref=np.concatenate([bdc.BasebandPacked(files[0],unpack=False).spec_idx,bdc.BasebandPacked(files[1],unpack=False).spec_idx])
+    assert np.array_equal(specnums,ref[(ref>=last0-20)&(ref<last0-20+acclen)])
+    #and forward past the end of the file
+    ant.seek(first1+30)
+    assert ant.fileidx==1 and next(ant)['specnums'][0]==first1+30
+
+def test_autocorr_sharded(stations):
+    acclen,nchunks=37,18
+    serial=autocorravg.get_avg_fast(stations[0],t0,t0+10,acclen,nchunks,nproc=1)
+    sharded=autocorravg.get_avg_fast(stations[0],t0,t0+10,acclen,nchunks,nproc=3)
+    for a,b in zip(serial[:3],sharded[:3]):
+        assert a.shape==(nchunks,8)
+        assert a.count()>0
+        assert np.all(a.mask==b.mask)
+        assert np.allclose(a.filled(0),b.filled(0))
+
+@pytest.mark.parametrize("delay_model", [None, DelayModel(delay0=5,delay_rate=800.,phase_rate=50.)])
+def test_xcorr_sharded(stations,delay_model):
+    acclen,nchunks=37,16
+    serial=xcorravg.get_avg_fast(stations[0],stations[1],t0,t0+10,5,acclen,nchunks,delay_model=delay_model,nproc=1)
+    sharded=xcorravg.get_avg_fast(stations[0],stations[1],t0,t0+10,5,acclen,nchunks,delay_model=delay_model,nproc=4)
+    assert serial[0].shape==(nchunks,8)
+    assert serial[0].count()>0
+    assert np.all(serial[0].mask==sharded[0].mask)
+    assert np.allclose(serial[0].filled(0),sharded[0].filled(0))
@@ -0,0 +1,35 @@
+import numpy as np
+from correlations.tests.stubs import stub_module
+stub_module('scio.scio')
+import SNAPfiletools as sft
+
+def test_gap_layout():
+    row_time = 10.
+    # second file starts 3.5 rows after the first ends, third has no data, fourth follows the second with no gap
+    tstamps = [1000, 1000+5*row_time+35, 2000, 1000+5*row_time+35+4*row_time]
+    nrows = [5, 4, 0, 2]
+    starts, total, tstart, tend = sft.get_gap_layout(tstamps, nrows, row_time)
+    assert starts == [0, 8, None, 12]
+    assert total == 14
+    assert tstart == 1000
+    assert tend == tstamps[3] + 2*row_time
+    # nothing but empty files
+    starts, total, tstart, tend = sft.get_gap_layout([1, 2], [0, 0], row_time)
+    assert starts == [None, None] and total == 0 and tstart is None
+
+def test_assemble_blocks():
+    nchan = 3
+    blocks = [np.ones((5, nchan)), 2*np.ones((4, nchan)), None, 3*np.ones((3, nchan))]
+    starts = [0, 8, None, 12]
+    nrows = [5, 4, 0, 2]
+    out = sft.assemble_blocks(blocks, starts, nrows, 14, nchan)
+    assert out.shape == (14, nchan)
+    assert np.all(out[:5] == 1)
+    assert np.all(np.isnan(out[5:8]))
+    assert np.all(out[8:12] == 2)
+    # block longer than its rows in the layout is cut
+    assert np.all(out[12:] == 3)
+    # a product without any blocks is all NaN, and masks cleanly
+    empty = sft.assemble_blocks([None]*4, starts, nrows, 14, nchan)
+    assert empty.shape == (14, nchan) and np.all(np.isnan(empty))
+    assert np.all(np.ma.masked_invalid(empty).mask)
@@ -0,0 +1,80 @@
+import pytest
+import numpy as np
+import voltage_stream
+from legacy import pfb_helper
+from correlations import baseband_data_classes as bdc
+from correlations import unpacking as unpk
+from correlations.tests.synth_baseband import make_station
+
+t0 = 1700000000
+
+def test_forward_pfb():
+    rng = np.random.default_rng(2)
+    ts = rng.normal(size=256*50+77)
+    w = pfb_helper.sinc_hamming(4, 256)
+    ref = np.array([np.fft.rfft(ts[i*256:(i+4)*256]*w)[::4] for i in range(47)])
+    spec = pfb_helper.pfb(ts, 129, 4, nchunk=10)
+    assert spec.shape == ref.shape
+    assert np.allclose(spec, ref)
+    chunks = np.array_split(ts, 9)
+    assert np.allclose(np.concatenate(list(pfb_helper.pfb_stream(chunks, 129, 4))), spec)
+
+def test_batched_inverse_pfb():
+    rng = np.random.default_rng(0)
+    ts = rng.normal(size=256*600)
+    spec = pfb_helper.pfb(ts, 129, 4)
+    rec = pfb_helper.inverse_pfb(spec, 4)
+    assert rec.shape == (len(spec)+3, 256)
+    # only the edges can't be recovered
+    assert np.std((rec.ravel()-ts)[256*100:-256*100]) < 2e-3
+    assert np.allclose(pfb_helper.inverse_pfb(spec, 4, nthreads=3), rec)
+
+def test_band_cholesky_truncation():
+    coeff_P, coeff_PPT = pfb_helper.get_ppt_coeffs(4, 256)
+    nblock = 600
+    L, start, nrow = pfb_helper.toeplitz_band_cholesky(coeff_PPT, nblock)
+    # most offsets converge early, only the nearly singular middle ones need all the rows
+    assert np.median(nrow) < 50
+    assert len(L) < 0.2*nblock*256
+    assert nrow.max() == nblock
+    for c in [0, 37, 100, 128]:
+        T = sum(np.diag(np.full(nblock-k, coeff_PPT[k, c]), -k) for k in range(4))
+        T = T + np.tril(T, -1).T
+        ref = np.linalg.cholesky(T)
+        rows = L[start[c] + np.minimum(np.arange(nblock), nrow[c]-1)]
+        dense = np.zeros((nblock, nblock))
+        for k in range(4):
+            dense[np.arange(k, nblock), np.arange(nblock-k)] = rows[k:, k]
+        assert np.allclose(dense, ref, atol=1e-8*ref.max())
+
+def test_streaming_inverse_pfb():
+    rng = np.random.default_rng(1)
+    ts = rng.normal(size=256*3000)
+    spec = pfb_helper.pfb(ts, 129, 4)
+    full = pfb_helper.inverse_pfb(spec, 4).ravel()
+    ipfb = pfb_helper.StreamingInversePFB(129, nover=512)
+    edges = np.r_[0, np.sort(rng.choice(np.arange(1,len(spec)), 15, replace=False)), len(spec)]
+    out = np.concatenate([ipfb.push(spec[a:b]) for a, b in zip(edges[:-1], edges[1:])] + [ipfb.flush()])
+    assert len(out) == len(full)
+    assert np.sqrt(np.mean((out-full)**2)) < 2e-3
+
+def test_stream_across_files(tmp_path):
+    data_dir = str(tmp_path/'snap1')
+    files = make_station(data_dir, t0, nfiles=2, npackets=60)
+    acclen, nchunks = 50, 9
+    outs = list(voltage_stream.stream_voltages(data_dir, t0, t0+10, acclen, nchunks, pols=(0,), nover=128))
+    assert [o['sample0'] for o in outs] == list(np.cumsum([0]+[len(o['pol0']) for o in outs[:-1]]))
+    volt = np.concatenate([o['pol0'] for o in outs])
+    # same zero filled spectra read in one go and pushed in the same chunks
+    ant = bdc.BasebandFileIterator(files, 0, 0, acclen*nchunks, nchunks=1)
+    m = ant.spec_num_start
+    chunk = next(ant)
+    x, present = unpk.unpack_sorted_4bit(chunk['pol0'], chunk['specnums'], m, acclen*nchunks)
+    assert not np.all(present)
+    spec = np.zeros((acclen*nchunks, voltage_stream.NFREQ), dtype='complex128')
+    spec[:, ant.obj.channels] = x
+    ipfb = pfb_helper.StreamingInversePFB(voltage_stream.NFREQ, nover=128)
+    ref = np.concatenate([ipfb.push(spec[i*acclen:(i+1)*acclen]) for i in range(nchunks)] + [ipfb.flush()])
+    assert len(volt) == (acclen*nchunks+3)*4096
+    assert np.std(volt) > 0
+    assert np.allclose(volt, ref)
@@ -0,0 +1,70 @@
+import pytest
+import numpy as np
+from correlations import correlations as cr
+from correlations.delay_model import DelayModel
+
+def unpack_sorted_4bit(pol):
+    re=np.asarray(np.right_shift(np.bitwise_and(pol, 0xf0), 4), dtype="int8")
+    re[re>8]=re[re>8]-16
+    im=np.asarray(np.bitwise_and(pol, 0x0f), dtype="int8")
+    im[im>8]=im[im>8]-16
+    return re+1J*im
+
+@pytest.fixture
+def two_ant_data():
+    rng=np.random.default_rng(42)
+    nrows=200
+    ncol=12
+    data0=rng.integers(0,256,(nrows,ncol)).astype('uint8')
+    data1=rng.integers(0,256,(nrows,ncol)).astype('uint8')
+    #both antennas have some spectra missing, at different places
+    specnum0=np.arange(1000,1000+nrows+20,dtype='int64')
+    specnum0=np.delete(specnum0,np.arange(30,50))
+    specnum1=np.arange(5000,5000+nrows+20,dtype='int64')
+    specnum1=np.delete(specnum1,np.arange(100,120))
+    return data0,data1,specnum0,specnum1
+
+def get_ref(data0,data1,specnum0,specnum1,start0,start1,rot,blocklen):
+    x0=unpack_sorted_4bit(data0)
+    x1=unpack_sorted_4bit(data1)
+    common,i0,i1=np.intersect1d(specnum0-start0,specnum1-start1,return_indices=True)
+    blk=np.clip(common//blocklen,0,rot.shape[0]-1)
+    prod=x0[i0]*np.conj(x1[i1])*rot[blk]
+    return np.sum(prod,axis=0)/len(common)
+
+def test_rot_ones_matches_2ant(two_ant_data):
+    data0,data1,specnum0,specnum1=two_ant_data
+    rot=np.ones((4,data0.shape[1]),dtype='complex64')
+    cr1=cr.avg_xcorr_4bit_2ant(data0,data1,specnum0,specnum1,1000,5003)
+    cr2=cr.avg_xcorr_4bit_2ant_rot(data0,data1,specnum0,specnum1,1000,5003,rot,50)
+    assert np.allclose(cr1,cr2)
+
+def test_rot_blocks(two_ant_data):
+    data0,data1,specnum0,specnum1=two_ant_data
+    rng=np.random.default_rng(1)
+    nblock=4
+    blocklen=50
+    rot=np.exp(1J*rng.uniform(-np.pi,np.pi,(nblock,data0.shape[1]))).astype('complex64')
+    cr1=cr.avg_xcorr_4bit_2ant_rot(data0,data1,specnum0,specnum1,1000,5003,rot,blocklen)
+    cr2=get_ref(data0,data1,specnum0,specnum1,1000,5003,rot,blocklen)
+    assert np.allclose(cr1,cr2,rtol=1e-5,atol=1e-4)
+
+def test_rot_no_overlap(two_ant_data):
+    data0,data1,specnum0,specnum1=two_ant_data
+    rot=np.ones((1,data0.shape[1]),dtype='complex64')
+    cr1=cr.avg_xcorr_4bit_2ant_rot(data0,data1,specnum0,specnum1,0,5000,rot,1000)
+    assert np.isnan(cr1)
+
+def test_delay_model():
+    model=DelayModel(delay0=10,delay_rate=2.,slope0=0.1,slope_rate=0.01,phase0=0.5,phase_rate=0.2)
+    assert model.get_delay(0)==10
+    assert model.get_delay(1.3)==13
+    chans=np.arange(100,104)
+    ph=model.get_phase(np.array([0.,2.]),chans)
+    assert ph.shape==(2,4)
+    assert np.allclose(ph[0],0.5+0.1*chans)
+    assert np.allclose(ph[1],0.5+0.4+(0.1+0.02)*chans)
+    rot=model.get_rot(2.,chans)
+    assert np.allclose(rot,np.exp(-1J*ph[1]),atol=1e-6)
+    assert not model.is_static()
+    assert DelayModel(delay0=-5).is_static()
@@ -88,4 +88,28 @@ def sortpols(data, length_channels, bit_mode, rowstart, rowend, chanstart, chane
     t2 = time.time()
     print(f"Took {(t2 - t1):5.3f} to unpack")
     
-    return pol0, pol1
\ No newline at end of file
+    return pol0, pol1
+
+def _make_4bit_lut():
+    b = numpy.arange(256)
+    re = b>>4
+    im = b&15
+    re[re>8] = re[re>8]-16
+    im[im>8] = im[im>8]-16
+    return (re + 1J*im).astype('complex64')
+
+LUT_4BIT = _make_4bit_lut()
+
+def unpack_sorted_4bit(pol, specnums, start_idx, nspec):
+    '''
+    Decode sortpol'd 4 bit bytes (one pol, as returned by sortpols or BasebandFileIterator) to complex64
+    with a 256 entry lookup table. Spectrum s goes to row s-start_idx of an (nspec, ncols) array, so missing
+    spectra come out as rows of zeros and time stays contiguous. Also returns a bool array of which rows were present.
+    '''
+    rows = numpy.asarray(specnums, dtype='int64') - start_idx
+    keep = (rows>=0)&(rows<nspec)
+    out = numpy.zeros((nspec, pol.shape[1]), dtype='complex64')
+    out[rows[keep]] = LUT_4BIT[pol[:len(rows)][keep]]
+    present = numpy.zeros(nspec, dtype=bool)
+    present[rows[keep]] = True
+    return out, present
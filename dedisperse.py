@@ -0,0 +1,201 @@
+import numpy as np
+import time
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from correlations import products
+
+KDM = 4.148808e3 # dispersion constant in s MHz^2 pc^-1 cm^3
+
+def get_delays(freqs, dm, fref):
+    # delay in seconds of freqs (MHz) relative to fref
+    return KDM*dm*(np.asarray(freqs,dtype='float64')**-2 - fref**-2)
+
+def plan_subbands(freqs, dms, dt, nsub=32, ndm_group=16):
+    '''
+    Subband dedispersion plan. Channels are split into nsub contiguous subbands (in frequency order) and DM trials
+    into groups of ndm_group. For every group, channels are first shifted to the top of their subband at the
+    group's central DM, then subbands are shifted to the top of the band at every DM of the group.
+    All shifts are in samples and non-negative. maxshift is the overlap needed between blocks.
+    '''
+    freqs = np.asarray(freqs, dtype='float64')
+    dms = np.asarray(dms, dtype='float64')
+    order = np.argsort(freqs)
+    subbands = [s for s in np.array_split(order, nsub) if len(s)>0]
+    ftop = freqs.max()
+    sub_ftop = np.array([freqs[s].max() for s in subbands])
+    groups = []
+    for g in range(0, len(dms), ndm_group):
+        idm = np.arange(g, min(g+ndm_group, len(dms)))
+        dmc = np.mean(dms[idm])
+        intra = [np.round(get_delays(freqs[s], dmc, sub_ftop[k])/dt).astype(int) for k, s in enumerate(subbands)]
+        inter = np.round(get_delays(sub_ftop[None,:], dms[idm,None], ftop)/dt).astype(int)
+        groups.append({'idm':idm, 'intra':intra, 'inter':inter})
+    intra_max = max(max(s.max() for s in g['intra']) for g in groups)
+    inter_max = max(g['inter'].max() for g in groups)
+    return {'subbands':subbands, 'groups':groups, 'intra_max':int(intra_max), 'inter_max':int(inter_max),\
+        'maxshift':int(intra_max+inter_max), 'ndm':len(dms)}
+
+def _dedisperse_group(data, plan, group, nout):
+    lsub = nout + plan['inter_max']
+    t = np.arange(lsub)
+    sub = np.empty((len(plan['subbands']), lsub), dtype='float32')
+    for k, s in enumerate(plan['subbands']):
+        # all channels of the subband are shifted at once with one gather
+        sub[k] = data[s[:,None], group['intra'][k][:,None]+t[None,:]].sum(axis=0)
+    t = np.arange(nout)
+    ks = np.arange(len(plan['subbands']))
+    out = np.empty((len(group['idm']), nout), dtype='float32')
+    for i in range(len(group['idm'])):
+        out[i] = sub[ks[:,None], group['inter'][i][:,None]+t[None,:]].sum(axis=0)
+    return out
+
+def subband_dedisperse(data, plan, nthreads=4):
+    '''
+    data: (nchan, ntime) normalized power. Returns (ndm, ntime-maxshift) dedispersed time series,
+    referenced to the top of the band. DM groups are independent and run in a thread pool
+    (numpy releases the GIL in the gathers and sums).
+    '''
+    nout = data.shape[1] - plan['maxshift']
+    if(nout<=0):
+        return np.zeros((plan['ndm'], 0), dtype='float32')
+    dmt = np.empty((plan['ndm'], nout), dtype='float32')
+    with ThreadPoolExecutor(nthreads) as ex:
+        results = ex.map(lambda g: _dedisperse_group(data, plan, g, nout), plan['groups'])
+        for g, out in zip(plan['groups'], results):
+            dmt[g['idm']] = out
+    return dmt
+
+def normalize_block(block):
+    '''
+    (ntime, nchan) masked power -> (nchan, ntime) float32 with every channel at zero median and unit robust std.
+    Masked samples and dead channels are set to zero so they don't add anything.
+    '''
+    x = np.ma.masked_invalid(block).astype('float32').T
+    med = np.ma.median(x, axis=1)
+    mad = 1.4826*np.ma.median(np.abs(x - med[:,None]), axis=1)
+    mad = np.ma.filled(mad, 0)
+    good = mad>0
+    out = np.zeros(x.shape, dtype='float32')
+    out[good] = ((x[good] - med[good,None])/mad[good,None]).filled(0)
+    return out
+
+def get_snr(dmt, widths):
+    '''
+    Boxcar S/N of every DM trial for every width, using a robust per-trial std.
+    Returns best S/N and the index of the width that gave it, both (ndm, nout) with nout = ntime - max(widths) + 1.
+    '''
+    nout = dmt.shape[1] - max(widths) + 1
+    med = np.median(dmt, axis=1, keepdims=True)
+    std = 1.4826*np.median(np.abs(dmt-med), axis=1, keepdims=True)
+    std[std==0] = np.inf
+    cs = np.concatenate([np.zeros((dmt.shape[0],1)), np.cumsum(dmt-med, axis=1, dtype='float64')], axis=1)
+    best = np.full((dmt.shape[0], nout), -np.inf)
+    bestw = np.zeros((dmt.shape[0], nout), dtype=int)
+    for iw, w in enumerate(widths):
+        snr = (cs[:,w:w+nout] - cs[:,:nout])/(std*np.sqrt(w))
+        better = snr>best
+        best[better] = snr[better]
+        bestw[better] = iw
+    return best, bestw
+
+def find_candidates(best, bestw, threshold, t0, dt, dms, widths):
+    '''
+    Candidates are time samples where the best S/N over DM and width is above threshold and is the
+    largest within +- the widest boxcar. Returns a structured array of (time, dm, width, snr).
+    '''
+    cand_dtype = [('time','f8'),('dm','f8'),('width','i8'),('snr','f8')]
+    idm = np.argmax(best, axis=0)
+    peak = best[idm, np.arange(best.shape[1])]
+    w = max(widths)
+    padded = np.concatenate([np.full(w, -np.inf), peak, np.full(w, -np.inf)])
+    localmax = np.lib.stride_tricks.sliding_window_view(padded, 2*w+1).max(axis=1)
+    it = np.where((peak>=threshold) & (peak>=localmax))[0]
+    cands = np.zeros(len(it), dtype=cand_dtype)
+    cands['time'] = t0 + it*dt
+    cands['dm'] = np.asarray(dms)[idm[it]]
+    cands['width'] = np.asarray(widths)[bestw[idm[it], it]]
+    cands['snr'] = peak[it]
+    return cands
+
+def merge_candidates(cands, window):
+    '''
+    Keep only the strongest candidate within +- window seconds. Removes duplicates of pulses found at both
+    sides of a block boundary.
+    '''
+    keep = []
+    for i in np.argsort(cands['snr'])[::-1]:
+        if(len(keep)==0 or np.all(np.abs(cands['time'][keep]-cands['time'][i])>window)):
+            keep.append(i)
+    return np.sort(cands[keep], order='time')
+
+def dedisperse_product(path, dms, outpath=None, block=65536, nsub=32, ndm_group=16, widths=(1,2,4,8,16), threshold=7.,\
+    pols=('pol00','pol11'), nthreads=4):
+    '''
+    Out-of-core dedispersion of a power product written by spectra_stream.py or autocorravg.py --stream.
+    The waterfall is read in blocks of `block` output samples plus the overlap needed by the largest DM and width,
+    so memory depends on block, not on the length of the run.
+    If outpath is given, the DM-time array is written there as a product (rows are time, columns are DM trials).
+    Returns the candidates.
+    '''
+    reader = products.ProductReader(path)
+    meta = reader.meta
+    dt = meta['t_bin'] if 't_bin' in meta else meta['t_acclen']
+    freqs = np.asarray(meta['channels'])*125/2048
+    dms = np.asarray(dms, dtype='float64')
+    widths = list(widths)
+    plan = plan_subbands(freqs, dms, dt, nsub, ndm_group)
+    overlap = plan['maxshift'] + max(widths) - 1
+    print("Max shift", plan['maxshift'], "samples. Reading blocks of", block+overlap)
+    writer = None
+    if(outpath):
+        writer = products.ProductWriter(outpath, {'dmt':'float32'}, len(dms),\
+            {'dms':dms, 'dt':dt, 'time_start':meta.get('time_start',0), 'source':os.path.abspath(path)})
+    cands = []
+    start = 0
+    st = time.time()
+    while(start + overlap < reader.nrows):
+        t1 = time.time()
+        stop = min(start + block + overlap, reader.nrows)
+        power = sum(reader.get(p, start, stop) for p in pols)
+        dmt = subband_dedisperse(normalize_block(power), plan, nthreads)
+        best, bestw = get_snr(dmt, widths)
+        cands.append(find_candidates(best, bestw, threshold, meta.get('time_start',0)+start*dt, dt, dms, widths))
+        nout = best.shape[1]
+        if(writer is not None):
+            writer.append(dmt=dmt[:,:nout].T)
+        print(f"rows {start} to {start+nout} done in {time.time()-t1:5.3f}s,", len(cands[-1]), "candidates")
+        start += nout
+    if(writer is not None):
+        writer.close()
+    print("Time taken final:", time.time()-st)
+    if(len(cands)==0):
+        return find_candidates(np.zeros((len(dms),0)), np.zeros((len(dms),0),dtype=int), threshold, 0, dt, dms, widths)
+    return merge_candidates(np.concatenate(cands), max(widths)*dt)
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description="Incoherent subband dedispersion search of a power product.")
+    parser.add_argument('path', type=str, help='Product directory written by spectra_stream.py or autocorravg.py --stream')
+    parser.add_argument('dm_min', type=float, help='Smallest DM trial')
+    parser.add_argument('dm_max', type=float, help='Largest DM trial')
+    parser.add_argument('ndm', type=int, help='Number of DM trials')
+    parser.add_argument('-b', '--block', type=int, default=65536, help='Output samples per block read from disk')
+    parser.add_argument('-s', '--nsub', type=int, default=32, help='Number of subbands')
+    parser.add_argument('-g', '--ndm_group', type=int, default=16, help='DM trials sharing one set of subbands')
+    parser.add_argument('-w', '--widths', type=int, nargs='+', default=[1,2,4,8,16], help='Boxcar widths in samples')
+    parser.add_argument('-th', '--threshold', type=float, default=7., help='S/N threshold for candidates')
+    parser.add_argument('-j', '--nthreads', type=int, default=4, help='Threads for DM groups')
+    parser.add_argument('-d', '--dmt', action='store_true', help='Also write the DM-time array as a product')
+    parser.add_argument('-o', '--outdir', dest='outdir',type=str, default='/scratch/s/sievers/mohanagr/', help='Output directory')
+    args = parser.parse_args()
+
+    dms = np.linspace(args.dm_min, args.dm_max, args.ndm)
+    tag = f"{os.path.basename(os.path.normpath(args.path))}_{args.dm_min}_{args.dm_max}_{args.ndm}"
+    outpath = os.path.join(args.outdir, f"dmt_{tag}") if args.dmt else None
+    cands = dedisperse_product(args.path, dms, outpath, args.block, args.nsub, args.ndm_group, args.widths, args.threshold, nthreads=args.nthreads)
+    fpath = os.path.join(args.outdir, f"cands_{tag}.npz")
+    np.savez(fpath, cands=cands, dms=dms)
+    print(fpath)
+    for c in cands[np.argsort(cands['snr'])[::-1][:20]]:
+        print(f"t={c['time']:.4f} DM={c['dm']:.3f} width={c['width']} S/N={c['snr']:.1f}")
@@ -0,0 +1,80 @@
+import numpy as np
+import time
+import os
+import argparse
+from correlations import baseband_data_classes as bdc
+from correlations import unpacking as unpk
+from correlations.fine_channelizer import FineChannelizer
+from utils import baseband_utils as butils
+
+def get_fine_spectra(path, init_t, end_t, nfft, acclen, nchunks, chanstart=0, chanend=None, noverlap=None, window=True):
+    '''
+    High resolution auto and cross spectra of one station, nfft fine channels per coarse channel.
+    Spectra are read acclen at a time with the iterator and decoded straight from the sortpol'd bytes,
+    with missing spectra zero filled. Segments that contain missing spectra are not used.
+    '''
+    idxstart, fileidx, files = butils.get_init_info(init_t, end_t, path)
+    print("Starting at: ",idxstart, "in filenum: ",fileidx)
+    ant1 = bdc.BasebandFileIterator(files,fileidx,idxstart,acclen,nchunks=nchunks,chanstart=chanstart,chanend=chanend)
+    if(ant1.obj.bit_mode!=4):
+        raise NotImplementedError(f"BIT MODE {ant1.obj.bit_mode} IS NOT SUPPORTED BY THIS SCRIPT.")
+    ncols=ant1.obj.chanend-ant1.obj.chanstart
+    channels=ant1.obj.channels[ant1.obj.chanstart:ant1.obj.chanend]
+    fc = FineChannelizer(ncols, nfft, noverlap, window)
+    m=ant1.spec_num_start
+    st=time.time()
+    for i, chunk in enumerate(ant1):
+        t1=time.time()
+        x0, present = unpk.unpack_sorted_4bit(chunk['pol0'], chunk['specnums'], m+i*acclen, acclen)
+        x1, present = unpk.unpack_sorted_4bit(chunk['pol1'], chunk['specnums'], m+i*acclen, acclen)
+        fc.push(x0, x1, present)
+        print("time taken for one loop", time.time()-t1)
+        print(i+1,"CHUNK READ")
+    print("Time taken final:", time.time()-st, "segments used", fc.nseg, "skipped", fc.nskipped)
+    auto00, auto11, cross01 = fc.get_spectra()
+    return auto00, auto11, cross01, fc.get_freqs(channels), fc.nseg
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description="Fine resolution spectra by upchannelizing 4 bit baseband.")
+    parser.add_argument('data_dir', type=str,help='Parent data directory. Should have 5 digit time folders.')
+    parser.add_argument("time_start",type=int, help="Start timestamp ctime")
+    parser.add_argument("nfft", type=int, help="Fine channels per coarse channel")
+    parser.add_argument("-ov", "--noverlap", type=int, default=None, help="Overlap between FFT segments. Default nfft/2.")
+    parser.add_argument("-nw", "--no_window", action="store_true", help="Don't apply a Hann window")
+    parser.add_argument("-a", "--acclen", type=int, default=100000, help="Spectra read at a time. Doesn't change the result.")
+    parser.add_argument('-n', '--nchunks', dest='nchunks',type=int, default=560, help='Number of acclen blocks to read. If stop time is specfied this is overwritten.')
+    parser.add_argument('-t', '--time_stop', dest='time_stop',type=int, default=False, help='Stop time. Overwrites nchunks if specified')
+    parser.add_argument("-c", '--chans', type=int, nargs=2, help="Indices of start and end channels.")
+    parser.add_argument('-o', '--outdir', dest='outdir',type=str, default='/scratch/s/sievers/mohanagr/',
+              help='Output directory for data and plots')
+    args = parser.parse_args()
+
+    if(args.time_stop):
+        args.nchunks = int(np.floor((args.time_stop-args.time_start)*250e6/4096/args.acclen))
+    else:
+        args.time_stop = args.time_start + int(np.ceil(args.nchunks*args.acclen*4096/250e6))
+    if(not args.chans):
+        args.chans=[0,None]
+
+    auto00,auto11,cross01,freqs,nseg = get_fine_spectra(args.data_dir, args.time_start, args.time_stop, args.nfft, args.acclen, args.nchunks,\
+        args.chans[0], args.chans[1], args.noverlap, not args.no_window)
+
+    tag = f"{args.time_start}_{args.nchunks*args.acclen}_{args.nfft}_{args.chans[0]}_{args.chans[1]}"
+    fpath = os.path.join(args.outdir, f"fine_4bit_{tag}.npz")
+    np.savez_compressed(fpath, auto00=auto00, auto11=auto11, cross01=cross01, freqs=freqs, nseg=nseg)
+    print(fpath)
+
+    from matplotlib import pyplot as plt
+    plt.figure(figsize=(10,6), dpi=200)
+    plt.subplot(211)
+    plt.semilogy(freqs, auto00, label='pol00')
+    plt.semilogy(freqs, auto11, label='pol11')
+    plt.legend()
+    plt.subplot(212)
+    plt.plot(freqs, np.abs(cross01), label='|pol01|')
+    plt.xlabel("Frequency (MHz)")
+    plt.legend()
+    fpath = os.path.join(args.outdir, f"fine_4bit_{tag}.png")
+    plt.savefig(fpath)
+    print(fpath)
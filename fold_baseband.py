@@ -0,0 +1,81 @@
+import numpy as np
+import time
+import os
+import argparse
+from correlations import baseband_data_classes as bdc
+from correlations import correlations as cr
+from utils import baseband_utils as butils
+
+def fold_fast(path, init_t, end_t, periods, pdots, nbin, acclen, nchunks, chanstart=0, chanend=None):
+    '''
+    Fold the total power of one station at several trial periods (s) and period derivatives (s/s) in one pass.
+    acclen only sets how many spectra are read at a time, every spectrum is folded with its own timestamp.
+    Returns the profile summed over spectra (ntrial, nbin, nchan), the number of spectra in each bin and the channels.
+    '''
+    idxstart, fileidx, files = butils.get_init_info(init_t, end_t, path)
+    print("Starting at: ",idxstart, "in filenum: ",fileidx)
+    ant1 = bdc.BasebandFileIterator(files,fileidx,idxstart,acclen,nchunks=nchunks,chanstart=chanstart,chanend=chanend)
+    if(ant1.obj.bit_mode!=4):
+        raise NotImplementedError(f"BIT MODE {ant1.obj.bit_mode} IS NOT SUPPORTED BY THIS SCRIPT.")
+    # phase zero is at the first spectrum of the run
+    spec_ref = ant1.spec_num_start
+    profile = None
+    counts = None
+    st=time.time()
+    for i, chunk in enumerate(ant1):
+        t1=time.time()
+        profile, counts = cr.fold_autocorr_4bit(chunk['pol0'],chunk['pol1'],chunk['specnums'],spec_ref,periods,pdots,nbin,profile,counts)
+        print("time taken for one loop", time.time()-t1)
+        print(i+1,"CHUNK READ")
+    print("Time taken final:", time.time()-st)
+    return profile,counts,ant1.obj.channels[ant1.obj.chanstart:ant1.obj.chanend]
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description="Fold 4 bit baseband power at trial periods.")
+    parser.add_argument('data_dir', type=str,help='Parent data directory. Should have 5 digit time folders.')
+    parser.add_argument("time_start",type=int, help="Start timestamp ctime")
+    parser.add_argument("-P", "--periods", type=float, nargs='+', required=True, help="Trial periods in seconds")
+    parser.add_argument("-Pd", "--pdots", type=float, nargs='+', default=[0.], help="Period derivative of each trial, or one value for all")
+    parser.add_argument("-b", "--nbin", type=int, default=64, help="Number of phase bins")
+    parser.add_argument("-a", "--acclen", type=int, default=100000, help="Spectra read at a time. Doesn't change the result.")
+    parser.add_argument('-n', '--nchunks', dest='nchunks',type=int, default=560, help='Number of acclen blocks to fold. If stop time is specfied this is overwritten.')
+    parser.add_argument('-t', '--time_stop', dest='time_stop',type=int, default=False, help='Stop time. Overwrites nchunks if specified')
+    parser.add_argument("-c", '--chans', type=int, nargs=2, help="Indices of start and end channels.")
+    parser.add_argument('-o', '--outdir', dest='outdir',type=str, default='/scratch/s/sievers/mohanagr/',
+              help='Output directory for data and plots')
+    args = parser.parse_args()
+
+    if(args.time_stop):
+        args.nchunks = int(np.floor((args.time_stop-args.time_start)*250e6/4096/args.acclen))
+    else:
+        args.time_stop = args.time_start + int(np.ceil(args.nchunks*args.acclen*4096/250e6))
+    if(not args.chans):
+        args.chans=[0,None]
+    if(len(args.pdots)==1):
+        args.pdots = args.pdots*len(args.periods)
+    assert(len(args.pdots)==len(args.periods))
+
+    profile,counts,channels = fold_fast(args.data_dir, args.time_start, args.time_stop, args.periods, args.pdots, args.nbin,\
+        args.acclen, args.nchunks, args.chans[0], args.chans[1])
+
+    tag = f"{args.time_start}_{args.nchunks*args.acclen}_{args.nbin}_{args.chans[0]}_{args.chans[1]}"
+    fpath = os.path.join(args.outdir, f"fold_4bit_{tag}.npz")
+    np.savez_compressed(fpath, profile=profile, counts=counts, periods=args.periods, pdots=args.pdots, chans=channels)
+    print(fpath)
+
+    from matplotlib import pyplot as plt
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg = profile/counts[...,None]
+    ntrial = len(args.periods)
+    plt.figure(figsize=(5,3*ntrial), dpi=200)
+    for k in range(ntrial):
+        plt.subplot(ntrial,1,k+1)
+        prof = np.nanmean(avg[k],axis=1)
+        plt.plot(np.arange(args.nbin)/args.nbin, prof/np.nanmedian(prof))
+        plt.title(f"P = {args.periods[k]} s, Pdot = {args.pdots[k]}")
+        plt.xlabel("Phase")
+    plt.tight_layout()
+    fpath = os.path.join(args.outdir, f"fold_4bit_{tag}.png")
+    plt.savefig(fpath)
+    print(fpath)
@@ -1,7 +1,7 @@
 import numpy as np
 #from acoustics.cepstrum import complex_cepstrum
 import os, sys, argparse
-from  scio import scio
+from utils import direct_cache
 import matplotlib.pyplot as plt
 
 from astropy.convolution import Gaussian1DKernel
@@ -143,10 +143,8 @@ if __name__ == "__main__":
    
     args = parser.parse_args()
 
-    pol00 = scio.read(os.path.join(args.data_dir, "pol00.scio.bz2"))
-    pol11 = scio.read(os.path.join(args.data_dir, "pol11.scio.bz2"))
-    pol01r = scio.read(os.path.join(args.data_dir, "pol01r.scio.bz2"))
-    pol01i = scio.read(os.path.join(args.data_dir, "pol01i.scio.bz2"))
+    dat = direct_cache.get_direct(args.data_dir)
+    pol00, pol11, pol01r, pol01i = dat['pol00'], dat['pol11'], dat['pol01r'], dat['pol01i']
     acctime = get_acctime(os.path.join(args.data_dir, "time_gps_start.raw"))
 
     pol00 = pol00[1:,:]
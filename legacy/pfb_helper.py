@@ -2,7 +2,11 @@
 ##it is time to leave the caves of python 2 and write this in python3 
 
 import numpy as np
+import os
+import hashlib
 import scipy.linalg as la
+import scipy.fft
+import numba as nb
 
 
 def sinc_window(ntap, lblock):
@@ -75,30 +79,32 @@ def get_pfb_mat_sinc(nchan,ntap,window=sinc_hanning):
     return mymat
 
 
-def apply_pfb_filter_patches(mypfb,patches):
+def apply_pfb_filter_patches(mypfb,patches,stationary=False):
 #def filter_pfb_patches(mypfb,patches):
     """Assume the filtering is stationary and so apply it with a convolution.  Each patch is the filter
-    kernel for a single frequency, with highest value assumed in the middle."""
-    mypfb_out=0*mypfb
-    mypfb_ft=np.fft.fft2(mypfb)
+    kernel for a single frequency, with highest value assumed in the middle.
+
+    The kernels of all output channels are gathered into one (nchan, nblock, nchan) array and applied
+    with nblock matrix products, one per time lag, instead of a 2D FFT per channel. With stationary=True
+    the kernel of the middle channel is used for every channel and the whole thing is a single 2D FFT
+    convolution."""
     nchan=mypfb.shape[1]
     nblock=patches[0].shape[0]
     assert(patches[0].shape[1]==nchan)
-    for i in range(nchan):
-        tmp=0*mypfb_out
-        patch=patches[i]
-        patch=np.roll(patch,-i,1)
+    if stationary:
+        i=nchan//2
+        tmp=0*mypfb
+        patch=np.roll(patches[i],-i,1)
         tmp[:nblock//2,:]=patch[nblock//2:,:]
         tmp[-nblock//2:,:]=patch[:nblock//2,:]
-        #print(np.sum(np.abs(tmp)),np.sum(np.abs(patch)))
-        tmpft=np.fft.fft2(tmp)
-        if True:
-            tmpft=tmpft*mypfb_ft
-            tmpft=np.fft.ifft(tmpft,axis=1)
-            mypfb_out[:,i]=np.fft.ifft(tmpft[:,i])
-        else:
-            myconv=np.fft.ifft2((tmpft)*mypfb_ft)
-            mypfb_out[:,i]=myconv[:,i]
+        return np.fft.ifft2(np.fft.fft2(tmp)*np.fft.fft2(mypfb))
+    # kern[i,r,c] multiplies channel c at time lag r-nblock//2 for output channel i
+    chans=np.arange(nchan)
+    cols=(2*chans[:,None]-chans[None,:])%nchan
+    kern=np.asarray(patches)[chans[:,None,None],np.arange(nblock)[None,:,None],cols[:,None,:]]
+    mypfb_out=np.zeros(mypfb.shape,dtype=np.result_type(mypfb,kern))
+    for r in range(nblock):
+        mypfb_out+=np.roll(mypfb@kern[:,r,:].T,r-nblock//2,axis=0)
     return mypfb_out
 
 def make_large_pfb_mat(nchan,ntap,nblock,window=sinc_hamming):
@@ -114,15 +120,106 @@ def make_large_pfb_mat(nchan,ntap,nblock,window=sinc_hamming):
         mat[ix:ix+nchan,iy:iy+block.shape[1]]=block
     return mat
 
-def get_pfb_filter_mat(nchan,ntap,nblock,window=sinc_hamming,frac=0.85):
-    mat=make_large_pfb_mat(nchan,ntap,nblock,window=window)
-    u,s,v=np.linalg.svd(mat)
-    ss=s[np.int(frac*len(s))]
+def get_pfb_gram_blocks(nchan,ntap,window=sinc_hamming):
+    #M M^H of make_large_pfb_mat is block-Toeplitz: block (i,i+d) is G_d for d<ntap and zero past that
+    block=get_pfb_mat_sinc(nchan,ntap,window=window)
+    shift=2*(nchan-1)
+    nsamp=block.shape[1]
+    return [block[:,d*shift:]@np.conj(block[:,:nsamp-d*shift]).T for d in range(ntap)]
+
+
+def _get_filt(s,frac):
+    ss=np.sort(s.ravel())[::-1][int(frac*s.size)]
     s_filt=s/ss
     s_filt[s_filt>1]=1
-    s_filt=s_filt**2
-    filt_mat=np.conj(u)@(np.diag(s_filt)@(u.T))
+    return s_filt**2
+
+
+PFB_CACHE_DIR=os.environ.get('PFB_CACHE_DIR',os.path.join(os.path.expanduser('~'),'.cache','albatros_pfb'))
+
+#dense eigh of the Gram matrix is O((nblock*nchan)^3), above this size method='auto' uses the circulant patches
+GRAM_MAX_SIZE=4096
+
+def _window_key(window,ntap,lblock):
+    #hash of the sampled window, so lambdas, partials and redefined windows never share a cache entry
+    coeff=np.ascontiguousarray(window(ntap,lblock),dtype='float64')
+    return hashlib.sha1(coeff.tobytes()).hexdigest()[:16]
+
+def _cache_fname(kind,nchan,ntap,nblock,window,frac):
+    return os.path.join(PFB_CACHE_DIR,f"{kind}_{nchan}_{ntap}_{nblock}_{_window_key(window,ntap,2*(nchan-1))}_{frac}.npy")
+
+def _load_cached(fname):
+    if fname is not None and os.path.exists(fname):
+        return np.load(fname)
+
+def _save_cached(fname,arr):
+    #write to a temp file and rename so other processes never see a partial file
+    if fname is None:
+        return
+    os.makedirs(os.path.dirname(fname),exist_ok=True)
+    tmp=f"{fname}.{os.getpid()}.tmp"
+    with open(tmp,'wb') as f:
+        np.save(f,arr)
+    os.replace(tmp,fname)
+
+
+def get_pfb_filter_mat(nchan,ntap,nblock,window=sinc_hamming,frac=0.85,cache=True):
+    #u s^2 u^H of the SVD of the big PFB matrix is its Gram matrix, so the filter comes from eigh of the
+    #(block-Toeplitz, built block by block) Gram matrix instead of a dense SVD of the twice as wide matrix.
+    #Filter matrices are saved in PFB_CACHE_DIR and reused by later calls and other processes.
+    fname=_cache_fname('filtmat',nchan,ntap,nblock,window,frac) if cache else None
+    filt_mat=_load_cached(fname)
+    if filt_mat is not None:
+        return filt_mat
+    gram=np.zeros([nblock*nchan,nblock*nchan],dtype='complex')
+    for d,blk in enumerate(get_pfb_gram_blocks(nchan,ntap,window=window)):
+        for i in range(nblock-d):
+            gram[i*nchan:(i+1)*nchan,(i+d)*nchan:(i+d+1)*nchan]=blk
+            gram[(i+d)*nchan:(i+d+1)*nchan,i*nchan:(i+1)*nchan]=np.conj(blk).T
+    lam,u=np.linalg.eigh(gram)
+    s_filt=_get_filt(np.sqrt(np.clip(lam,0,None)),frac)
+    filt_mat=np.conj(u)@(s_filt[:,None]*u.T)
+    _save_cached(fname,filt_mat)
     return filt_mat
+
+
+def get_pfb_circulant_patches(nchan,ntap,nblock,window=sinc_hamming,frac=0.85):
+    #Same as make_conv_patches(get_pfb_filter_mat(...)) but with the Gram matrix wrapped around to be block-circulant.
+    #An FFT over blocks splits it into nblock independent nchan x nchan eigenproblems, so this is nblock^2
+    #times cheaper. The patches are a stationary approximation anyway, the difference is the edge of the
+    #finite matrix that the middle row doesn't see much of.
+    circ=np.zeros([nblock,nchan,nchan],dtype='complex')
+    for d,blk in enumerate(get_pfb_gram_blocks(nchan,ntap,window=window)):
+        circ[d]+=blk
+        if d>0:
+            circ[-d]+=np.conj(blk).T
+    circ_ft=nblock*np.fft.ifft(circ,axis=0)
+    lam,u=np.linalg.eigh(circ_ft)
+    s_filt=_get_filt(np.sqrt(np.clip(lam,0,None)),frac)
+    filt_ft=u@(s_filt[...,None]*np.conj(u).transpose(0,2,1))
+    filt=np.fft.fft(filt_ft,axis=0)/nblock
+    rows=(np.arange(nblock)-nblock//2)%nblock
+    return [np.conj(filt[rows,i,:]) for i in range(nchan)]
+
+
+def get_pfb_patches(nchan,ntap,nblock,window=sinc_hamming,frac=0.85,method='auto',cache=True):
+    #convolution patches for filter_pfb_patches, cached on disk like the filter matrices.
+    #method='gram' is make_conv_patches of the exact filter matrix, 'circulant' is get_pfb_circulant_patches.
+    #'auto' is 'gram' up to nblock*nchan=GRAM_MAX_SIZE and 'circulant' past that.
+    if method=='auto':
+        method='gram' if nblock*nchan<=GRAM_MAX_SIZE else 'circulant'
+    fname=_cache_fname(f'patches_{method}',nchan,ntap,nblock,window,frac) if cache else None
+    patches=_load_cached(fname)
+    if patches is not None:
+        return list(patches)
+    if method=='gram':
+        patches=make_conv_patches(nchan,nblock,get_pfb_filter_mat(nchan,ntap,nblock,window=window,frac=frac,cache=cache))
+    elif method=='circulant':
+        patches=get_pfb_circulant_patches(nchan,ntap,nblock,window=window,frac=frac)
+    else:
+        raise ValueError(f"Unknown method {method}")
+    _save_cached(fname,np.array(patches))
+    return patches
     
 
 def make_conv_patches(nchan,nblock,mat,offset=0):
@@ -145,13 +242,12 @@ def make_conv_patches(nchan,nblock,mat,offset=0):
     return patches
 
 
-def filter_pfb_patches(mypfb,patches=None,ntap=4,nblock=16,window=sinc_hamming,frac=0.85,return_patches=False):
+def filter_pfb_patches(mypfb,patches=None,ntap=4,nblock=16,window=sinc_hamming,frac=0.85,return_patches=False,method='auto',stationary=False):
     if patches is None:
         nchan=mypfb.shape[1]
-        filt_mat=get_pfb_filter_mat(nchan,ntap,nblock,window=window,frac=frac)
-        patches=make_conv_patches(nchan,nblock,filt_mat)
+        patches=get_pfb_patches(nchan,ntap,nblock,window=window,frac=frac,method=method)
 
-    mypfb_filt=apply_pfb_filter_patches(mypfb,patches)
+    mypfb_filt=apply_pfb_filter_patches(mypfb,patches,stationary=stationary)
     if return_patches:
         return mypfb_filt,patches
     else:
@@ -160,8 +256,12 @@ def filter_pfb_patches(mypfb,patches=None,ntap=4,nblock=16,window=sinc_hamming,f
 
 
 
-def pfb(timestream, nfreq, ntap=4, window=sinc_hamming):
+def pfb(timestream, nfreq, ntap=4, window=sinc_hamming, nchunk=4096, workers=-1):
     """Perform the CHIME PFB on a timestream.
+
+    Taking every ntap-th frequency of the windowed ntap*lblock FFT is the same as an lblock FFT
+    of the windowed taps summed together, so the taps are summed over a strided view of the
+    timestream and all blocks go through one batched rfft.
     
     Parameters
     ----------
@@ -172,6 +272,11 @@ def pfb(timestream, nfreq, ntap=4, window=sinc_hamming):
         number because of Nyquist)
     ntaps : int
         Number of taps.
+    nchunk : int, optional
+        Number of blocks done at a time, to bound the memory of the temporaries.
+        None does them all at once.
+    workers : int, optional
+        Threads for the FFT (scipy.fft convention, -1 is all cores).
 
     Returns
     -------
@@ -183,33 +288,42 @@ def pfb(timestream, nfreq, ntap=4, window=sinc_hamming):
     lblock = 2 * (nfreq - 1)
     
     # Number of blocks
-    nblock = timestream.size / lblock - (ntap - 1)
+    nblock = max(int(timestream.size / lblock - (ntap - 1)), 0)
+    spec = np.empty((nblock, nfreq), dtype=np.complex128)
+    if nblock == 0:
+        return spec
     
-    # Initialise array for spectrum
-    # if np.abs(int(nblock) - nblock) > 0.0001:
-    #     print("Nblock non integer")
-    #     print(nblock)
-    
-    nblock = int(nblock)        
-    spec = np.zeros((nblock, nfreq), dtype=np.complex128)
-    
-    # Window function
-    w = window(ntap, lblock)
-    
-    # Iterate over blocks and perform the PFB
-    for bi in range(nblock):
-        # Cut out the correct timestream section
-        ts_sec = timestream[(bi*lblock):((bi+ntap)*lblock)].copy()
-        
-        # Perform a real FFT (with applied window function)
-        ft = np.fft.rfft(ts_sec * w)
-        
-        # Choose every n-th frequency
-        spec[bi] = ft[::ntap]
+    # Window function, one row per tap
+    w = window(ntap, lblock).reshape(ntap, lblock)
+
+    # (nblock, lblock, ntap) view of the taps of every block, nothing is copied
+    blocks = np.asarray(timestream)[:(nblock + ntap - 1) * lblock].reshape(-1, lblock)
+    taps = np.lib.stride_tricks.sliding_window_view(blocks, ntap, axis=0)
+
+    step = nblock if nchunk is None else nchunk
+    for b0 in range(0, nblock, max(step, 1)):
+        folded = np.einsum('blt,tl->bl', taps[b0:b0 + step], w)
+        spec[b0:b0 + len(folded)] = scipy.fft.rfft(folded, axis=1, workers=workers)
         
     return spec
 
 
+def pfb_stream(chunks, nfreq, ntap=4, window=sinc_hamming, workers=-1):
+    """PFB of a long timestream given as an iterable of 1D chunks of any length.
+
+    Samples that don't complete a block yet, and the ntap-1 blocks the next spectrum needs,
+    are carried over to the next chunk. Yields the spectra of every chunk, which put together
+    are the same as pfb() of the whole timestream.
+    """
+    lblock = 2 * (nfreq - 1)
+    buf = np.zeros(0)
+    for chunk in chunks:
+        buf = np.concatenate([buf, chunk])
+        spec = pfb(buf, nfreq, ntap, window, workers=workers)
+        buf = buf[len(spec) * lblock:]
+        yield spec
+
+
 # def pfb_timestream_fullmatrix(ntime, nfreq, ntap=4, window=sinc_hanning):
     
 #     # Number of samples in a sub-block
@@ -266,8 +380,168 @@ def band_mv(A, kl, ku, n, m, x, trans = False):
     return yout
 
 
-def inverse_pfb(ts_pfb, ntap, window=sinc_hamming, no_nyquist=False):
+def get_ppt_coeffs(ntap, lblock, window=sinc_hamming):
+    """Window coefficients of P and the diagonals of PP^T for every offset in a block.
+
+    Returns
+    -------
+    coeff_P : np.ndarray[ntap, lblock]
+    coeff_PPT : np.ndarray[ntap, lblock]
+        coeff_PPT[k] is the k-th diagonal of the (Toeplitz) PP^T matrix of each offset.
+    """
+    coeff_P = window(ntap, lblock).reshape(ntap, lblock)
+    coeff_PPT = np.array([(coeff_P[:ntap-k] * coeff_P[k:]).sum(axis=0) for k in range(ntap)])
+    return coeff_P, coeff_PPT
+
+
+@nb.njit(parallel=True)
+def _band_cholesky_rows(coeff, nblock, tol, L, start, nrow, store):
+    # Cholesky rows of the banded Toeplitz matrix of every column of coeff, one column per thread.
+    # Each column stops at the row where it converged (nrow[c] rows). With store, rows go to L[start[c]:...].
+    nband, ncol = coeff.shape
+    for c in nb.prange(ncol):
+        ring = np.zeros((nband, nband)) # last nband rows, row j at j % nband
+        nrow[c] = nblock
+        for j in range(nblock):
+            row = ring[j % nband]
+            top = min(j, nband-1)
+            for k in range(top, 0, -1):
+                acc = coeff[k, c]
+                for m in range(k+1, top+1):
+                    acc -= row[m]*ring[(j-k) % nband, m-k]
+                row[k] = acc/ring[(j-k) % nband, 0]
+            for k in range(top+1, nband):
+                row[k] = 0.
+            acc = coeff[0, c]
+            for k in range(1, top+1):
+                acc -= row[k]**2
+            row[0] = np.sqrt(acc)
+            if store:
+                L[start[c]+j] = row
+            if j >= nband:
+                diff = 0.
+                big = 0.
+                for k in range(nband):
+                    diff = max(diff, abs(row[k]-ring[(j-1) % nband, k]))
+                    big = max(big, abs(row[k]))
+                if diff <= tol*big:
+                    nrow[c] = j+1
+                    break
+
+
+def toeplitz_band_cholesky(coeff, nblock, tol=1e-10):
+    """Cholesky factors of the banded symmetric Toeplitz matrices T[j, j+k] = coeff[k], one per column of coeff.
+
+    Rows of the factor of a banded Toeplitz matrix converge to a fixed row (the spectral factor of the band),
+    so each column stops as soon as its row stops changing and every later row is equal to its last one.
+    Most PFB offsets converge within a few tens of rows; only the few around the nearly singular middle
+    offset need all nblock. The converged rows of all columns are stored back to back.
+
+    Returns
+    -------
+    L : np.ndarray[sum(nrow), nband]
+        Rows of all columns, L[start[c] + j, k] is element (j, j-k) of the factor of column c.
+    start : np.ndarray[ncol]
+    nrow : np.ndarray[ncol]
+        Number of stored rows of each column, <= nblock.
+    """
+    nband, ncol = coeff.shape
+    coeff = np.ascontiguousarray(coeff, dtype=np.float64)
+    nrow = np.empty(ncol, dtype=np.int64)
+    start = np.zeros(ncol, dtype=np.int64)
+    # first pass only finds where every column converges, second one stores that many rows
+    _band_cholesky_rows(coeff, nblock, tol, np.empty((0, nband)), start, nrow, False)
+    start[1:] = np.cumsum(nrow)[:-1]
+    L = np.empty((nrow.sum(), nband))
+    _band_cholesky_rows(coeff, nblock, tol, L, start, nrow, True)
+    return L, start, nrow
+
+
+_chol_cache = {}
+
+def get_pfb_cholesky(ntap, lblock, nblock, window=sinc_hamming):
+    """Factor of PP^T for inverse_pfb, kept around for later calls.
+    Rows only depend on nblock where a column hasn't converged, so a factor made for a larger nblock is reused."""
+    key = (ntap, lblock, _window_key(window, ntap, lblock))
+    if key not in _chol_cache or _chol_cache[key][0] < nblock:
+        coeff_P, coeff_PPT = get_ppt_coeffs(ntap, lblock, window)
+        _chol_cache[key] = (nblock, toeplitz_band_cholesky(coeff_PPT, nblock))
+    return _chol_cache[key][1]
+
+
+@nb.njit(parallel=True)
+def _band_cholesky_solve_project(L, start, nrow, coeff_P, x, rec, colblock):
+    # solve L L^T y = x for every column of x (nblock, ncol) in place, then rec[j+k] += coeff_P[k]*y[j].
+    # Threads get blocks of colblock neighbouring columns, so the inner loops run over contiguous memory.
+    # Past the last stored row of every column in the block (jc) the factor rows are constant and kept in Lc,
+    # before that they are gathered into Lj.
+    nblock, ncol = x.shape
+    nband = L.shape[1]
+    ntap = coeff_P.shape[0]
+    for b in nb.prange((ncol+colblock-1)//colblock):
+        c0 = b*colblock
+        c1 = min(c0+colblock, ncol)
+        w = c1-c0
+        jc = 0
+        Lc = np.empty((nband, w))
+        for c in range(c0, c1):
+            jc = max(jc, nrow[c]-1)
+            for k in range(nband):
+                Lc[k, c-c0] = L[start[c]+nrow[c]-1, k]
+        Lj = np.empty((nband, w))
+        for j in range(nblock):
+            if j < jc:
+                for c in range(c0, c1):
+                    r = start[c] + min(j, nrow[c]-1)
+                    for k in range(nband):
+                        Lj[k, c-c0] = L[r, k]
+                Lr = Lj
+            else:
+                Lr = Lc
+            xj = x[j, c0:c1]
+            for k in range(1, min(j, nband-1)+1):
+                xk = x[j-k, c0:c1]
+                lk = Lr[k]
+                for i in range(w):
+                    xj[i] -= lk[i]*xk[i]
+            l0 = Lr[0]
+            for i in range(w):
+                xj[i] /= l0[i]
+        for j in range(nblock-1, -1, -1):
+            xj = x[j, c0:c1]
+            for k in range(1, min(nblock-1-j, nband-1)+1):
+                if j+k >= jc:
+                    lk = Lc[k]
+                else:
+                    for c in range(c0, c1):
+                        Lj[k, c-c0] = L[start[c]+min(j+k, nrow[c]-1), k]
+                    lk = Lj[k]
+                xk = x[j+k, c0:c1]
+                for i in range(w):
+                    xj[i] -= lk[i]*xk[i]
+            if j >= jc:
+                l0 = Lc[0]
+            else:
+                for c in range(c0, c1):
+                    Lj[0, c-c0] = L[start[c]+min(j, nrow[c]-1), 0]
+                l0 = Lj[0]
+            for i in range(w):
+                xj[i] /= l0[i]
+        for j in range(nblock):
+            xj = x[j, c0:c1]
+            for k in range(ntap):
+                rk = rec[j+k, c0:c1]
+                pk = coeff_P[k, c0:c1]
+                for i in range(w):
+                    rk[i] += pk[i]*xj[i]
+
+
+def inverse_pfb(ts_pfb, ntap, window=sinc_hamming, no_nyquist=False, nthreads=None, chol=None):
     """Invert the CHIME PFB timestream.
+
+    The banded Cholesky solve of PP^T y = pseudo_ts and the projection with P^T run in one compiled kernel,
+    in parallel over the lblock offsets.
+
     Parameters
     ----------
     ts_pfb : np.ndarray[nsamp, nfreq]
@@ -279,54 +553,85 @@ def inverse_pfb(ts_pfb, ntap, window=sinc_hamming, no_nyquist=False):
     no_nyquist : boolean, optional
         If True, we are missing the Nyquist frequency (i.e. CHIME PFB), and we
         should add it back in (with zero amplitude).
+    nthreads : integer, optional
+        Number of numba threads, all of them by default.
+    chol : tuple, optional
+        Output of toeplitz_band_cholesky for this ntap, lblock and window (and at least this nblock).
+        By default the factor from get_pfb_cholesky is used, so it is only computed once.
     """
 
     # If we are missing the Nyquist freq (default for CHIME), add it back in
     if no_nyquist:
         new_shape = ts_pfb.shape[:-1] + (ts_pfb.shape[-1] + 1,)
-        pts2 = np.zeros(new_shape, dtype=np.float64)
+        pts2 = np.zeros(new_shape, dtype=np.complex128)
         pts2[..., :-1] = ts_pfb
         ts_pfb = pts2
 
-    # Inverse fourier transform to get the pseudo-timestream
-    pseudo_ts = np.fft.irfft(ts_pfb, axis=-1)
-
-    # Transpose timestream
-    pseudo_ts = pseudo_ts.T.copy()
+    # Inverse fourier transform to get the pseudo-timestream, (nblock, lblock)
+    pseudo_ts = scipy.fft.irfft(ts_pfb, axis=-1, workers=-1)
 
     # Pull out the number of blocks and their length
-    lblock, nblock = pseudo_ts.shape
+    nblock, lblock = pseudo_ts.shape
     ntsblock = nblock + ntap - 1
 
-    # Coefficients for the P matrix
-    # Create the window array.
-    coeff_P = window(ntap, lblock).reshape(ntap, lblock)
-
-    # Coefficients for the PP^T matrix
-    coeff_PPT = np.array([(coeff_P[:, np.newaxis, :] *
-                           coeff_P[np.newaxis, :, :])
-                          .diagonal(offset=k).sum(axis=-1)
-                          for k in range(ntap)])
+    coeff_P, coeff_PPT = get_ppt_coeffs(ntap, lblock, window)
+    if chol is None:
+        chol = get_pfb_cholesky(ntap, lblock, nblock, window)
+    L, start, nrow = chol
 
-    rec_ts = np.zeros((lblock, ntsblock), dtype=np.float64)
+    rec_ts = np.zeros((ntsblock, lblock), dtype=np.float64)
+    nthreads_old = nb.get_num_threads()
+    if nthreads is not None:
+        nb.set_num_threads(min(nthreads, nb.config.NUMBA_NUM_THREADS))
+    try:
+        _band_cholesky_solve_project(L, start, nrow, np.ascontiguousarray(coeff_P), pseudo_ts, rec_ts, 128)
+    finally:
+        nb.set_num_threads(nthreads_old)
 
-    for i_off in range(lblock):
-
-        # Create band matrix representation of P
-        band_P = np.zeros((ntap, ntsblock), dtype=np.float64)
-        band_P[:] = coeff_P[::-1, i_off, np.newaxis]
-
-        # Create band matrix representation of PP^T (symmetric)
-        band_PPT = np.zeros((ntap, nblock), dtype=np.float64)
-        band_PPT[:] = coeff_PPT[::-1, i_off, np.newaxis]
+    return rec_ts
 
-        # Solve for intermediate vector
-        yh = la.solveh_banded(band_PPT, pseudo_ts[i_off])
 
-        # Project into timestream estimate
-        rec_ts[i_off] = band_mv(band_P, 0, 3, ntsblock, nblock, yh, trans=True)
+class StreamingInversePFB():
+    """Inverse PFB of an arbitrarily long PFB timestream pushed in chunks.
 
-    # Transpose timestream back
-    rec_ts = rec_ts.T.copy()
+    The inverse of a finite chunk is wrong near its edges, so every chunk is inverted together with
+    nover spectra of context on each side and only the middle is returned. The last 2*nover spectra
+    are carried over to the next chunk, so for PFB output the result is the same (to ~1e-4 of the rms for nover=1024)
+    as inverting the whole timestream at once, in memory that only depends on the chunk size.
+    Output is delayed by nover blocks; call flush() at the end to get the rest.
+    """
 
-    return rec_ts
+    def __init__(self, nfreq, ntap=4, nover=1024, window=sinc_hamming, nthreads=None):
+        self.nfreq = nfreq
+        self.lblock = 2 * (nfreq - 1)
+        self.ntap = ntap
+        self.nover = nover
+        self.window = window
+        self.nthreads = nthreads
+        self.buf = np.zeros((0, nfreq), dtype=np.complex128)
+        self.first = True
+
+    def _invert(self, nkeep):
+        # invert the buffer and keep its last nkeep spectra for the next chunk
+        rec = inverse_pfb(self.buf, self.ntap, self.window, nthreads=self.nthreads)
+        self.first = False
+        self.buf = self.buf[len(self.buf) - nkeep:].copy()
+        return rec
+
+    def push(self, spec):
+        """Add spectra (nspec, nfreq). Returns the timestream that is now final (may be empty)."""
+        self.buf = np.concatenate([self.buf, spec])
+        n = len(self.buf)
+        if n <= 2 * self.nover:
+            return np.zeros(0)
+        start = 0 if self.first else self.nover
+        rec = self._invert(2 * self.nover)
+        return rec[start:n - self.nover].ravel()
+
+    def flush(self):
+        """Timestream left in the buffer, up to the end of the last pushed spectrum's taps."""
+        if len(self.buf) == 0 or (not self.first and len(self.buf) <= self.nover):
+            return np.zeros(0)
+        start = 0 if self.first else self.nover
+        rec = self._invert(0)
+        return rec[start:].ravel()
@@ -5,16 +5,19 @@ if os.environ.get('DISPLAY','') == '':
     mpl.use('Agg')
 from matplotlib import pyplot as plt
 import numpy as np
-import datetime, time, re
+import datetime, time, re, json, shutil
 from scio import scio
 import SNAPfiletools as sft
 import argparse
 from datetime import datetime
 import matplotlib.dates as mdates
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 import pytz
 import skyfield.api as sf
+from utils import direct_cache
+from utils.stats_utils import QuantileSketch
 
 
 def get_ts_from_name(f):
@@ -30,8 +33,7 @@ def get_binned(fname,data_dir,coords,ctime_start,ctime_stop,nbins):
     # data_dir='/project/s/sievers/albatros/marion/albatros-hydroshack/data_auto_cross/'
     data_subdirs = sft.time2fnames(ctime_start, ctime_stop, data_dir)
     data_subdirs.sort()
-    new_dirs = [d+f'/{fname}.scio.bz2' for d in data_subdirs]
-    datpol00 = scio.read_files(new_dirs)
+    datpol00 = sft.read_direct_parallel(data_subdirs, [fname])[fname]
     print("Files of ",fname, "read")
     # print(data_subdirs)
     # data_subdirs = ['/home/mohan/Projects/direct/16272/1627202093']
@@ -70,6 +72,323 @@ def get_binned(fname,data_dir,coords,ctime_start,ctime_stop,nbins):
             st=en
     return binned
 
+LST_PRODUCTS = ['pol00','pol11','pol01r','pol01i']
+SKETCH_PRODUCTS = ['pol00','pol11']
+SKETCH_ALPHA = 0.02
+SKETCH_MAX_BINS = 256
+SKETCH_BLOCK = 16 # LST bins merged at a time, at most 16*2048*256 int32 per store
+MAX_PARTS = 10
+
+def get_lst_bins(tstamp, nrows, earth_loc, ts, nbins, chunk_time=6.44):
+    '''
+    LST bin of every row of a direct data file starting at tstamp.
+    '''
+    mytstamps = tstamp+np.arange(0,nrows)*chunk_time
+    myjds = mytstamps/86400 + 2440587.5
+    lsthrs = earth_loc.lst_hours_at(ts.ut1_jd(myjds))
+    return np.minimum(np.floor(lsthrs/(24/nbins)).astype(int), nbins-1)
+
+def _load_npy(fname):
+    try:
+        return np.load(fname, mmap_mode='r')
+    except ValueError:
+        # empty arrays can't be memory-mapped
+        return np.load(fname)
+
+def _load_part(path, product):
+    # (bins, sketch dict) of a part written by LSTAccumulator.save, memory-mapped
+    d = {f[len(product)+1:-4]:_load_npy(os.path.join(path, f)) for f in os.listdir(path) if f.startswith(product+'_')}
+    return d.pop('bins'), d
+
+class LSTAccumulator():
+    '''
+    Running per-LST-bin sums, counts and median sketches.
+
+    Holds the bins listed in bins (all nbins by default). A partial accumulator for a single file only holds the
+    few bins that file touches, and merge() adds it into the full one, so files can be binned by different
+    workers in any order. Sums and counts of all products are exact. Medians of sketch_products (the autos by
+    default) come from QuantileSketches with one channel per (bin, channel), within alpha (relative) of the true
+    one unless it folded (see QuantileSketch._refold). Signed cross medians can sit in a folded tail and their
+    sketches are nearly all max_bins wide, so by default the crosses only get means.
+
+    The sketches of all nbins*nchan channels are never held at once. Merged partials are kept as they are
+    (ragged, see QuantileSketch.to_dict) until save() writes them as a new part, and reduce() merges the parts
+    and partials SKETCH_BLOCK bins at a time.
+    '''
+    def __init__(self, nbins, nchan=2048, products=LST_PRODUCTS, bins=None, sketch_products=SKETCH_PRODUCTS,
+            alpha=SKETCH_ALPHA, max_bins=SKETCH_MAX_BINS):
+        self.nbins = nbins
+        self.nchan = nchan
+        self.products = list(products)
+        self.bins = np.arange(nbins) if bins is None else np.asarray(bins)
+        nb = len(self.bins)
+        self.sums = {p:np.zeros((nb,nchan)) for p in self.products}
+        self.counts = {p:np.zeros(nb, dtype='int64') for p in self.products}
+        self.sketch_products = [p for p in sketch_products if p in self.products]
+        self.alpha = alpha
+        self.max_bins = max_bins
+        self.sketches = {} # sketches of the rows add()ed here, made on first use
+        self.pending = {p:[] for p in self.sketch_products} # (bins, sketch dict) of merged partials, not saved yet
+        self.parts = [] # part directories written by save()
+        self.dirs = [] # directories that went in, for incremental updates
+
+    def add(self, product, lstbins, arr):
+        '''
+        Add rows of arr (nrows, nchan) to the bins in lstbins (nrows,). The bins have to be held by this accumulator.
+        '''
+        loc = np.searchsorted(self.bins, lstbins)
+        # rows come in runs of the same bin, sum each run in one go
+        starts = np.concatenate([[0], np.where(np.diff(loc)!=0)[0]+1])
+        np.add.at(self.sums[product], loc[starts], np.add.reduceat(arr, starts, axis=0))
+        np.add.at(self.counts[product], loc[starts], np.diff(np.append(starts, len(loc))))
+        if(product in self.sketch_products):
+            if(product not in self.sketches):
+                self.sketches[product] = QuantileSketch(len(self.bins)*self.nchan, self.alpha, self.max_bins, 'int32')
+            self.sketches[product].update(arr, groups=loc)
+
+    def merge(self, other):
+        '''
+        Add a (partial) accumulator of the same nbins, nchan and sketch settings. Returns self.
+        '''
+        if(other.nchan!=self.nchan):
+            raise ValueError(f"merged accumulator has {other.nchan} channels instead of {self.nchan}")
+        if(other.sketch_products!=self.sketch_products or other.alpha!=self.alpha or other.max_bins!=self.max_bins):
+            raise ValueError("merged accumulator has different sketch settings")
+        loc = np.searchsorted(self.bins, other.bins)
+        if(np.any(self.bins[np.minimum(loc, len(self.bins)-1)]!=other.bins)):
+            raise ValueError("merged accumulator has bins this one doesn't hold")
+        for p in other.products:
+            self.sums[p][loc] += other.sums[p]
+            self.counts[p][loc] += other.counts[p]
+        for p in self.sketch_products:
+            self.pending[p] += other._sources(p, parts=False)
+        self.parts += other.parts
+        self.dirs += other.dirs
+        return self
+
+    def _sources(self, product, parts=True):
+        # (bins, sketch dict) of everything that went into product: saved parts, merged partials and rows added here
+        out = [_load_part(path, product) for path in self.parts] if parts else []
+        out += self.pending[product]
+        if(product in self.sketches):
+            out.append((self.bins, self.sketches[product].to_dict()))
+        return out
+
+    def _blocks(self):
+        return [self.bins[i:i+SKETCH_BLOCK] for i in range(0, len(self.bins), SKETCH_BLOCK)]
+
+    def get_sketch(self, product, bins, sources=None):
+        '''
+        QuantileSketch of product in the given (sorted) bins, channel i*nchan+c for channel c of bins[i], merged
+        from everything that went in (or from sources, see _sources).
+        '''
+        sources = self._sources(product) if sources is None else sources
+        sk = QuantileSketch(len(bins)*self.nchan, self.alpha, self.max_bins, 'int32')
+        for sbins, d in sources:
+            common, isrc, idst = np.intersect1d(sbins, bins, return_indices=True)
+            if(len(common)==0):
+                continue
+            rows = (isrc[:,None]*self.nchan + np.arange(self.nchan)).ravel()
+            sk.merge(QuantileSketch.from_dict(d, rows), chans=(idst[:,None]*self.nchan + np.arange(self.nchan)).ravel())
+        return sk
+
+    def _write_part(self, partdir, parts=False):
+        # merge what went in since the last save (everything with parts=True) block by block, and write it ragged
+        # as one new part of .npy files. Returns its path.
+        path = os.path.join(partdir, f"{time.time_ns()}_{os.getpid()}")
+        tmp = path + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for p in self.sketch_products:
+            sources = self._sources(p, parts)
+            blocks = [self.get_sketch(p, b, sources).to_dict() for b in self._blocks()]
+            shift = np.cumsum([0]+[len(b['pos']) for b in blocks[:-1]])
+            has_neg = any(len(b['neg'])>0 for b in blocks)
+            out = {'bins':self.bins, 'alpha':self.alpha, 'max_bins':self.max_bins,
+                'off':np.concatenate([[0]]+[b['off'][1:]+s for b, s in zip(blocks, shift)]),
+                'neg':np.concatenate([b['neg'] if len(b['neg'])>0 else np.zeros_like(b['pos']) for b in blocks]) if has_neg\
+                    else np.zeros(0, dtype='int32')}
+            for k in ('kmin','kmax','collapsed','pos','zero','count','sum','min','max'):
+                out[k] = np.concatenate([b[k] for b in blocks])
+            for k, v in out.items():
+                np.save(os.path.join(tmp, f"{p}_{k}.npy"), v)
+        os.replace(tmp, path)
+        return path
+
+    def save(self, fname, compact=False, **meta):
+        '''
+        Write sums, counts, ingested dirs and meta (e.g. coords) to fname (.npz), and the sketches merged since the
+        last save as a new part in fname.parts/, so an update only writes what it added and a small .npz. With
+        compact, or once there are MAX_PARTS parts, all parts are merged into one instead.
+        The part is written first and the .npz goes through a temp file, so an interrupted update leaves the old
+        state intact. Parts the .npz doesn't list (merged, or left by an interrupted update) are removed.
+        '''
+        partdir = fname + '.parts'
+        parts = list(self.parts)
+        compact = compact or len(parts)>=MAX_PARTS
+        new = any(self.pending[p] or p in self.sketches for p in self.sketch_products)
+        if(new or (compact and len(parts)>1)):
+            parts = ([] if compact else parts) + [self._write_part(partdir, parts=compact)]
+        # parts in partdir are listed by name, so the accumulator can be moved with them
+        names = [os.path.basename(path) if os.path.dirname(os.path.abspath(path))==os.path.abspath(partdir) else os.path.abspath(path)
+            for path in parts]
+        arrs = {'bins':self.bins, 'products':np.array(self.products), 'dirs':np.array(self.dirs, dtype=str),
+            'meta':json.dumps(dict(meta, nbins=self.nbins, nchan=self.nchan, sketch_products=self.sketch_products,
+                alpha=self.alpha, max_bins=self.max_bins, parts=names))}
+        for p in self.products:
+            arrs[f'{p}_sums'] = self.sums[p]
+            arrs[f'{p}_counts'] = self.counts[p]
+        tmp = f"{fname}.{os.getpid()}.tmp.npz"
+        np.savez(tmp, **arrs)
+        os.replace(tmp, fname)
+        if(os.path.isdir(partdir)):
+            for name in set(os.listdir(partdir))-set(names):
+                shutil.rmtree(os.path.join(partdir, name), ignore_errors=True)
+        self.parts = [os.path.join(partdir, n) for n in names]
+        self.pending = {p:[] for p in self.sketch_products}
+        self.sketches = {}
+
+    @classmethod
+    def load(cls, fname, **expected):
+        '''
+        Read an accumulator written by save(). Returns (accumulator, meta dict). The parts stay on disk.
+        Keyword arguments are checked against the saved meta (e.g. nbins, chunk_time, alpha), so data binned with
+        different settings isn't added to it by mistake.
+        '''
+        with np.load(fname) as f:
+            meta = json.loads(str(f['meta']))
+            for key, val in expected.items():
+                if(key not in meta or not np.allclose(meta[key], val)):
+                    raise ValueError(f"{fname} was made with {key}={meta.get(key)}, expected {val}")
+            products = list(f['products'])
+            # files from before the parts kept one dense sketch of every product in the .npz
+            old = [p for p in products if f'{p}_sketch_pos' in f.files]
+            acc = cls(meta['nbins'], meta['nchan'], products, bins=f['bins'], sketch_products=meta.get('sketch_products', old),
+                alpha=meta.get('alpha', SKETCH_ALPHA), max_bins=meta.get('max_bins', SKETCH_MAX_BINS))
+            for p in products:
+                acc.sums[p] = f[f'{p}_sums']
+                acc.counts[p] = f[f'{p}_counts']
+            for p in old:
+                acc.pending[p].append((acc.bins, {k[len(p)+8:]:f[k] for k in f.files if k.startswith(f'{p}_sketch_')}))
+            acc.parts = [os.path.join(fname + '.parts', n) for n in meta.get('parts', [])] # absolute names stay as they are
+            acc.dirs = list(f['dirs'])
+        return acc, meta
+
+    def reduce(self, product):
+        '''
+        Same output as reduce_binned: counts, mean and median (NaN for products without sketches) of every bin.
+        '''
+        counts = self.counts[product]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bmean = np.where(counts[:,None]>0, self.sums[product]/counts[:,None], 0)
+        if(product in self.sketch_products):
+            sources = self._sources(product)
+            bmedian = np.concatenate([self.get_sketch(product, b, sources).median().reshape(-1, self.nchan) for b in self._blocks()])
+            bmedian = np.nan_to_num(bmedian)
+        else:
+            bmedian = np.full(bmean.shape, np.nan)
+        return {'counts':counts.astype(float),'mean':bmean,'median':bmedian}
+
+def bin_directory(d, earth_loc, ts, nbins, products=LST_PRODUCTS, chunk_time=6.44, pool=None, **kwargs):
+    '''
+    Partial LSTAccumulator of one direct data directory. Reads it once (through direct_cache) for all products.
+    pool: executor the files are decompressed in, see direct_cache.get_direct.
+    Returns None if none of the products could be read.
+    '''
+    dat = direct_cache.get_direct(d, do_evict=False, products=products, pool=pool)
+    arrs = {p:dat[p] for p in products if dat[p] is not None and len(dat[p])>0}
+    if(len(arrs)==0):
+        print("YO WTF, READ", d)
+        return None
+    nrows = max(len(arr) for arr in arrs.values())
+    lstbins = get_lst_bins(get_ts_from_name(d), nrows, earth_loc, ts, nbins, chunk_time)
+    nchan = next(iter(arrs.values())).shape[1]
+    acc = LSTAccumulator(nbins, nchan, products, bins=np.unique(lstbins), **kwargs)
+    for p, arr in arrs.items():
+        acc.add(p, lstbins[:len(arr)], np.asarray(arr))
+    acc.dirs.append(os.path.abspath(d))
+    return acc
+
+def get_binned_all(data_dir, coords, ctime_start, ctime_stop, nbins, nchan=2048, products=LST_PRODUCTS, nthreads=None,
+        chunk_time=6.44, acc=None, settle=0, **kwargs):
+    '''
+    LST-bin all products of all direct data directories between ctime_start and ctime_stop.
+    Every directory is read once and binned into a small partial accumulator by a worker thread, and the partials
+    are merged into one LSTAccumulator (acc, or a new one made with kwargs) as they come in.
+    Directories already in acc.dirs are skipped, so an accumulator loaded from disk only ingests new ones, and
+    directories that started less than settle seconds ago are left for later since they may still be written to.
+    '''
+    data_subdirs = sft.time2fnames(ctime_start, ctime_stop, data_dir)
+    data_subdirs.sort()
+    if(acc is None):
+        acc = LSTAccumulator(nbins, nchan, products, **kwargs)
+    # partials are made with the settings of acc, so they can be merged into it
+    kwargs = {'sketch_products':acc.sketch_products, 'alpha':acc.alpha, 'max_bins':acc.max_bins}
+    done = set(acc.dirs)
+    data_subdirs = [d for d in data_subdirs if os.path.abspath(d) not in done and get_ts_from_name(d) < time.time()-settle]
+    print(len(data_subdirs), "new directories to bin,", len(done), "already in")
+    ts=sf.load.timescale()
+    earth_loc = sf.wgs84.latlon(*coords)
+    nthreads = nthreads or os.cpu_count()
+    with ThreadPoolExecutor(nthreads) as ex, ThreadPoolExecutor(nthreads) as decomp:
+        partials = ex.map(lambda d: bin_directory(d, earth_loc, ts, nbins, products, chunk_time, decomp, **kwargs), data_subdirs)
+        for i, part in enumerate(partials):
+            if(i%10==0):
+                print(i+1,"files read.File timestamp is ", get_ts_from_name(data_subdirs[i]))
+            if(part is not None):
+                acc.merge(part)
+    direct_cache.evict(keep=[direct_cache.get_entry_path(d) for d in data_subdirs])
+    return acc
+
+def plot_lst(stats, nbins, plot_type, sttime, entime, output_path, cross_type=None):
+    # cross_type: what to plot for pol01, e.g. the mean when its medians weren't sketched
+    cross_type = cross_type or plot_type
+    pol01 =stats['pol01r'][cross_type] + 1J*stats['pol01i'][cross_type]
+
+    plt.figure()
+    f=plt.gcf()
+    f.set_size_inches(15,15)
+    
+    plt.suptitle(f'Plotting from: {sttime} to {entime}, plot type: {plot_type}')
+    myext=[0, 125, 24, 0]
+    plt.subplot(321)
+    plt.title("Pol00")
+    plt.imshow(np.log10(stats['pol00'][plot_type]),vmin=7,vmax=8.2,extent=myext,aspect='auto')
+    plt.colorbar()
+
+    plt.subplot(323)
+    plt.title("Pol11")
+    plt.imshow(np.log10(stats['pol11'][plot_type]),vmin=7,vmax=8.2,extent=myext,aspect='auto')
+    plt.colorbar()
+    
+    plt.subplot(322)
+    plt.title(f"Pol01 mag ({cross_type})")
+    plt.imshow(np.log10(np.abs(pol01)),vmin=3,vmax=8,extent=myext,aspect='auto')
+    plt.colorbar()
+
+    plt.subplot(324)
+    plt.title(f"Pol01 phase ({cross_type})")
+    plt.imshow(np.angle(pol01),extent=myext,aspect='auto',cmap='RdBu')
+    plt.colorbar()
+
+    plt.subplot(313)
+    plt.title('bin count')
+    plt.plot(np.arange(0,nbins),stats['pol00']['counts'])
+
+    plt.savefig(output_path)
+    plt.close()
+    print(output_path)
+
+def save_lst_npz(stats, output_path):
+    statsp00, statsp11, statsp01r, statsp01i = stats['pol00'], stats['pol11'], stats['pol01r'], stats['pol01i']
+    np.savez_compressed(output_path,\
+                        p00mean=statsp00['mean'],p00median=statsp00['median'],\
+                        p11mean=statsp11['mean'],p11median=statsp11['median'],\
+                        p01rmean=statsp01r['mean'],p01rmedian=statsp01r['median'],\
+                        p01imean=statsp01i['mean'],p01imedian=statsp01i['median'],
+                        counts=statsp00['counts'])
+    print(output_path)
+
 # def myredux(xx):
 #     u=np.percentile(xx,99)
 #     b=np.percentile(xx,1)
@@ -117,84 +436,63 @@ def reduce_binned_parallel(binned,nbins,nchan):
 
 if __name__ == '__main__':
 
-    loc='uapishka'
-    ctime_start= 1661011607
-    ctime_stop = 1666620593
-    mytz=pytz.timezone('US/Eastern')
-    nbins = 720 # 2 minute bins 
-    coords = [51.4641932, -68.2348603,300]
-    data_dir = '/project/s/sievers/mohanagr/uapishka_aug_oct_2022/data_auto_cross/'
+    parser = argparse.ArgumentParser(description="LST-bin direct data. With an accumulator file only new directories are read and the outputs are regenerated from it.")
+    parser.add_argument('-d', '--data_dir', type=str, default='/project/s/sievers/mohanagr/uapishka_aug_oct_2022/data_auto_cross/', help='Direct data directory')
+    parser.add_argument('-s', '--time_start', type=int, default=1661011607, help='Start ctime')
+    parser.add_argument('-e', '--time_stop', type=int, default=1666620593, help='Stop ctime. 0 means now.')
+    parser.add_argument('-n', '--nbins', type=int, default=720, help='Number of LST bins. 720 is 2 minute bins.')
+    parser.add_argument('-c', '--coords', type=float, nargs=3, default=[51.4641932, -68.2348603,300], help='lat lon elevation')
+    parser.add_argument('-l', '--loc', type=str, default='uapishka', help='Site name for output files')
+    parser.add_argument('-z', '--timezone', type=str, default='US/Eastern', help='Timezone for the plot title')
+    parser.add_argument('-p', '--plot_type', type=str, default='median', choices=['median','mean'])
+    parser.add_argument('-o', '--outdir', type=str, default='/project/s/sievers/mohanagr/', help='Output directory')
+    parser.add_argument('-j', '--nthreads', type=int, default=None, help='Directories binned at a time')
+    parser.add_argument('-a', '--accfile', type=str, default=None, help='Persistent accumulator (.npz). Created if missing, updated with new directories otherwise. '\
+        'Every update writes the median sketches of the new data as a new part in <accfile>.parts/ (about 200 MB per product for a night at 720 bins '\
+        'and 2048 channels) and rewrites the .npz of sums and counts (about 50 MB). Parts are merged into one with --compact or once there are %d.' % MAX_PARTS)
+    parser.add_argument('--compact', action='store_true', help='With -a, merge the parts of the accumulator into one')
+    parser.add_argument('-m', '--median_products', type=str, nargs='*', default=SKETCH_PRODUCTS, choices=LST_PRODUCTS,
+        help='Products that get median sketches (a new accumulator only). Crosses without them are plotted from the mean.')
+    parser.add_argument('-t', '--chunk_time', type=float, default=6.44, help='Time per row of the direct data in seconds')
+    parser.add_argument('--settle', type=float, default=7200, help='With -a, skip directories younger than this many seconds')
+    args = parser.parse_args()
 
-    plot_type = 'median'
-    
-    sttime=get_localtime_from_UTC(ctime_start,mytz).strftime("%b-%d %H:%M")
-    entime=get_localtime_from_UTC(ctime_stop,mytz).strftime("%b-%d %H:%M")
+    loc=args.loc
+    ctime_start= args.time_start
+    ctime_stop = args.time_stop or int(time.time())
+    mytz=pytz.timezone(args.timezone)
+    nbins = args.nbins
+    coords = args.coords
+    data_dir = args.data_dir
+    plot_type = args.plot_type
+
+    acc=None
+    settle=0
+    meta={'coords':coords, 'data_dir':os.path.abspath(data_dir), 'chunk_time':args.chunk_time}
+    if(args.accfile):
+        settle=args.settle
+        if(os.path.exists(args.accfile)):
+            acc, oldmeta = LSTAccumulator.load(args.accfile, nbins=nbins, coords=coords, chunk_time=args.chunk_time,\
+                alpha=SKETCH_ALPHA, max_bins=SKETCH_MAX_BINS)
 
     t1=time.time()
-    binned=get_binned('pol00',data_dir,coords,ctime_start,ctime_stop,nbins)
+    acc=get_binned_all(data_dir,coords,ctime_start,ctime_stop,nbins,nthreads=args.nthreads,chunk_time=args.chunk_time,acc=acc,settle=settle,\
+        sketch_products=args.median_products)
     t2=time.time()
     print("time taken for binning",t2-t1)
-    t1=time.time()
-    statsp00=reduce_binned(binned,nbins,2048)
-    t2=time.time()
-    print("time taken for reduction",t2-t1)
-
-    binned=get_binned('pol11',data_dir,coords,ctime_start,ctime_stop,nbins)
-    statsp11=reduce_binned(binned,nbins,2048)
-    print("Done pol11")
-    binned=get_binned('pol01r',data_dir,coords,ctime_start,ctime_stop,nbins)
-    statsp01r=reduce_binned(binned,nbins,2048)
-    print("Done pol01r")
-    binned=get_binned('pol01i',data_dir,coords,ctime_start,ctime_stop,nbins)
-    statsp01i=reduce_binned(binned,nbins,2048)
-    print("Done pol01i")
-    pol01 =statsp01r[plot_type] + 1J*statsp01i[plot_type]
-
-    f=plt.gcf()
-    f.set_size_inches(15,15)
-    
-    plt.suptitle(f'Plotting from: {sttime} to {entime}, plot type: {plot_type}')
-    myext=[0, 125, 24, 0]
-    plt.subplot(321)
-    plt.title("Pol00")
-    plt.imshow(np.log10(statsp00[plot_type]),vmin=7,vmax=8.2,extent=myext,aspect='auto')
-    plt.colorbar()
-
-    plt.subplot(323)
-    plt.title("Pol11")
-    plt.imshow(np.log10(statsp11[plot_type]),vmin=7,vmax=8.2,extent=myext,aspect='auto')
-    plt.colorbar()
-    
-    plt.subplot(322)
-    plt.title("Pol01 mag")
-    plt.imshow(np.log10(np.abs(pol01)),vmin=3,vmax=8,extent=myext,aspect='auto')
-    plt.colorbar()
-
-    plt.subplot(324)
-    plt.title("Pol01 phase")
-    plt.imshow(np.angle(pol01),extent=myext,aspect='auto',cmap='RdBu')
-    plt.colorbar()
-
-    plt.subplot(313)
-    plt.title('bin count')
-    plt.plot(np.arange(0,nbins),statsp00['counts'])
-
-    output_path = f'/project/s/sievers/mohanagr/lst_{nbins}_{plot_type}_{ctime_start}_{ctime_stop}_{loc}.png'
-    plt.savefig(output_path)
-    print(output_path)
-    
-    output_path = f'/project/s/sievers/mohanagr/lst_{nbins}_{ctime_start}_{ctime_stop}_{loc}.npz'
-    np.savez_compressed(output_path,\
-                        p00mean=statsp00['mean'],p00median=statsp00['median'],\
-                        p11mean=statsp11['mean'],p11median=statsp11['median'],\
-                        p01rmean=statsp01r['mean'],p01rmedian=statsp01r['median'],\
-                        p01imean=statsp01i['mean'],p01imedian=statsp01i['median'],
-                        counts=statsp00['counts'])
-    
-
-
-        
-
-        
+    if(args.accfile):
+        acc.save(args.accfile, compact=args.compact, **meta)
+        print("saved", args.accfile, "with", len(acc.dirs), "directories")
+        if(len(acc.dirs)>0):
+            # name the outputs after the data that's actually in
+            dir_ts = [get_ts_from_name(d) for d in acc.dirs]
+            ctime_start, ctime_stop = min(dir_ts), max(dir_ts)
+    stats={p:acc.reduce(p) for p in LST_PRODUCTS}
+    print("time taken for reduction",time.time()-t2)
 
+    sttime=get_localtime_from_UTC(ctime_start,mytz).strftime("%b-%d %H:%M")
+    entime=get_localtime_from_UTC(ctime_stop,mytz).strftime("%b-%d %H:%M")
 
+    cross_type = plot_type if 'pol01r' in acc.sketch_products else 'mean'
+    plot_lst(stats, nbins, plot_type, sttime, entime, os.path.join(args.outdir, f'lst_{nbins}_{plot_type}_{ctime_start}_{ctime_stop}_{loc}.png'), cross_type)
+    save_lst_npz(stats, os.path.join(args.outdir, f'lst_{nbins}_{ctime_start}_{ctime_stop}_{loc}.npz'))
@@ -2,6 +2,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pytz
 from datetime import datetime
+from utils import stats_utils
 
 def get_localtime_from_UTC(tstamp, mytz):
     return datetime.fromtimestamp(int(tstamp),tz=pytz.utc).astimezone(tz=mytz)
@@ -11,13 +12,9 @@ def get_vmin_vmax(data_arr,log=True):
     Automatically gets vmin and vmax for colorbar
     '''
     # print("shape of passed array", data_arr.shape, data_arr.dtype)
-    xx=data_arr.copy()
-    med = np.percentile(xx,50)
+    # std of the entries between the 1st and 99th percentile, to remove some outliers for better plotting
+    b, med, u, stddev = stats_utils.sketch_clipped_stats(data_arr)
     # print(med, "median")
-    u=np.percentile(xx,99)
-    b=np.percentile(xx,1)
-    xx_clean=xx[(xx<=u)&(xx>=b)] # remove some outliers for better plotting
-    stddev = np.std(xx_clean)
     vmin= max(med - 1*stddev,10**7)
     vmax = med + 1*stddev
     print(vmax,stddev)
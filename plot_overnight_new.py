@@ -8,10 +8,10 @@ import numpy as np
 import datetime, time, re
 from scio import scio
 import SNAPfiletools as sft
+from utils import direct_pyramid, stats_utils
 import argparse
 from datetime import datetime
 import matplotlib.dates as mdates
-from multiprocessing import Pool
 from functools import partial
 import pytz
 
@@ -23,7 +23,7 @@ def get_localtime_from_UTC(tstamp, mytz):
     return datetime.fromtimestamp(int(tstamp),tz=pytz.utc).astimezone(tz=mytz)
 
 #============================================================
-def get_data_arrs(data_dir, ctime_start, ctime_stop, chunk_time, blocklen, mytz):
+def get_data_arrs(data_dir, ctime_start, ctime_stop, chunk_time, blocklen, mytz, nthreads=None):
     '''
     Given the path to a Big data directory (i.e. directory contains the directories 
     labeled by the first 5 digits of the ctime date), gets all the data in some time interval.
@@ -37,6 +37,9 @@ def get_data_arrs(data_dir, ctime_start, ctime_stop, chunk_time, blocklen, mytz)
     ctime_start, ctime_stop: str
         desired start and stop time in ctime
 
+    nthreads: int
+        max number of files decompressed at the same time. Default number of cores.
+
     Returns:
     --------
 
@@ -62,72 +65,21 @@ def get_data_arrs(data_dir, ctime_start, ctime_stop, chunk_time, blocklen, mytz)
         sys.exit(1)
     
     
-    #rough estimate of number of rows we'll read
-    nrows_guess = len(data_subdirs)*((int(3600/chunk_time/blocklen)+1)+1)
-    # print("Starting with a guess of ", nrows_guess)
-    print("guessed rows", nrows_guess)
-    pol00 = np.zeros((nrows_guess+500,2048))
-
-    t1=time.time()
-    new_dirs = [d+'/pol00.scio.bz2' for d in data_subdirs]
-    datpol00 = scio.read_files(new_dirs)
-    new_dirs = [d+'/pol11.scio.bz2' for d in data_subdirs]
-    datpol11 = scio.read_files(new_dirs)
-    new_dirs = [d+'/pol01r.scio.bz2' for d in data_subdirs]
-    datpol01r = scio.read_files(new_dirs)
-    new_dirs = [d+'/pol01i.scio.bz2' for d in data_subdirs]
-    datpol01i = scio.read_files(new_dirs)
-    print(time.time()-t1, f"Read {len(data_subdirs)} files")
-
-    #average everything if blocklen>1
-    # print("first row must be in:", data_subdirs[0])
-
-    myavgfunc = partial(get_avg, block=blocklen)
-    if(blocklen>1):
-        t1=time.time()
-        with Pool(os.cpu_count()) as p:
-            avgpol00 = p.map(myavgfunc,datpol00)
-            avgpol11 = p.map(myavgfunc,datpol11)
-            avgpol01r = p.map(myavgfunc,datpol01r)
-            avgpol01i = p.map(myavgfunc,datpol01i)
-        print(time.time()-t1, "averaged everything")
-    else:
-        avgpol00 = datpol00
-        avgpol11 = datpol11
-        avgpol01r = datpol01r
-        avgpol01i = datpol01i
-
-    print(len(avgpol00))
+    # every thread decompresses one file and keeps only its block averaged rows
     t1=time.time()
-    tstart=0
-    tend=0
-    nrows=0
-    for i, d in enumerate(avgpol00):
-        # print("Mean, median are", np.mean(d,axis=0),np.median(d,axis=0))
-        print("working on",data_subdirs[i])
-        if(d is None):
-            continue
-        if(nrows==0):
-            # we are yet to read the first file
-            pol00[:d.shape[0]] = d
-            nrows+=d.shape[0]
-            ts = get_ts_from_name(data_subdirs[i])
-            tstart=ts #save starting time for user output
-            ts+=d.shape[0]*chunk_time*blocklen #end time of the current file, to be compared in next iteration
-            continue
-        newts = get_ts_from_name(data_subdirs[i]) #start time of the current file
-        diff=int((newts-ts)/chunk_time/blocklen) 
-        # each cell in the plot represents a minimum time of blocklen * chunktime. 
-        # That's the time resolution for the plot. Can't catch gaps < resolution.
-        if(diff>0):
-            print(f"significant diff b/w files {tstart} and {newts} of:", diff, "rows")
-            pol00[nrows:nrows+diff,:]=np.nan
-            pol00=np.append(pol00, np.zeros((diff,2048)), axis=0)
-            nrows+=diff
-        pol00[nrows:nrows+d.shape[0],:]=d
-        nrows+=d.shape[0]
-        ts=newts+d.shape[0]*chunk_time*blocklen #end time of the current file
-    tend=ts
+    myavgfunc = partial(get_avg, block=blocklen) if blocklen>1 else None
+    dat = sft.read_direct_parallel(data_subdirs, nthreads=nthreads, reduce=myavgfunc)
+    avgpol00, avgpol11, avgpol01r, avgpol01i = [dat[p] for p in sft.DIRECT_PRODUCTS]
+    del dat
+    print(time.time()-t1, f"Read and averaged {len(data_subdirs)} files")
+
+    # layout comes from pol00, every product goes to the same rows. one allocation per product.
+    tstamps = [get_ts_from_name(d) for d in data_subdirs]
+    nrows_file = [0 if d is None else d.shape[0] for d in avgpol00]
+    starts, nrows, tstart, tend = sft.get_gap_layout(tstamps, nrows_file, chunk_time*blocklen)
+    if(nrows==0):
+        print("NOTHING WAS READ. CHECK TSTAMPS")
+        sys.exit(1)
 
     print("############################################################")
     print(f"First file at: {get_ts_from_name(data_subdirs[0])}, Last file at: {get_ts_from_name(data_subdirs[-1])}")
@@ -135,48 +87,44 @@ def get_data_arrs(data_dir, ctime_start, ctime_stop, chunk_time, blocklen, mytz)
     ts,te= list(map(partial(get_localtime_from_UTC,mytz=mytz), [tstart, tend]))
     print(f"In Local time: {ts.strftime('%b-%d %H:%M:%S')} to {te.strftime('%b-%d %H:%M:%S')} in {mytz.zone}")
     print("Final nrows:", nrows)
+    nchan = [d.shape[1] for d in avgpol00 if d is not None][0]
 
-    pol00 = pol00[:nrows].copy()
-    # print(pol00.shape)
-    #once we have pol00, we know the exact size. use it
-    pol11 = np.zeros((nrows,2048))
-    pol01r = np.zeros((nrows,2048))
-    pol01i = np.zeros((nrows,2048))
-    
-    nrows=0
-    for i in range(len(avgpol00)):
-        if((avgpol11[i] is None) or (avgpol01i[i] is None) or (avgpol01r[i] is None)):
-            continue
-        if(nrows==0):
-            r=avgpol11[i].shape[0]
-            pol11[:r,:]=avgpol11[i]
-            pol01r[:r,:]=avgpol01r[i]
-            pol01i[:r,:]=avgpol01i[i]
-            nrows+=r
-            ts=get_ts_from_name(data_subdirs[i])+r*chunk_time*blocklen
-            continue
-        newts = get_ts_from_name(data_subdirs[i])
-        diff=int((newts-ts)/chunk_time/blocklen)
-        if(diff>0):
-            pol11[nrows:nrows+diff,:]=np.nan
-            pol01r[nrows:nrows+diff,:]=np.nan
-            pol01i[nrows:nrows+diff,:]=np.nan
-            nrows+=diff
-        r=avgpol11[i].shape[0]
-        pol11[nrows:nrows+r,:]=avgpol11[i]
-        pol01r[nrows:nrows+r,:]=avgpol01r[i]
-        pol01i[nrows:nrows+r,:]=avgpol01i[i]
-        nrows+=r
-        ts=newts+r*chunk_time*blocklen
+    t1=time.time()
+    pol00 = sft.assemble_blocks(avgpol00, starts, nrows_file, nrows, nchan)
+    del avgpol00
+    pol11 = sft.assemble_blocks(avgpol11, starts, nrows_file, nrows, nchan)
+    del avgpol11
+    pol01r = sft.assemble_blocks(avgpol01r, starts, nrows_file, nrows, nchan)
+    del avgpol01r
+    pol01i = sft.assemble_blocks(avgpol01i, starts, nrows_file, nrows, nchan)
+    del avgpol01i
     t2=time.time()
     # print('Time taken to concatenate data:',t2-t1)
-    # print("pol00, pol11,pol01r, pol01i shape:", pol00.shape,pol11.shape,pol01r.shape,pol01i.shape)
     pol00=np.ma.masked_invalid(pol00)
     pol11=np.ma.masked_invalid(pol11)
     pol01r=np.ma.masked_invalid(pol01r)
     pol01i=np.ma.masked_invalid(pol01i)
     return pol00, pol11, pol01r, pol01i, tstart, tend
 
+def get_pyramid_arrs(data_dir, ctime_start, ctime_stop, chunk_time, blocklen, nthreads=None, update=True):
+    '''
+    Same outputs as get_data_arrs, but averaged on the global time grid of width blocklen*chunk_time from the
+    coarsest level of the direct data time pyramid that divides blocklen. With update the pyramids are brought up
+    to date first, directories not in them (like the one still being written) are read from the raw data.
+    '''
+    print("\n################### READING PYRAMID ###################")
+    bins, res, count = direct_pyramid.get_binned(data_dir, ctime_start, ctime_stop, chunk_time, blocklen, nthreads=nthreads, update=update)
+    if(count is None or not np.any(count>0)):
+        print("NOTHING WAS READ. CHECK TSTAMPS")
+        sys.exit(1)
+    have = np.where(count>0)[0]
+    sl = slice(have[0], have[-1]+1)
+    print(f"Using pyramid level {direct_pyramid.get_level(blocklen)}, {len(have)} of {sl.stop-sl.start} rows have data")
+    pols = [np.ma.masked_invalid(res[p]['mean'][sl]) for p in direct_pyramid.PRODUCTS]
+    tstart = bins[sl.start]*blocklen*chunk_time
+    tend = bins[sl.stop-1]*blocklen*chunk_time + blocklen*chunk_time
+    return (*pols, tstart, tend)
+
 def get_avg(arr,block=10):
     '''
     Fast average array over a given block size. 
@@ -212,12 +160,9 @@ def get_stats(data_arr):
     # print("WHERE MEDIAN ZERO",np.where(np.median(data_arr,axis=0)==0))
     # print("MEDIAN",np.median(data_arr,axis=0))
     # print("MEDIAN MA",np.ma.median(data_arr,axis=0))
+    stats = stats_utils.channel_stats(data_arr) # one pass, masked entries ignored
     if logplot:
-        stats = {"min":np.log10(np.ma.min(data_arr,axis=0)), "median":np.log10(np.ma.median(data_arr,axis=0)), 
-                "mean":np.log10(np.ma.mean(data_arr,axis=0)), "max":np.log10(np.ma.max(data_arr,axis=0))}
-    else:
-        stats = {"min":np.ma.min(data_arr,axis=0), "median":np.ma.median(data_arr,axis=0), 
-                "mean":np.ma.mean(data_arr,axis=0), "max":np.ma.max(data_arr,axis=0)}
+        stats = {k:np.log10(v) for k, v in stats.items()}
     return stats
 
 def get_vmin_vmax(data_arr):
@@ -225,13 +170,10 @@ def get_vmin_vmax(data_arr):
     Automatically gets vmin and vmax for colorbar
     '''
     # print("shape of passed array", data_arr.shape, data_arr.dtype)
-    xx=data_arr[~data_arr.mask].data
-    med = np.percentile(xx,50)
+    # percentiles from a quantile sketch of the masked array and the std of the entries between the 1st and 99th
+    # percentile (to remove some outliers for better plotting), in chunks with no flattened copy
+    b, med, u, stddev = stats_utils.sketch_clipped_stats(data_arr)
     # print(med, "median")
-    u=np.percentile(xx,99)
-    b=np.percentile(xx,1)
-    xx_clean=xx[(xx<=u)&(xx>=b)] # remove some outliers for better plotting
-    stddev = np.std(xx_clean)
     vmin= max(med - 2*stddev,10**7)
     vmax = med + 2*stddev
     # print("vmin, vmax are", vmin, vmax)
@@ -269,10 +211,11 @@ def full_plot(data_arrs, mytz, chunk_time):
         pol11 = np.log10(pol11)
 
     if rescale:
-        scaling_pol00 = np.tile(pol00_stats['median'],pol00.shape[0]).reshape(*pol00.shape)
-        scaling_pol11 = np.tile(pol11_stats['median'],pol11.shape[0]).reshape(*pol11.shape)
-        pol00[:]=10*(pol00-scaling_pol00) # - instead of / for type 2 scaling: log(pol00/pol00_median)
-        pol11[:]=10*(pol11-scaling_pol11)
+        # medians broadcast along time, no tiled copies
+        pol00 -= pol00_stats['median'] # - instead of / for type 2 scaling: log(pol00/pol00_median)
+        pol00 *= 10
+        pol11 -= pol11_stats['median']
+        pol11 *= 10
         vmin=-1
         vmax=1
         vmin2=vmin
@@ -389,6 +332,9 @@ def main():
     parser.add_argument("-fmi", "--fmin", dest='fmin', default = None, type=float, help="minimum for frequency to plot")  
     parser.add_argument("-r", "--rescale", dest='rescale', default = False, action="store_true",help="Rescale autospectra using median power")
     parser.add_argument("-c", "--common", action="store_true", help="Common colorbar for both pols")
+    parser.add_argument("-y", "--pyramid", action="store_true", help="Average on a fixed time grid using the direct data time pyramid")
+    parser.add_argument("--no-update", dest='update', action="store_false", help="With -y, don't ingest new directories into the pyramids, read them from the raw data")
+    parser.add_argument("-j", "--nthreads", type=int, default=None, help="Max files decompressed at the same time. Default number of cores.")
     args = parser.parse_args()
 
     #=============== defining some global variables ===============#
@@ -425,7 +371,10 @@ def main():
     chunk_time = args.acclen*4096/250e6
 
     #================= reading data =================#
-    pol00,pol11,pol01r,pol01i, tstart, tend = get_data_arrs(args.data_dir, ctime_start, ctime_stop, chunk_time, args.blocksize, mytz)
+    if(args.pyramid):
+        pol00,pol11,pol01r,pol01i, tstart, tend = get_pyramid_arrs(args.data_dir, ctime_start, ctime_stop, chunk_time, args.blocksize, args.nthreads, args.update)
+    else:
+        pol00,pol11,pol01r,pol01i, tstart, tend = get_data_arrs(args.data_dir, ctime_start, ctime_stop, chunk_time, args.blocksize, mytz, args.nthreads)
     # import sys
     # sys.exit(0)
 
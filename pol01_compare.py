@@ -3,7 +3,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import argparse
 import os
-from utils import scio
+from utils import direct_cache
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser()
@@ -14,8 +14,6 @@ if __name__=="__main__":
     args = parser.parse_args()
 
 
-    pol01r = scio.read(os.path.join(args.direct_dir,'pol01r.scio.bz2'))
-    pol01i = scio.read(os.path.join(args.direct_dir,'pol01i.scio.bz2'))
     with np.load(args.bbfilepath) as npz:
         bbpol01 = np.ma.MaskedArray(npz['datap01'],npz['maskp01'])
         # bbpol01 = np.ma.MaskedArray(npz['data'],npz['mask'])
@@ -27,11 +25,14 @@ if __name__=="__main__":
     acclen = int(args.bbfilepath.split('/')[-1].split('_')[3])
     print("Inferred acclen: ", acclen)
 
+    # autos are only needed to normalize 1 bit data
+    dat = direct_cache.get_direct(args.direct_dir, products=['pol01'] if bitmode==4 else None)
+    pol01r, pol01i = dat['pol01r'], dat['pol01i']
+
     fig,ax=plt.subplots(3,2)
     fig.set_size_inches(10,12)
     if(bitmode==1):
-        pol00 = scio.read(os.path.join(args.direct_dir,'pol00.scio.bz2'))
-        pol11 = scio.read(os.path.join(args.direct_dir,'pol11.scio.bz2'))
+        pol00, pol11 = dat['pol00'], dat['pol11']
         norm=np.sqrt(pol11)*np.sqrt(pol00)
         pr=pol01r/norm
         pi=pol01i/norm
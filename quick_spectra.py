@@ -1,7 +1,7 @@
 import numpy as np
 import os
 import matplotlib.pyplot as plt
-from  scio import scio
+from utils import direct_cache, stats_utils
 import argparse
 import pytz
 import datetime as dt
@@ -31,13 +31,9 @@ def get_vmin_vmax(data_arr):
     Automatically gets vmin and vmax for colorbar
     '''
     # print("shape of passed array", data_arr.shape, data_arr.dtype)
-    xx=np.ravel(data_arr).copy()
-    med = np.percentile(xx,50)
+    # std of the entries between the 1st and 99th percentile, to remove some outliers for better plotting
+    b, med, u, stddev = stats_utils.sketch_clipped_stats(data_arr)
     # print(med, "median")
-    u=np.percentile(xx,99)
-    b=np.percentile(xx,1)
-    xx_clean=xx[(xx<=u)&(xx>=b)] # remove some outliers for better plotting
-    stddev = np.std(xx_clean)
     vmin= max(med - 2*stddev,10**7)
     vmax = med + 2*stddev
     if(vmin>vmax):
@@ -66,10 +62,8 @@ if __name__ == "__main__":
     #data_dir = pathlib.Path(args.data_dir)
     #output_dir = pathlib.Path(args.output_dir)
 
-    pol00 = scio.read(os.path.join(args.data_dir, "pol00.scio.bz2"))
-    pol11 = scio.read(os.path.join(args.data_dir, "pol11.scio.bz2"))
-    pol01r = scio.read(os.path.join(args.data_dir, "pol01r.scio.bz2"))
-    pol01i = scio.read(os.path.join(args.data_dir, "pol01i.scio.bz2"))
+    dat = direct_cache.get_direct(args.data_dir)
+    pol00, pol11, pol01r, pol01i = dat['pol00'], dat['pol11'], dat['pol01r'], dat['pol01i']
     acctime = get_acctime(os.path.join(args.data_dir, "time_gps_start.raw"))
 
     fmin, fmax = 0, 125
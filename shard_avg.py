@@ -0,0 +1,147 @@
+import numpy as np
+import json
+import os
+import sys
+import argparse
+from correlations import baseband_data_classes as bdc
+from utils import baseband_utils as butils
+import autocorravg
+
+def plan_shards(data_dir, time_start, time_stop, acclen, nchunks, nshards, chanstart=0, chanend=None):
+    '''
+    Split a run into nshards independent shards for autocorravg. Shard edges are always on chunk boundaries,
+    and are snapped to the first chunk that starts inside a new file where possible, so that
+    shards mostly don't read the same files. Returns the manifest dict.
+    '''
+    idxstart, fileidx, files = butils.get_init_info(time_start, time_stop, data_dir)
+    spec_start = idxstart + bdc.get_specnum_bounds(files[fileidx])[0]
+    spec_end = spec_start + nchunks*acclen
+    # chunk index of the first chunk starting at or after the start of each file
+    candidates = []
+    for i in range(fileidx+1, len(files)):
+        first, last = bdc.get_specnum_bounds(files[i])
+        if(first>=spec_end):
+            break
+        c = int(np.ceil((first-spec_start)/acclen))
+        if(0<c<nchunks):
+            candidates.append(c)
+    candidates = np.unique(candidates)
+    targets = np.linspace(0, nchunks, nshards+1)[1:-1]
+    if(len(candidates)>0):
+        edges = [candidates[np.argmin(np.abs(candidates-t))] for t in targets]
+    else:
+        edges = list(targets.astype(int))
+    edges = np.unique([0]+[int(e) for e in edges]+[nchunks])
+    shards = []
+    for k in range(len(edges)-1):
+        chunk0 = int(edges[k])
+        sfileidx, sidxstart = bdc.seek_specnum(files, fileidx, spec_start + chunk0*acclen)
+        shards.append({'id':k, 'chunk0':chunk0, 'nchunks':int(edges[k+1]-edges[k]), 'fileidx':int(sfileidx), 'idxstart':int(sidxstart)})
+    manifest = {'data_dir':data_dir, 'time_start':time_start, 'time_stop':time_stop, 'acclen':acclen, 'nchunks':nchunks,
+                'chans':[chanstart,chanend], 'fileidx':int(fileidx), 'spec_start':int(spec_start), 'files':files, 'shards':shards}
+    return manifest
+
+def get_shard_fname(outdir, shard_id):
+    return os.path.join(outdir, f"shard_{shard_id:04d}.npz")
+
+def run_shard(manifest, shard_id, outdir):
+    shard = manifest['shards'][shard_id]
+    assert(shard['id']==shard_id)
+    pol00,pol11,pol01,channels = autocorravg.get_avg_shard(manifest['files'], shard['fileidx'], manifest['spec_start'], manifest['acclen'],\
+        shard['chunk0'], shard['nchunks'], manifest['chans'][0], manifest['chans'][1])
+    fpath = get_shard_fname(outdir, shard_id)
+    # write to a temp file first so a killed job never leaves a valid looking partial shard behind
+    tmp = fpath + '.tmp.npz'
+    np.savez(tmp, pol00=pol00, pol11=pol11, pol01=pol01, chans=channels, chunk0=shard['chunk0'], nchunks=shard['nchunks'])
+    os.replace(tmp, fpath)
+    return fpath
+
+def merge_shards(manifest, outdir):
+    '''
+    Check that every shard is present and that they cover [0, nchunks) exactly once, then stitch them in order.
+    '''
+    shards = sorted(manifest['shards'], key=lambda s: s['chunk0'])
+    pols = {'pol00':[], 'pol11':[], 'pol01':[]}
+    nextchunk = 0
+    channels = None
+    for shard in shards:
+        fpath = get_shard_fname(outdir, shard['id'])
+        if(not os.path.exists(fpath)):
+            raise RuntimeError(f"Shard {shard['id']} missing: {fpath}")
+        with np.load(fpath) as f:
+            if(int(f['chunk0'])!=nextchunk or int(f['nchunks'])!=shard['nchunks'] or f['pol00'].shape[0]!=shard['nchunks']):
+                raise RuntimeError(f"Shard {shard['id']} does not cover chunks {nextchunk} to {nextchunk+shard['nchunks']}")
+            for key in pols:
+                pols[key].append(f[key])
+            channels = f['chans']
+        nextchunk += shard['nchunks']
+    if(nextchunk!=manifest['nchunks']):
+        raise RuntimeError(f"Shards cover {nextchunk} chunks, expected {manifest['nchunks']}")
+    pol00 = np.ma.masked_invalid(np.concatenate(pols['pol00']))
+    pol11 = np.ma.masked_invalid(np.concatenate(pols['pol11']))
+    pol01 = np.ma.masked_invalid(np.concatenate(pols['pol01']))
+    return pol00,pol11,pol01,channels
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description="Plan, run and merge independent shards of an autocorravg run.")
+    subparsers = parser.add_subparsers(dest='cmd', required=True)
+
+    p = subparsers.add_parser('plan', help='Write a manifest of shards')
+    p.add_argument('data_dir', type=str,help='Parent data directory. Should have 5 digit time folders.')
+    p.add_argument("time_start",type=int, help="Start timestamp ctime")
+    p.add_argument("acclen", type=int, help="Accumulation length for averaging")
+    p.add_argument("nshards", type=int, help="Number of shards")
+    p.add_argument('-n', '--nchunks', dest='nchunks',type=int, default=560, help='Number of chunks in output file. If stop time is specfied this is overwritten. Default 560 ~ 1 hr.')
+    p.add_argument('-t', '--time_stop', dest='time_stop',type=int, default=False, help='Stop time. Overwrites nchunks if specified')
+    p.add_argument("-c", '--chans', type=int, nargs=2, help="Indices of start and end channels.")
+    p.add_argument('-o', '--outdir', dest='outdir',type=str, default='/scratch/s/sievers/mohanagr/', help='Output directory for manifest, shards and merged data')
+
+    p = subparsers.add_parser('run', help='Run one shard')
+    p.add_argument('manifest', type=str, help='Path to manifest.json')
+    p.add_argument('shard_id', type=int, nargs='?', default=None, help='Shard to run. Defaults to $SLURM_ARRAY_TASK_ID.')
+
+    p = subparsers.add_parser('merge', help='Verify and merge all shards')
+    p.add_argument('manifest', type=str, help='Path to manifest.json')
+    p.add_argument("-l", "--logplot", action="store_true", help="Plot in logscale")
+    p.add_argument("-vmi", "--vmin", dest='vmin', default = None, type=float, help="minimum for colorbar. if nothing is specified, vmin is automatically set")
+    p.add_argument("-vma", "--vmax", dest='vmax', default = None, type=float, help="maximum for colorbar. if nothing is specified, vmax is automatically set")
+    args = parser.parse_args()
+
+    if(args.cmd=='plan'):
+        if(args.time_stop):
+            args.nchunks = int(np.floor((args.time_stop-args.time_start)*250e6/4096/args.acclen))
+        else:
+            args.time_stop = args.time_start + int(np.ceil(args.nchunks*args.acclen*4096/250e6))
+        if(not args.chans):
+            args.chans=[0,None]
+        manifest = plan_shards(args.data_dir, args.time_start, args.time_stop, args.acclen, args.nchunks, args.nshards, args.chans[0], args.chans[1])
+        manifest['outdir'] = args.outdir
+        os.makedirs(args.outdir, exist_ok=True)
+        fpath = os.path.join(args.outdir, f"manifest_{args.time_start}_{args.acclen}_{args.nchunks}_{args.chans[0]}_{args.chans[1]}.json")
+        with open(fpath,'w') as f:
+            json.dump(manifest, f, indent=1)
+        print(len(manifest['shards']), "shards")
+        print(fpath)
+    else:
+        with open(args.manifest) as f:
+            manifest = json.load(f)
+        outdir = manifest['outdir']
+        if(args.cmd=='run'):
+            shard_id = args.shard_id
+            if(shard_id is None):
+                if('SLURM_ARRAY_TASK_ID' not in os.environ):
+                    sys.exit("No shard id given and SLURM_ARRAY_TASK_ID not set")
+                shard_id = int(os.environ['SLURM_ARRAY_TASK_ID'])
+            print(run_shard(manifest, shard_id, outdir))
+        elif(args.cmd=='merge'):
+            pol00,pol11,pol01,channels = merge_shards(manifest, outdir)
+            chans = manifest['chans']
+            tag = f"{manifest['time_start']}_{manifest['acclen']}_{manifest['nchunks']}_{chans[0]}_{chans[1]}"
+            fpath = os.path.join(outdir, f"pols_4bit_{tag}.npz")
+            np.savez_compressed(fpath,datap01=pol01.data,maskp01=pol01.mask,datap00=pol00.data,maskp00=pol00.mask,\
+                datap11=pol11.data,maskp11=pol11.mask,chans=channels)
+            print(fpath)
+            fpath = os.path.join(outdir, f"pols_4bit_{tag}.png")
+            butils.plot_4bit(pol00,pol11,pol01,channels[chans[0]:chans[1]],manifest['acclen'],manifest['time_start'],args.vmin,args.vmax,fpath,minutes=True,logplot=args.logplot)
+            print(fpath)
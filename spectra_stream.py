@@ -0,0 +1,61 @@
+import numpy as np
+import time
+import os
+import argparse
+from correlations import baseband_data_classes as bdc
+from correlations import correlations as cr
+from correlations import products
+from utils import baseband_utils as butils
+
+def stream_spectra(path, init_t, end_t, binlen, nbins, outpath, chanstart=0, chanend=None, bins_per_chunk=4096):
+    '''
+    Write time-resolved pol00, pol11 and pol01 of one station to the product directory outpath.
+    Every output row is the average of binlen consecutive spectra (binlen=1 gives unaveraged spectra).
+    Data is read bins_per_chunk*binlen spectra at a time, so memory doesn't grow with the length of the run.
+    '''
+    idxstart, fileidx, files = butils.get_init_info(init_t, end_t, path)
+    print("Starting at: ",idxstart, "in filenum: ",fileidx)
+    acclen = bins_per_chunk*binlen
+    nchunks = int(np.ceil(nbins/bins_per_chunk))
+    ant1 = bdc.BasebandFileIterator(files,fileidx,idxstart,acclen,nchunks=nchunks,chanstart=chanstart,chanend=chanend)
+    if(ant1.obj.bit_mode!=4):
+        raise NotImplementedError(f"BIT MODE {ant1.obj.bit_mode} IS NOT SUPPORTED BY THIS SCRIPT.")
+    ncols=ant1.obj.chanend-ant1.obj.chanstart
+    m=ant1.spec_num_start
+    meta = {'binlen':binlen, 'nbins':nbins, 'time_start':init_t, 't_bin':binlen*4096/250e6, 'spec_start':m,\
+        'chans':[chanstart,chanend], 'channels':ant1.obj.channels[ant1.obj.chanstart:ant1.obj.chanend]}
+    st=time.time()
+    with products.ProductWriter(outpath, {'pol00':'float32','pol11':'float32','pol01':'complex64'}, ncols, meta, flush_every=bins_per_chunk) as writer:
+        for i, chunk in enumerate(ant1):
+            t1=time.time()
+            nb = min(bins_per_chunk, nbins-i*bins_per_chunk)
+            pol00,pol11,pol01,counts = cr.binned_corr_4bit(chunk['pol0'],chunk['pol1'],chunk['specnums'],m+i*acclen,binlen,nb)
+            writer.append(pol00=pol00,pol11=pol11,pol01=pol01)
+            print("time taken for one loop", time.time()-t1)
+            print(i+1,"CHUNK READ")
+    print("Time taken final:", time.time()-st)
+    return outpath
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description="Stream unaveraged or lightly averaged 4 bit spectra of a whole run to disk.")
+    parser.add_argument('data_dir', type=str,help='Parent data directory. Should have 5 digit time folders.')
+    parser.add_argument("time_start",type=int, help="Start timestamp ctime")
+    parser.add_argument("binlen", type=int, help="Number of spectra averaged into each output row (1 for no averaging)")
+    parser.add_argument('-n', '--nbins', dest='nbins',type=int, default=100000, help='Number of output rows. If stop time is specfied this is overwritten.')
+    parser.add_argument('-t', '--time_stop', dest='time_stop',type=int, default=False, help='Stop time. Overwrites nbins if specified')
+    parser.add_argument("-c", '--chans', type=int, nargs=2, help="Indices of start and end channels.")
+    parser.add_argument("-b", "--bins_per_chunk", type=int, default=4096, help="Output rows computed per read of the baseband. Sets the memory use.")
+    parser.add_argument('-o', '--outdir', dest='outdir',type=str, default='/scratch/s/sievers/mohanagr/',
+              help='Output directory')
+    args = parser.parse_args()
+
+    if(args.time_stop):
+        args.nbins = int(np.floor((args.time_stop-args.time_start)*250e6/4096/args.binlen))
+    else:
+        args.time_stop = args.time_start + int(np.ceil(args.nbins*args.binlen*4096/250e6))
+    if(not args.chans):
+        args.chans=[0,None]
+
+    outpath = os.path.join(args.outdir, f"spectra_4bit_{args.time_start}_{args.binlen}_{args.nbins}_{args.chans[0]}_{args.chans[1]}")
+    print(stream_spectra(args.data_dir, args.time_start, args.time_stop, args.binlen, args.nbins, outpath, args.chans[0], args.chans[1], args.bins_per_chunk))
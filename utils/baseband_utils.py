@@ -1,6 +1,9 @@
 import numpy as np
 import os, glob
 from matplotlib import pyplot as plt
+from utils import stats_utils
+
+DT_SPEC = 4096/250e6 # time of one spectrum, 4096 samples at 250 MHz
 
 def get_init_info(init_t, end_t, parent_dir):
     '''
@@ -17,11 +20,9 @@ def get_init_info(init_t, end_t, parent_dir):
     files = glob.glob(path+'/*')
     if(frag1!=frag2):
         path = os.path.join(parent_dir,frag2)
-        files.append(glob.glob(path+'/*'))
+        files.extend(glob.glob(path+'/*'))
     files.sort()
-    speclen=4096 # length of each spectra
-    fs=250e6
-    dt_spec = speclen/fs # time taken to read one spectra
+    dt_spec = DT_SPEC # time taken to read one spectra
 
     # find which file to read first 
     filetstamps = [int(f.split('.')[0].split('/')[-1]) for f in files]
@@ -45,6 +46,65 @@ def get_init_info(init_t, end_t, parent_dir):
     
     return idxstart, fileidx, files
 
+def get_shard_bounds(nchunks, nshard):
+    '''
+    Split nchunks into nshard contiguous ranges on chunk boundaries. Returns list of (chunk0, nchunks_in_shard).
+    Empty shards are dropped.
+    '''
+    edges = np.linspace(0, nchunks, nshard+1).astype(int)
+    return [(edges[i], edges[i+1]-edges[i]) for i in range(nshard) if edges[i+1]>edges[i]]
+
+def save_checkpoint(fpath, **kwargs):
+    '''
+    Save arrays and iterator state to fpath (.npz). Written to a temp file and renamed,
+    so a crash while saving leaves the previous checkpoint intact.
+    '''
+    tmp = fpath + '.tmp.npz'
+    np.savez(tmp, **kwargs)
+    os.replace(tmp, fpath)
+
+def save_checkpoint_rows(fpath, start, **arrs):
+    '''
+    Save rows start:start+len of the output arrays next to the checkpoint fpath, one file per checkpoint.
+    Only the rows finished since the last checkpoint are written, so the cost of a checkpoint doesn't grow with the run.
+    '''
+    save_checkpoint(f"{fpath[:-4]}_rows_{start}.npz", start=start, **arrs)
+
+def load_checkpoint_rows(fpath, done, arrs):
+    '''
+    Fill rows :done of the arrays in the dict arrs from the row files written by save_checkpoint_rows.
+    Row files past done are from after the last checkpoint and are skipped, they get rewritten on resume.
+    '''
+    for f in glob.glob(f"{fpath[:-4]}_rows_*.npz"):
+        with np.load(f) as part:
+            start = int(part['start'])
+            if(start>=done):
+                continue
+            for key, arr in arrs.items():
+                rows = part[key][:done-start]
+                arr[start:start+len(rows)] = rows
+
+def get_ckpt_fname(checkpoint, chunk0):
+    # one checkpoint file per shard, named by the shard's first chunk
+    if(checkpoint is None):
+        return None
+    return f"{checkpoint}_{chunk0}.npz"
+
+def load_checkpoint(fpath, **expected):
+    '''
+    Load a checkpoint saved with save_checkpoint. Returns None if there is none.
+    Any keyword arguments are checked against the saved values, so a checkpoint from a different run isn't resumed by mistake.
+    '''
+    if(not os.path.exists(fpath)):
+        return None
+    with np.load(fpath) as f:
+        ckpt = {key:f[key] for key in f.files}
+    for key, val in expected.items():
+        if(np.any(ckpt[key]!=val)):
+            raise ValueError(f"Checkpoint {fpath} has {key}={ckpt[key]}, expected {val}")
+    print("Resuming from", fpath, "with", int(ckpt['chunksdone']), "chunks done")
+    return ckpt
+
 def get_plot_lims(pol,acclen):
 
     # numpy percentile method ignores mask and may generate garbage with 0s (missing specs). 
@@ -70,14 +130,10 @@ def get_plot_lims(pol,acclen):
 def plot_4bit(pol00,pol11,pol01,channels,acclen,time_start,vmin,vmax,opath,minutes=False,logplot=True):
 
     freq = channels*125/2048 #MHz
-    pol00_med = np.ma.median(pol00, axis=0)
-    pol11_med = np.ma.median(pol11, axis=0)
-    pol00_mean = np.ma.mean(pol00, axis=0)
-    pol11_mean = np.ma.mean(pol11, axis=0)
-    pol00_max = np.ma.max(pol00, axis=0)
-    pol11_max = np.ma.max(pol11, axis=0)
-    pol00_min = np.ma.min(pol00, axis=0)
-    pol11_min = np.ma.min(pol11, axis=0)
+    stats00 = stats_utils.channel_stats(pol00)
+    stats11 = stats_utils.channel_stats(pol11)
+    pol00_med, pol00_mean, pol00_max, pol00_min = stats00['median'], stats00['mean'], stats00['max'], stats00['min']
+    pol11_med, pol11_mean, pol11_max, pol11_min = stats11['median'], stats11['mean'], stats11['max'], stats11['min']
     if (vmin is None) and (vmax is None):
         med,vmin,vmax=get_plot_lims(pol00,acclen)
         med2,vmin2,vmax2=get_plot_lims(pol11,acclen)
@@ -0,0 +1,196 @@
+import numpy as np
+import os, json, time, hashlib, shutil, tempfile
+from concurrent.futures import ThreadPoolExecutor
+from scio import scio
+
+'''
+Local cache of decompressed direct data.
+
+Every 10-digit direct data directory gets one cache entry with its products as plain .npy files
+    pol00.npy, pol11.npy    float64 autospectra
+    pol01.npy               complex128 cross spectrum (pol01r + 1j*pol01i)
+    meta.json               source path, mtimes of the source files, which products were read and which exist
+Entries are memory-mapped when read, so nothing is decompressed twice and only the rows that are
+used get read. Only the products a caller asks for are decompressed, and they are added to the entry
+as they come. An entry is rebuilt if any source file changed (mtime). meta.json is touched on every
+hit and the least recently used entries are removed once the cache is bigger than the budget.
+
+The cache lives in $ALBATROS_DIRECT_CACHE, or $SCRATCH/albatros_direct, or albatros_direct_<user> in
+the temp directory ($TMPDIR), so it never fills up a home directory by default.
+'''
+
+def default_cache_dir(env='ALBATROS_DIRECT_CACHE', name='albatros_direct'):
+    # $env, or $SCRATCH/name, or name_<user> in the temp directory
+    if(os.environ.get(env)):
+        return os.environ[env]
+    if(os.environ.get('SCRATCH')):
+        return os.path.join(os.environ['SCRATCH'], name)
+    user = os.environ.get('USER') or str(os.getuid())
+    return os.path.join(tempfile.gettempdir(), f'{name}_{user}')
+
+CACHE_DIR = default_cache_dir()
+BUDGET_GB = float(os.environ.get('ALBATROS_DIRECT_CACHE_GB', 50))
+SOURCES = ['pol00', 'pol11', 'pol01r', 'pol01i']
+PRODUCTS = ['pol00', 'pol11', 'pol01']
+# source files needed for every cached product
+_NEEDS = {'pol00':['pol00'], 'pol11':['pol11'], 'pol01':['pol01r','pol01i']}
+
+def get_cached_products(products):
+    '''
+    Cached products needed for the given products. pol01r and pol01i both come from pol01.
+    '''
+    out = []
+    for p in products:
+        p = 'pol01' if p in ('pol01r','pol01i') else p
+        if(p not in PRODUCTS):
+            raise ValueError(f"{p} is not a direct data product")
+        if(p not in out):
+            out.append(p)
+    return out
+
+def get_entry_path(d, cache_dir=None):
+    key = hashlib.sha1(os.path.abspath(d).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir or CACHE_DIR, key)
+
+def get_mtimes(d, suffix='.scio.bz2'):
+    mtimes = {}
+    for p in SOURCES:
+        fname = os.path.join(d, p+suffix)
+        mtimes[p] = os.path.getmtime(fname) if os.path.exists(fname) else None
+    return mtimes
+
+def _load(fname):
+    try:
+        return np.load(fname, mmap_mode='c')
+    except ValueError:
+        # empty arrays can't be mapped
+        return np.load(fname)
+
+def _read_meta(entry, mtimes):
+    # meta of an entry that is up to date with the source files, else None
+    try:
+        with open(os.path.join(entry, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if(meta['mtimes']!=mtimes):
+        return None
+    return meta
+
+def _read_entry(entry, mtimes, products):
+    meta = _read_meta(entry, mtimes)
+    if(meta is None or not all(p in meta['read'] for p in products)):
+        return None
+    os.utime(os.path.join(entry, 'meta.json')) # for LRU
+    return {p:(_load(os.path.join(entry, p+'.npy')) if p in meta['products'] else None) for p in products}
+
+def _read_scio(fname):
+    try:
+        return scio.read(fname) if os.path.exists(fname) else None
+    except Exception as error:
+        print("failed to read", fname, error)
+        return None
+
+def _read_source(d, suffix, products, pool=None):
+    # decompress the source files of products, all at the same time. bz2 releases the GIL.
+    sources = [s for p in products for s in _NEEDS[p]]
+    fnames = [os.path.join(d, s+suffix) for s in sources]
+    if(pool is None):
+        with ThreadPoolExecutor(len(fnames)) as ex:
+            dat = dict(zip(sources, ex.map(_read_scio, fnames)))
+    else:
+        dat = dict(zip(sources, pool.map(_read_scio, fnames)))
+    out = {p:dat[p] for p in products if p!='pol01'}
+    if('pol01' in products):
+        out['pol01'] = None
+        if(dat['pol01r'] is not None and dat['pol01i'] is not None and dat['pol01r'].shape==dat['pol01i'].shape):
+            out['pol01'] = dat['pol01r'] + 1J*dat['pol01i']
+    return out
+
+def _write_entry(d, entry, mtimes, dat):
+    # add products to the entry. every file is written to a temp name and renamed, and meta.json goes last,
+    # so readers never see a product that isn't complete.
+    meta = _read_meta(entry, mtimes)
+    if(meta is None):
+        shutil.rmtree(entry, ignore_errors=True) # stale entry
+        meta = {'path':os.path.abspath(d), 'mtimes':mtimes, 'read':[], 'products':[]}
+    os.makedirs(entry, exist_ok=True)
+    tag = f"{os.getpid()}.{time.time_ns()}.tmp"
+    for p, arr in dat.items():
+        if(arr is not None):
+            np.save(os.path.join(entry, f"{p}.{tag}.npy"), arr)
+            os.replace(os.path.join(entry, f"{p}.{tag}.npy"), os.path.join(entry, p+'.npy'))
+            meta['products'] = sorted(set(meta['products']) | {p})
+        meta['read'] = sorted(set(meta['read']) | {p})
+    with open(os.path.join(entry, f"meta.{tag}.json"), 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(entry, f"meta.{tag}.json"), os.path.join(entry, 'meta.json'))
+
+def get_cache_size(cache_dir=None):
+    '''
+    Returns a list of (last used, bytes, entry path) of all entries, least recently used first.
+    An entry is a directory with a meta.json that is touched on use, its size includes subdirectories.
+    '''
+    cache_dir = cache_dir or CACHE_DIR
+    entries = []
+    if(not os.path.isdir(cache_dir)):
+        return entries
+    for e in os.scandir(cache_dir):
+        if(not e.is_dir() or e.name.endswith('.tmp')):
+            continue
+        try:
+            nbytes = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(e.path) for f in files)
+            entries.append((os.path.getmtime(os.path.join(e.path, 'meta.json')), nbytes, e.path))
+        except OSError:
+            continue
+    entries.sort()
+    return entries
+
+def evict(cache_dir=None, budget_gb=None, keep=()):
+    '''
+    Remove least recently used entries until the cache fits in budget_gb. Entries in keep are never removed.
+    '''
+    budget = (BUDGET_GB if budget_gb is None else budget_gb)*1024**3
+    entries = get_cache_size(cache_dir)
+    total = sum(e[1] for e in entries)
+    for last_used, nbytes, path in entries:
+        if(total<=budget):
+            break
+        if(path in keep):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= nbytes
+        print("evicted", path, f"{nbytes/1024**2:.1f} MB")
+
+def get_direct(d, cache_dir=None, budget_gb=None, suffix='.scio.bz2', do_evict=True, products=None, pool=None):
+    '''
+    Products of direct data directory d through the cache. Decompresses and caches them on a miss.
+    products: which of pol00, pol11, pol01r, pol01i (or pol01) are needed, default all. Only their source files are decompressed.
+    pool: executor the source files are decompressed in. Default a new one with a thread per file.
+    Don't pass the pool this is called from, the call waits on the decompression.
+    Returns a dict with pol00, pol11, pol01 (complex) and pol01r, pol01i (views of pol01), None for missing or not requested ones.
+    If the cache can't be written the decompressed arrays are returned as is.
+    '''
+    want = get_cached_products(SOURCES if products is None else products)
+    entry = get_entry_path(d, cache_dir)
+    mtimes = get_mtimes(d, suffix)
+    dat = _read_entry(entry, mtimes, want)
+    if(dat is None):
+        meta = _read_meta(entry, mtimes)
+        have = [] if meta is None else [p for p in want if p in meta['read']]
+        dat = _read_source(d, suffix, [p for p in want if p not in have], pool)
+        try:
+            _write_entry(d, entry, mtimes, dat)
+            if(do_evict):
+                evict(cache_dir, budget_gb, keep=(entry,))
+            dat = _read_entry(entry, mtimes, want) or dat
+        except OSError as error:
+            print("could not cache", d, error)
+        if(len(dat)<len(want)):
+            # products that were cached before, if the rewrite failed
+            dat.update(_read_entry(entry, mtimes, have) or {})
+    dat = {p:dat.get(p) for p in PRODUCTS}
+    pol01 = dat['pol01']
+    dat['pol01r'] = None if pol01 is None else pol01.real
+    dat['pol01i'] = None if pol01 is None else pol01.imag
+    return dat
@@ -0,0 +1,272 @@
+import numpy as np
+import os, json, time, re, shutil, hashlib, argparse
+from utils import direct_cache
+import SNAPfiletools as sft
+
+'''
+Multi-resolution time pyramid of direct spectra.
+
+Rows are binned on a global time grid of width level*chunk_time (bin b covers [b*w, (b+1)*w) in ctime), so bins
+line up across files and levels: a level 100 bin is exactly 10 level 10 bins. For every 5-digit directory and
+every level in LEVELS the pyramid keeps, per product,
+    sum (float64), min, max (float32) of shape (nbin, nchan) and count (nbin,) of rows that went into each bin,
+which is enough to merge pyramids and to combine bins further. Mean is sum/count. Level 1 is the data itself
+and is read through direct_cache instead of being stored.
+
+A 5-digit directory's pyramid lives in PYRAMID_DIR/<hash of its path>/ as
+    meta.json       chunk_time, which 10-digit dirs were ingested (with source mtimes) and the current version
+    v<n>/           <product>_<level>_<stat>.npy and bin0_<product>_<level>.npy
+update_pyramid() only ingests 10-digit dirs that are new or changed since the last update. Every update writes a
+new version dir and then switches meta.json to it, so an interrupted update never double counts.
+PYRAMID_DIR is $ALBATROS_PYRAMID_DIR, or $SCRATCH/albatros_pyramid, or albatros_pyramid_<user> in the temp directory.
+A pyramid takes about 16 bytes per channel per level 10 bin and product, ~225 MB per 5-digit directory at 2048
+channels and 6.44 s rows. meta.json is touched on every load and the least recently used pyramids are removed once
+they take more than PYRAMID_BUDGET_GB ($ALBATROS_PYRAMID_GB, default 20, about 90 5-digit directories).
+Dirs that started less than settle seconds ago may still be written to and aren't ingested yet, get_binned() reads
+them (and anything else not in the pyramid) from the raw data, so a plot of the live night only re-reads the
+newest dir instead of rebuilding the pyramid every time.
+'''
+
+PYRAMID_DIR = direct_cache.default_cache_dir('ALBATROS_PYRAMID_DIR', 'albatros_pyramid')
+PYRAMID_BUDGET_GB = float(os.environ.get('ALBATROS_PYRAMID_GB', 20))
+LEVELS = [10, 100, 1000]
+PRODUCTS = ['pol00', 'pol11', 'pol01r', 'pol01i']
+STATS = ['sum', 'count', 'min', 'max']
+SETTLE = 7200
+
+def drop_bad_first_row(arr):
+    # same check as plot_overnight_new.get_avg: the first row of a file is sometimes garbage
+    if(arr.shape[0]>1 and np.median(arr[0,:])/np.median(arr[1,:])>1e2):
+        return arr[1:], 1
+    return arr, 0
+
+def bin_rows(tstamps, arr, width):
+    '''
+    Bin time-ordered rows on the global grid of the given width (s).
+    Returns (bins, sum, count, min, max) for every bin that has at least one row.
+    '''
+    b = np.floor(tstamps/width).astype('int64')
+    starts = np.r_[0, np.where(np.diff(b)!=0)[0]+1]
+    arr = np.asarray(arr, dtype='float64')
+    return b[starts], np.add.reduceat(arr, starts, axis=0), np.diff(np.r_[starts, len(b)]),\
+        np.minimum.reduceat(arr, starts, axis=0), np.maximum.reduceat(arr, starts, axis=0)
+
+def _empty(nbin, nchan):
+    return {'sum':np.zeros((nbin,nchan)), 'count':np.zeros(nbin, dtype='int64'),
+        'min':np.full((nbin,nchan), np.nan, dtype='float32'), 'max':np.full((nbin,nchan), np.nan, dtype='float32')}
+
+def merge_bins(level, bin0, bins, s, c, mn, mx):
+    '''
+    Merge binned rows into level (dict of stats starting at bin bin0), growing it as needed. Returns (level, bin0).
+    '''
+    nchan = s.shape[1]
+    if(level is None):
+        level, bin0 = _empty(0, nchan), bins[0]
+    lo = min(bin0, bins[0])
+    hi = max(bin0+len(level['count']), bins[-1]+1)
+    if(lo<bin0 or hi>bin0+len(level['count'])):
+        grown = _empty(hi-lo, nchan)
+        for st in STATS:
+            grown[st][bin0-lo:bin0-lo+len(level['count'])] = level[st]
+        level, bin0 = grown, lo
+    idx = bins-bin0
+    # bins are unique within one call, so plain fancy indexing is safe
+    level['sum'][idx] += s
+    level['count'][idx] += c
+    level['min'][idx] = np.fmin(level['min'][idx], mn)
+    level['max'][idx] = np.fmax(level['max'][idx], mx)
+    return level, bin0
+
+def get_pyramid_path(dir5):
+    return os.path.join(PYRAMID_DIR, hashlib.sha1(os.path.abspath(dir5).encode()).hexdigest()[:16])
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def load_pyramid(dir5, chunk_time):
+    '''
+    Returns (meta, {product:{level:(stats, bin0)}}) of the pyramid of a 5-digit directory, memory-mapped.
+    Empty if there is none yet or it was made with a different chunk_time.
+    '''
+    path = get_pyramid_path(dir5)
+    meta = _read_meta(path)
+    if(meta is None or not np.isclose(meta['chunk_time'], chunk_time)):
+        return {'chunk_time':chunk_time, 'dirs':{}, 'version':0}, {}
+    vdir = os.path.join(path, f"v{meta['version']}")
+    try:
+        os.utime(os.path.join(path, 'meta.json'))
+    except OSError:
+        pass
+    pyr = {}
+    for p in PRODUCTS:
+        pyr[p] = {}
+        for L in LEVELS:
+            fname = os.path.join(vdir, f"bin0_{p}_{L}.npy")
+            if(os.path.exists(fname)):
+                pyr[p][L] = ({st:np.load(os.path.join(vdir, f"{p}_{L}_{st}.npy"), mmap_mode='r') for st in STATS}, int(np.load(fname)))
+    return meta, pyr
+
+def update_pyramid(dir5, chunk_time, nthreads=None, settle=SETTLE):
+    '''
+    Ingest the 10-digit dirs of dir5 that are new or changed since the last update. Returns the number ingested.
+    A changed dir means the whole pyramid of dir5 is rebuilt, since its old rows can't be taken out of min/max.
+    PYRAMID_DIR is $ALBATROS_PYRAMID_DIR, or $SCRATCH/albatros_pyramid, or albatros_pyramid_<user> in the temp directory.
+A pyramid takes about 16 bytes per channel per level 10 bin and product, ~225 MB per 5-digit directory at 2048
+channels and 6.44 s rows. meta.json is touched on every load and the least recently used pyramids are removed once
+they take more than PYRAMID_BUDGET_GB ($ALBATROS_PYRAMID_GB, default 20, about 90 5-digit directories).
+Dirs that started less than settle seconds ago are left for a later update.
+    '''
+    s = re.compile(r'^\d{10}$')
+    subdirs = sorted(os.path.join(dir5, f) for f in os.listdir(dir5) if s.search(f))
+    meta, pyr = load_pyramid(dir5, chunk_time)
+    mtimes = {d:direct_cache.get_mtimes(d) for d in subdirs}
+    changed = [d for d in subdirs if os.path.basename(d) in meta['dirs'] and meta['dirs'][os.path.basename(d)]!=mtimes[d]]
+    if(changed):
+        print("changed since last update:", changed, "rebuilding")
+        meta, pyr = {'chunk_time':chunk_time, 'dirs':{}, 'version':meta['version']}, {}
+    new = [d for d in subdirs if os.path.basename(d) not in meta['dirs'] and int(os.path.basename(d)) < time.time()-settle]
+    if(len(new)==0):
+        return 0
+    t1 = time.time()
+    # start from in-memory copies of the current version
+    levels = {p:{L:({st:np.array(a) for st, a in pyr[p][L][0].items()}, pyr[p][L][1]) if L in pyr.get(p,{}) else (None, None)\
+        for L in LEVELS} for p in PRODUCTS}
+    dat = sft.read_direct_parallel(new, PRODUCTS, nthreads=nthreads)
+    for i, d in enumerate(new):
+        tstamp = int(os.path.basename(d))
+        for p in PRODUCTS:
+            arr = dat[p][i]
+            if(arr is None or arr.shape[0]==0):
+                continue
+            arr, skip = drop_bad_first_row(arr)
+            t = tstamp + (skip+np.arange(arr.shape[0]))*chunk_time
+            for L in LEVELS:
+                level, bin0 = levels[p][L]
+                levels[p][L] = merge_bins(level, bin0, *bin_rows(t, arr, L*chunk_time))
+        meta['dirs'][os.path.basename(d)] = mtimes[d]
+    path = get_pyramid_path(dir5)
+    version = meta['version']+1
+    vdir = os.path.join(path, f"v{version}")
+    shutil.rmtree(vdir, ignore_errors=True)
+    os.makedirs(vdir)
+    for p in PRODUCTS:
+        for L in LEVELS:
+            level, bin0 = levels[p][L]
+            if(level is None):
+                continue
+            for st in STATS:
+                np.save(os.path.join(vdir, f"{p}_{L}_{st}.npy"), level[st])
+            np.save(os.path.join(vdir, f"bin0_{p}_{L}.npy"), bin0)
+    old = meta['version']
+    meta['version'] = version
+    meta['path'] = os.path.abspath(dir5)
+    tmp = os.path.join(path, 'meta.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(path, 'meta.json'))
+    shutil.rmtree(os.path.join(path, f"v{old}"), ignore_errors=True)
+    direct_cache.evict(cache_dir=PYRAMID_DIR, budget_gb=PYRAMID_BUDGET_GB, keep=[path])
+    print(f"ingested {len(new)} dirs into pyramid of {dir5} in {time.time()-t1:5.2f}s")
+    return len(new)
+
+def _merge_raw(subdirs, products, chunk_time, width, b0, b1, out, bin0, nthreads=None):
+    # bin the rows of subdirs between bins b0 and b1 straight from the raw data into out/bin0 (dicts by product)
+    dat = sft.read_direct_parallel(subdirs, list(products), nthreads=nthreads)
+    for i, d in enumerate(subdirs):
+        for p in products:
+            arr = dat[p][i]
+            if(arr is None or arr.shape[0]==0):
+                continue
+            arr, skip = drop_bad_first_row(arr)
+            t = int(os.path.basename(d)) + (skip+np.arange(arr.shape[0]))*chunk_time
+            keep = (t>=b0*width)&(t<b1*width)
+            if(np.any(keep)):
+                out[p], bin0[p] = merge_bins(out[p], bin0[p], *bin_rows(t[keep], arr[keep], width))
+
+def get_level(blocklen):
+    # coarsest stored level that divides blocklen, 1 means the raw data
+    return max([1]+[L for L in LEVELS if blocklen%L==0])
+
+def get_binned(data_dir, ctime_start, ctime_stop, chunk_time, blocklen, products=PRODUCTS, update=True, nthreads=None, settle=SETTLE):
+    '''
+    Stats of every product on the global grid of width blocklen*chunk_time between ctime_start and ctime_stop,
+    combined from the coarsest pyramid level that divides blocklen (or the raw data if none does).
+    With update the pyramids are brought up to date first (see update_pyramid for settle). Dirs that aren't in
+    the pyramids are read from the raw data, so the result is complete either way.
+    Returns (bins, {product:{'mean','min','max'}} with NaN rows where there is no data, count of rows per bin).
+    '''
+    width = blocklen*chunk_time
+    b0, b1 = int(np.floor(ctime_start/width)), int(np.floor(ctime_stop/width))+1
+    L = get_level(blocklen)
+    fac = blocklen//L
+    out = {p:None for p in products}
+    bin0 = {p:None for p in products}
+    count = None
+    subdirs = sorted(sft.time2fnames(ctime_start-3600, ctime_stop, data_dir))
+    if(L==1):
+        _merge_raw(subdirs, products, chunk_time, width, b0, b1, out, bin0, nthreads)
+    else:
+        ingested = set()
+        for dir5 in sorted(os.listdir(data_dir)):
+            if(not re.search(r'^\d{5}$', dir5) or int(dir5)<int(ctime_start)//100000-1 or int(dir5)>int(ctime_stop)//100000):
+                continue
+            if(update):
+                update_pyramid(os.path.join(data_dir, dir5), chunk_time, nthreads, settle)
+            meta, pyr = load_pyramid(os.path.join(data_dir, dir5), chunk_time)
+            ingested.update(meta['dirs'])
+            for p in products:
+                if(L not in pyr.get(p, {})):
+                    continue
+                stats, pb0 = pyr[p][L]
+                # level L bins -> output bins, then keep the requested range
+                bins = (pb0+np.arange(len(stats['count'])))//fac
+                sel = (stats['count']>0)&(bins>=b0)&(bins<b1)
+                if(not np.any(sel)):
+                    continue
+                bins, idx = bins[sel], np.where(sel)[0]
+                starts = np.r_[0, np.where(np.diff(bins)!=0)[0]+1]
+                out[p], bin0[p] = merge_bins(out[p], bin0[p], bins[starts],
+                    np.add.reduceat(stats['sum'][idx], starts, axis=0), np.add.reduceat(stats['count'][idx], starts),
+                    np.fmin.reduceat(stats['min'][idx], starts, axis=0), np.fmax.reduceat(stats['max'][idx], starts, axis=0))
+        # dirs that aren't in the pyramids (yet), e.g. the one still being written
+        raw = [d for d in subdirs if os.path.basename(d) not in ingested]
+        if(raw):
+            _merge_raw(raw, products, chunk_time, width, b0, b1, out, bin0, nthreads)
+    bins = np.arange(b0, b1)
+    res = {}
+    for p in products:
+        if(out[p] is None):
+            res[p] = None
+            continue
+        nchan = out[p]['sum'].shape[1]
+        full = _empty(b1-b0, nchan)
+        lo, hi = max(bin0[p], b0), min(bin0[p]+len(out[p]['count']), b1)
+        for st in STATS:
+            full[st][lo-b0:hi-b0] = out[p][st][lo-bin0[p]:hi-bin0[p]]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = full['sum']/full['count'][:,None]
+        mean[full['count']==0] = np.nan
+        res[p] = {'mean':mean, 'min':full['min'], 'max':full['max']}
+        count = full['count'] if count is None else count
+    return bins, res, count
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description="Build or update the time pyramids of direct data 5-digit directories. "\
+        "They go to $ALBATROS_PYRAMID_DIR, $SCRATCH/albatros_pyramid or the temp directory, about 225 MB per 5-digit directory "\
+        f"at 2048 channels, and the least recently used ones are removed past $ALBATROS_PYRAMID_GB (default {PYRAMID_BUDGET_GB:g} GB).")
+    parser.add_argument('data_dir', type=str, help='Direct data directory with 5-digit directories')
+    parser.add_argument('dirs', type=str, nargs='*', help='5-digit directories to update. Default all of them.')
+    parser.add_argument('-n', '--acclen', dest='acclen', type=int, default=393216, help='Accumulation length. Default 393216 ~ 6.44s')
+    parser.add_argument("-j", "--nthreads", type=int, default=None, help="Max files decompressed at the same time. Default number of cores.")
+    parser.add_argument('--settle', type=float, default=SETTLE, help=f'Skip 10-digit directories younger than this many seconds, they may still be written to. Default {SETTLE}')
+    args = parser.parse_args()
+
+    chunk_time = args.acclen*4096/250e6
+    dirs = args.dirs or sorted(d for d in os.listdir(args.data_dir) if re.search(r'^\d{5}$', d))
+    for dir5 in dirs:
+        update_pyramid(os.path.join(args.data_dir, dir5), chunk_time, args.nthreads, args.settle)
@@ -0,0 +1,363 @@
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+class QuantileSketch():
+    '''
+    Per-channel streaming quantile sketch with relative accuracy alpha (DDSketch style): |x| is counted in
+    logarithmic key bins, positive and negative values separately, zeros apart, NaN/inf and masked entries skipped.
+    Each channel has its own key range of at most max_bins keys, see _refold for channels that need more.
+    Partial sketches are combined with merge(). Exact count, sum, min and max per channel are kept alongside.
+    '''
+    def __init__(self, nchan, alpha=0.01, max_bins=1024, dtype='int64'):
+        self.nchan = nchan
+        self.alpha = alpha
+        self.gamma = (1+alpha)/(1-alpha)
+        self.lgamma = np.log(self.gamma)
+        self.max_bins = max_bins
+        self.kmin = np.zeros(nchan, dtype='int64')
+        self.kmax = np.full(nchan, -1, dtype='int64') # kmax < kmin: no keys yet
+        self.collapsed = np.zeros(nchan, dtype=bool)
+        self.pos = np.zeros((nchan,0), dtype=dtype)
+        self.neg = np.zeros((nchan,0), dtype=dtype)
+        self.zero = np.zeros(nchan, dtype='int64')
+        self.count = np.zeros(nchan, dtype='int64')
+        self.sum = np.zeros(nchan)
+        self.min = np.full(nchan, np.inf)
+        self.max = np.full(nchan, -np.inf)
+
+    def _keys(self, absx):
+        return np.ceil(np.log(absx)/self.lgamma).astype('int64')
+
+    @staticmethod
+    def _shift_add(dst, drows, src, srows, off):
+        # dst[drows[i], j+off[i]] += src[srows[i], j], columns left of 0 folded into column 0. drows unique.
+        # Rows are handled in groups with the same shift, there are only a few distinct shifts.
+        wd, ws = dst.shape[1], src.shape[1]
+        for o in np.unique(off):
+            sel = off==o
+            d, blk = drows[sel], src[srows[sel]]
+            if(o>=0):
+                n = min(ws, wd-o)
+                dst[d, o:o+n] += blk[:, :n]
+            else:
+                dst[d, 0] += blk[:, :1-o].sum(axis=1, dtype=dst.dtype)
+                n = min(ws+o-1, wd-1)
+                if(n>0):
+                    dst[d, 1:1+n] += blk[:, 1-o:1-o+n]
+
+    def _alloc(self, width, neg=False):
+        # make the stores at least width wide, and allocate the negative store if needed
+        for name in ['pos','neg'] if (neg or self.neg.shape[1]>0) else ['pos']:
+            old = getattr(self, name)
+            if(old.shape[1]<width):
+                new = np.zeros((self.nchan, width), dtype=old.dtype)
+                new[:, :old.shape[1]] = old
+                setattr(self, name, new)
+
+    def _resize(self, chans, lo, hi, neg=False):
+        '''
+        Grow the key ranges of channels chans (unique) to cover keys lo..hi. Returns a mask of the channels that
+        would need more than max_bins keys, those are left for _refold.
+        '''
+        empty = self.kmax[chans] < self.kmin[chans]
+        new_lo = np.where(empty, lo, np.minimum(self.kmin[chans], lo))
+        new_hi = np.where(empty, hi, np.maximum(self.kmax[chans], hi))
+        fold = new_hi-new_lo+1 > self.max_bins
+        ok = ~fold
+        width = int((new_hi-new_lo)[ok].max())+1 if np.any(ok) else 0
+        self._alloc(width, neg)
+        moved = ok & ~empty & (new_lo!=self.kmin[chans])
+        if(np.any(moved)):
+            rows = chans[moved]
+            for name in ['pos','neg'] if self.neg.shape[1]>0 else ['pos']:
+                store = getattr(self, name)
+                src = store[rows]
+                store[rows] = 0
+                self._shift_add(store, rows, src, np.arange(len(rows)), self.kmin[rows]-new_lo[moved])
+        self.kmin[chans[ok]] = new_lo[ok]
+        self.kmax[chans[ok]] = new_hi[ok]
+        return fold
+
+    def _refold(self, c, keys, neg, weights):
+        '''
+        Add magnitude keys (neg True for negative values) with counts weights to channel c, which needs more than
+        max_bins keys, i.e. values over more than a factor gamma^max_bins (4.4 decades for alpha=0.02, max_bins=256).
+        The max_bins wide window with the most counts, of what's there already and what's added, is kept and keys
+        outside it are folded into its edge bins, and the channel is flagged in collapsed. Quantiles inside the
+        window (normally the median, whether the outliers are RFI spikes or dropouts) keep the alpha guarantee.
+        The folded tails don't: in the low tail values are only known to be below gamma^kmin, which matters for
+        signed data such as cross spectra whose median can sit arbitrarily close to zero.
+        Unless keys got folded a merged sketch doesn't depend on how the data was split.
+        '''
+        if(self.kmax[c]>=self.kmin[c]):
+            n = self.kmax[c]-self.kmin[c]+1
+            own = self.kmin[c] + np.arange(n)
+            nneg = n if self.neg.shape[1]>0 else 0
+            keys = np.concatenate([own, own[:nneg], keys])
+            neg = np.concatenate([np.zeros(n, dtype=bool), np.ones(nneg, dtype=bool), neg])
+            weights = np.concatenate([self.pos[c,:n], self.neg[c,:nneg], weights])
+        keep = weights>0
+        keys, neg, weights = keys[keep], neg[keep], weights[keep]
+        lo = keys.min()
+        hist = np.bincount(keys-lo, weights=weights)
+        csum = np.concatenate([[0], np.cumsum(hist)])
+        if(len(hist)>self.max_bins):
+            start = lo + np.argmax(csum[self.max_bins:]-csum[:-self.max_bins])
+            self.collapsed[c] = True
+        else:
+            start = lo
+        end = min(keys.max(), start+self.max_bins-1)
+        self._alloc(end-start+1, np.any(neg))
+        cols = np.clip(keys-start, 0, end-start)
+        self.pos[c] = np.bincount(cols[~neg], weights=weights[~neg], minlength=self.pos.shape[1]).astype(self.pos.dtype)
+        if(self.neg.shape[1]>0):
+            self.neg[c] = np.bincount(cols[neg], weights=weights[neg], minlength=self.neg.shape[1]).astype(self.neg.dtype)
+        self.kmin[c] = start
+        self.kmax[c] = end
+
+    def _add(self, store, chans, keys):
+        width = store.shape[1]
+        flat = chans*width + np.clip(keys-self.kmin[chans], 0, None)
+        if(len(flat)*8 < store.size):
+            # few entries in a big sketch, don't build a full size histogram
+            idx, cnt = np.unique(flat, return_counts=True)
+            store.reshape(-1)[idx] += cnt.astype(store.dtype)
+        else:
+            store += np.bincount(flat, minlength=self.nchan*width).reshape(self.nchan, width).astype(store.dtype)
+
+    def update(self, data, groups=None):
+        '''
+        Add a chunk of rows, (nrows, nchan) or a single (nchan,) row. Masked and non-finite entries are skipped.
+        With groups, data is (nrows, ncol) and row i goes to channels groups[i]*ncol..groups[i]*ncol+ncol-1, so one
+        sketch can hold e.g. nbins*ncol (bin, channel) pairs and rows are sorted into their bins on the way in.
+        '''
+        x = np.ma.filled(np.ma.asarray(data, dtype='float64'), np.nan)
+        if(groups is None):
+            x = x.reshape(-1, self.nchan)
+            valid = np.isfinite(x)
+            self.count += valid.sum(axis=0)
+            self.sum += np.where(valid, x, 0).sum(axis=0)
+            self.min = np.minimum(self.min, np.where(valid, x, np.inf).min(axis=0, initial=np.inf))
+            self.max = np.maximum(self.max, np.where(valid, x, -np.inf).max(axis=0, initial=-np.inf))
+            self.zero += (valid & (x==0)).sum(axis=0)
+            rows, chans = np.nonzero(valid)
+            vals = x[rows, chans]
+        else:
+            ncol = x.shape[-1]
+            x = x.reshape(-1, ncol)
+            rows, cols = np.nonzero(np.isfinite(x))
+            vals = x[rows, cols]
+            chans = np.asarray(groups, dtype='int64')[rows]*ncol + cols
+            self.count += np.bincount(chans, minlength=self.nchan)
+            self.sum += np.bincount(chans, weights=vals, minlength=self.nchan)
+            np.minimum.at(self.min, chans, vals)
+            np.maximum.at(self.max, chans, vals)
+            self.zero += np.bincount(chans[vals==0], minlength=self.nchan)
+        nonzero = vals!=0
+        chans, vals = chans[nonzero], vals[nonzero]
+        if(len(vals)==0):
+            return self
+        keys = self._keys(np.abs(vals))
+        isneg = vals<0
+        lo = np.full(self.nchan, np.iinfo('int64').max)
+        hi = np.full(self.nchan, np.iinfo('int64').min)
+        np.minimum.at(lo, chans, keys)
+        np.maximum.at(hi, chans, keys)
+        touched = np.nonzero(hi>=lo)[0]
+        fold = self._resize(touched, lo[touched], hi[touched], neg=bool(np.any(isneg)))
+        if(np.any(fold)):
+            folded = touched[fold]
+            print(f"QuantileSketch: {len(folded)} channels span more than max_bins={self.max_bins} keys, folding their tails")
+            infold = np.isin(chans, folded)
+            for c in folded:
+                sel = infold & (chans==c)
+                self._refold(c, keys[sel], isneg[sel], np.ones(sel.sum()))
+            chans, keys, isneg = chans[~infold], keys[~infold], isneg[~infold]
+        self._add(self.pos, chans[~isneg], keys[~isneg])
+        if(np.any(isneg)):
+            self._add(self.neg, chans[isneg], keys[isneg])
+        return self
+
+    def merge(self, other, chans=None):
+        '''
+        Add the counts of another sketch with the same alpha. Returns self.
+        By default other has the same channels. Otherwise chans (unique) gives the channel of self that each channel
+        of other goes to, e.g. a small sketch of a few bins merged into a big one.
+        '''
+        if(not np.isclose(other.gamma, self.gamma)):
+            raise ValueError("Can only merge sketches with the same alpha")
+        if(chans is None):
+            if(other.nchan!=self.nchan):
+                raise ValueError("Can only merge sketches with the same nchan unless chans is given")
+            chans = np.arange(self.nchan)
+        elif(len(chans)!=other.nchan):
+            raise ValueError("chans needs one entry per channel of the merged sketch")
+        chans = np.asarray(chans, dtype='int64')
+        self.count[chans] += other.count
+        self.sum[chans] += other.sum
+        self.min[chans] = np.minimum(self.min[chans], other.min)
+        self.max[chans] = np.maximum(self.max[chans], other.max)
+        self.zero[chans] += other.zero
+        self.collapsed[chans] |= other.collapsed
+        has = np.nonzero(other.kmax>=other.kmin)[0]
+        if(len(has)==0):
+            return self
+        other_neg = other.neg.shape[1]>0
+        fold = self._resize(chans[has], other.kmin[has], other.kmax[has], neg=other_neg)
+        if(np.any(fold)):
+            print(f"QuantileSketch: {fold.sum()} channels span more than max_bins={self.max_bins} keys, folding their tails")
+            own = np.arange(other.pos.shape[1])
+            for i in has[fold]:
+                keys = other.kmin[i] + np.concatenate([own, own[:other.neg.shape[1]]])
+                neg = np.arange(len(keys)) >= len(own)
+                self._refold(chans[i], keys, neg, np.concatenate([other.pos[i], other.neg[i]]).astype('float64'))
+            has = has[~fold]
+        for name in ['pos','neg'] if other_neg else ['pos']:
+            self._shift_add(getattr(self, name), chans[has], getattr(other, name), has, other.kmin[has]-self.kmin[chans[has]])
+        return self
+
+    def quantile(self, q, block=65536):
+        '''
+        Estimated q quantile(s) of every channel. q scalar gives (nchan,), q array gives (len(q), nchan).
+        NaN for channels without data. Works through block channels at a time to bound the temporary memory.
+        '''
+        q = np.asarray(q, dtype='float64')
+        nneg = self.neg.shape[1]
+        rank = q.reshape(-1,1)*(self.count-1)
+        idx = np.empty(rank.shape, dtype='int64')
+        for c in range(0, self.nchan, block):
+            sl = slice(c, c+block)
+            # sorted order: most negative first, then zeros, then positive
+            cum = np.cumsum(np.concatenate([self.neg[sl,::-1], self.zero[sl,None], self.pos[sl]], axis=1), axis=1)
+            for i in range(rank.shape[0]):
+                idx[i,sl] = (cum <= rank[i,sl,None]).sum(axis=1)
+        col = np.where(idx < nneg, nneg-1-idx, idx-nneg-1)
+        sign = np.where(idx < nneg, -1., np.where(idx==nneg, 0., 1.))
+        est = sign*2*self.gamma**(self.kmin+col).astype('float64')/(self.gamma+1)
+        with np.errstate(invalid='ignore'):
+            est = np.clip(est, self.min, self.max)
+        est[:, self.count==0] = np.nan
+        return est.reshape(q.shape + (self.nchan,))
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def percentile(self, p):
+        return self.quantile(np.asarray(p)/100)
+
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count>0, self.sum/self.count, np.nan)
+
+    def to_dict(self):
+        '''
+        Plain arrays, e.g. for np.savez or one .npy each. The stores are ragged: pos (and neg, empty if there is no
+        negative store) hold each channel's kmin..kmax columns one channel after the other, channel c at
+        off[c]:off[c+1], so one wide channel doesn't make the others take max_bins columns.
+        '''
+        w = np.maximum(self.kmax-self.kmin+1, 0)
+        mask = np.arange(self.pos.shape[1]) < w[:,None]
+        neg = self.neg[mask] if self.neg.shape[1]>0 else np.zeros(0, dtype=self.pos.dtype)
+        return {'alpha':self.alpha, 'max_bins':self.max_bins, 'kmin':self.kmin, 'kmax':self.kmax, 'collapsed':self.collapsed,
+            'off':np.concatenate([[0], np.cumsum(w)]), 'pos':self.pos[mask], 'neg':neg,
+            'zero':self.zero, 'count':self.count, 'sum':self.sum, 'min':self.min, 'max':self.max}
+
+    @classmethod
+    def from_dict(cls, d, chans=None):
+        '''
+        Sketch from the output of to_dict (arrays can be memory-mapped). With chans only those channels are read,
+        in that order, and the stores are as wide as the widest of them.
+        '''
+        chans = np.arange(len(d['count'])) if chans is None else np.asarray(chans, dtype='int64')
+        pos = d['pos']
+        sk = cls(len(chans), float(d['alpha']), int(d['max_bins']), pos.dtype)
+        for name in ('kmin','kmax','collapsed','zero','count','sum','min','max'):
+            setattr(sk, name, np.array(d[name][chans]))
+        if(pos.ndim==2):
+            # dense stores, as written before they were ragged
+            sk.pos, sk.neg = np.array(pos[chans]), np.array(d['neg'][chans])
+            return sk
+        off = np.asarray(d['off'])
+        w = off[chans+1]-off[chans]
+        rows = np.repeat(np.arange(len(chans)), w)
+        cols = np.arange(w.sum()) - np.repeat(np.cumsum(w)-w, w)
+        src = np.repeat(off[chans], w) + cols
+        width = int(w.max()) if len(w)>0 else 0
+        for name in ('pos','neg'):
+            if(len(d[name])==0 and name=='neg'):
+                continue
+            store = np.zeros((len(chans), width), dtype=pos.dtype)
+            store[rows, cols] = d[name][src]
+            setattr(sk, name, store)
+        return sk
+
+def sketch_percentiles(data, p, alpha=0.005, max_bins=16384, chunk=4096):
+    '''
+    Percentile(s) p of all finite, unmasked entries of data (rows first), from a single channel sketch built
+    chunk rows at a time. Stand-in for np.percentile on large waterfalls: no sort and no flattened copy.
+    '''
+    sk = QuantileSketch(1, alpha, max_bins)
+    for i in range(0, len(data), chunk):
+        sk.update(np.ma.ravel(data[i:i+chunk]))
+    return sk.percentile(p)[...,0]
+
+def sketch_clipped_stats(data, lo=1, hi=99, alpha=0.005, max_bins=16384, chunk=4096):
+    '''
+    Colorbar stats of data: the lo and hi percentiles b and u, the median, and the std of the entries between b and u.
+    Two passes of chunk rows at a time, one for the sketch and one for the clipped std, so no full-size copy of data is made.
+    Returns b, med, u, stddev.
+    '''
+    sk = QuantileSketch(1, alpha, max_bins)
+    for i in range(0, len(data), chunk):
+        sk.update(np.ma.ravel(data[i:i+chunk]))
+    b, med, u = sk.percentile([lo, 50, hi])[:,0]
+    # sums of the offsets from the median, so the variance doesn't cancel for data with a big mean
+    n, s1, s2 = 0, 0., 0.
+    for i in range(0, len(data), chunk):
+        x = np.ma.masked_invalid(data[i:i+chunk])
+        x = np.ma.masked_outside(x, b, u).compressed() - med
+        n += len(x)
+        s1 += x.sum()
+        s2 += np.dot(x, x)
+    stddev = np.sqrt(max(s2/n - (s1/n)**2, 0)) if n>0 else np.nan
+    return b, med, u, stddev
+
+def _block_stats(x, out, sl):
+    # min/median/mean/max of the columns in slice sl, NaN = missing
+    blk = x[:, sl]
+    valid = ~np.isnan(blk)
+    n = valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out['min'][sl] = np.where(n>0, np.where(valid, blk, np.inf).min(axis=0, initial=np.inf), np.nan)
+        out['max'][sl] = np.where(n>0, np.where(valid, blk, -np.inf).max(axis=0, initial=-np.inf), np.nan)
+        out['mean'][sl] = np.where(valid, blk, 0).sum(axis=0)/n
+    # partition puts NaNs at the end, so for columns with n valid entries the median is at (n-1)//2 and n//2.
+    # Columns usually share n, so there is one partition per distinct n.
+    med = out['median'][sl]
+    for nn in np.unique(n):
+        cols = np.nonzero(n==nn)[0]
+        if(nn==0):
+            med[cols] = np.nan
+            continue
+        k = sorted({(nn-1)//2, nn//2})
+        part = np.partition(blk[:, cols] if len(cols)<blk.shape[1] else blk, k, axis=0)
+        med[cols] = 0.5*(part[(nn-1)//2] + part[nn//2])
+
+def channel_stats(data, nthreads=None, block=64):
+    '''
+    Per-channel min, median, mean and max of a (nrows, nchan) array in one pass, as a dict of (nchan,) arrays.
+    NaNs and masked entries are ignored (NaN for channels with no data). The median is exact, from a partition
+    instead of a sort. Channels are processed in blocks of block columns by nthreads threads (default all cores).
+    Same numbers as np.ma.min/median/mean/max(axis=0), without building masked arrays.
+    '''
+    if(np.ma.isMaskedArray(data)):
+        x = np.ma.filled(data.astype('float64', copy=False), np.nan)
+    else:
+        x = np.asarray(data, dtype='float64')
+    nchan = x.shape[1]
+    out = {k:np.empty(nchan) for k in ('min','median','mean','max')}
+    slices = [slice(i, min(i+block, nchan)) for i in range(0, nchan, block)]
+    with ThreadPoolExecutor(nthreads or os.cpu_count()) as pool:
+        list(pool.map(lambda sl: _block_stats(x, out, sl), slices))
+    return out
@@ -0,0 +1,84 @@
+import numpy as np
+import time
+import os
+import argparse
+from correlations import baseband_data_classes as bdc
+from correlations import unpacking as unpk
+from legacy import pfb_helper
+from utils import baseband_utils as butils
+
+NFREQ = 2049 # 2048 channels plus the missing Nyquist, 4096 samples per spectrum
+
+def stream_voltages(path, init_t, end_t, acclen, nchunks, chanstart=0, chanend=None, pols=(0,1), nover=1024, nthreads=None):
+    '''
+    Generator of reconstructed time-domain voltages of one station from 4 bit baseband, across file boundaries.
+    Spectra are read acclen at a time with the iterator, missing spectra are zero filled, and every pol goes through
+    a StreamingInversePFB that carries nover spectra of context between chunks, so there are no edges at chunk or
+    file boundaries.
+    Yields dicts with 'pol0'/'pol1' float64 timestreams and 'sample0', the index of their first sample
+    counted from the first spectrum read (4096 samples per spectrum). The last dict is what was left in the buffers.
+    '''
+    idxstart, fileidx, files = butils.get_init_info(init_t, end_t, path)
+    print("Starting at: ",idxstart, "in filenum: ",fileidx)
+    ant1 = bdc.BasebandFileIterator(files,fileidx,idxstart,acclen,nchunks=nchunks,chanstart=chanstart,chanend=chanend)
+    if(ant1.obj.bit_mode!=4):
+        raise NotImplementedError(f"BIT MODE {ant1.obj.bit_mode} IS NOT SUPPORTED BY THIS SCRIPT.")
+    channels=np.asarray(ant1.obj.channels[ant1.obj.chanstart:ant1.obj.chanend])
+    ipfbs={pol:pfb_helper.StreamingInversePFB(NFREQ, nover=nover, nthreads=nthreads) for pol in pols}
+    spec=np.zeros((acclen,NFREQ),dtype='complex128')
+    m=ant1.spec_num_start
+    sample0=0
+    st=time.time()
+    for i, chunk in enumerate(ant1):
+        t1=time.time()
+        out={}
+        for pol in pols:
+            x, present = unpk.unpack_sorted_4bit(chunk[f'pol{pol}'], chunk['specnums'], m+i*acclen, acclen)
+            spec[:,channels]=x
+            out[f'pol{pol}']=ipfbs[pol].push(spec)
+        out['sample0']=sample0
+        sample0+=len(out[f'pol{pols[0]}'])
+        print("time taken for one loop", time.time()-t1)
+        print(i+1,"CHUNK READ")
+        yield out
+    out={f'pol{pol}':ipfbs[pol].flush() for pol in pols}
+    out['sample0']=sample0
+    print("Time taken final:", time.time()-st)
+    yield out
+
+if __name__=="__main__":
+
+    parser = argparse.ArgumentParser(description="Reconstruct continuous time-domain voltages from 4 bit baseband with an inverse PFB.")
+    parser.add_argument('data_dir', type=str,help='Parent data directory. Should have 5 digit time folders.')
+    parser.add_argument("time_start",type=int, help="Start timestamp ctime")
+    parser.add_argument("-a", "--acclen", type=int, default=8192, help="Spectra inverted at a time. Doesn't change the result.")
+    parser.add_argument("-ov", "--nover", type=int, default=1024, help="Spectra of context on each side of a chunk")
+    parser.add_argument('-n', '--nchunks', dest='nchunks',type=int, default=10, help='Number of acclen blocks to read. If stop time is specfied this is overwritten.')
+    parser.add_argument('-t', '--time_stop', dest='time_stop',type=int, default=False, help='Stop time. Overwrites nchunks if specified')
+    parser.add_argument("-c", '--chans', type=int, nargs=2, help="Indices of start and end channels.")
+    parser.add_argument("-p", "--pols", type=int, nargs='+', default=[0,1], help="Pols to reconstruct")
+    parser.add_argument('-j', '--nthreads', type=int, default=None, help='Threads for the inverse PFB, default all cores')
+    parser.add_argument('-o', '--outdir', dest='outdir',type=str, default='/scratch/s/sievers/mohanagr/',
+              help='Output directory for data')
+    args = parser.parse_args()
+
+    if(args.time_stop):
+        args.nchunks = int(np.floor((args.time_stop-args.time_start)*250e6/4096/args.acclen))
+    else:
+        args.time_stop = args.time_start + int(np.ceil(args.nchunks*args.acclen*4096/250e6))
+    if(not args.chans):
+        args.chans=[0,None]
+
+    tag = f"{args.time_start}_{args.nchunks*args.acclen}_{args.chans[0]}_{args.chans[1]}"
+    fnames = {pol:os.path.join(args.outdir, f"volt_pol{pol}_{tag}.raw") for pol in args.pols}
+    fouts = {pol:open(fname, 'wb') for pol, fname in fnames.items()}
+    try:
+        for out in stream_voltages(args.data_dir, args.time_start, args.time_stop, args.acclen, args.nchunks,\
+            args.chans[0], args.chans[1], args.pols, args.nover, args.nthreads):
+            for pol in args.pols:
+                out[f'pol{pol}'].astype('float32').tofile(fouts[pol])
+    finally:
+        for f in fouts.values():
+            f.close()
+    for fname in fnames.values():
+        print(fname)
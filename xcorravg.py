@@ -4,11 +4,125 @@ import glob
 import time
 from correlations import baseband_data_classes as bdc
 from correlations import correlations as cr
+from correlations import products
+from correlations.delay_model import DelayModel
 from utils import baseband_utils as butils
 import argparse
+import multiprocessing as mp
 import os
 
-def get_avg_fast(path1, path2, init_t, end_t, delay, acclen, nchunks, chanstart=0, chanend=None):
+def get_avg_shard(files1, files2, fileidx1, fileidx2, spec1, spec2, acclen, chunk0, nchunks, chanstart=0, chanend=None, delay_model=None, nsub=1,\
+    checkpoint=None, ckpt_every=100, writer=None):
+    '''
+    Correlate nchunks chunks starting at chunk chunk0. spec1 and spec2 are the (delayed) first spectrum numbers
+    of the whole run for the two antennas. Each shard opens its own iterators, so shards can run in separate processes.
+
+    checkpoint: path to a .npz. Both iterator positions are saved there every ckpt_every chunks and at the end, and the
+    chunks finished since the previous checkpoint go to their own file next to it (see butils.save_checkpoint_rows).
+    If it already exists, the run continues from it instead of starting over.
+    writer: optional products.ProductWriter. Rows are appended to it as they are produced instead of being kept in memory,
+    and None is returned in place of the array.
+    '''
+    dt_spec = butils.DT_SPEC
+    delay = 0
+    ddelay = 0
+    if(delay_model is not None):
+        delay = delay_model.get_delay(0)
+        ddelay = delay_model.get_delay(chunk0*acclen*dt_spec) - delay
+    ckpt = None
+    if(checkpoint):
+        ckpt = butils.load_checkpoint(checkpoint, spec1=spec1, spec2=spec2, acclen=acclen, chunk0=chunk0, nchunks=nchunks)
+    if(ckpt is not None):
+        done = int(ckpt['chunksdone'])
+        fileidx1 = int(ckpt['fileidx1'])
+        fileidx2 = int(ckpt['fileidx2'])
+        idxstart1 = int(ckpt['spec_num_start1']) - bdc.get_specnum_bounds(files1[fileidx1])[0]
+        idxstart2 = int(ckpt['spec_num_start2']) - bdc.get_specnum_bounds(files2[fileidx2])[0]
+    else:
+        done = 0
+        fileidx1, idxstart1 = bdc.seek_specnum(files1, fileidx1, spec1 + chunk0*acclen + ddelay)
+        fileidx2, idxstart2 = bdc.seek_specnum(files2, fileidx2, spec2 + chunk0*acclen)
+    print(idxstart1,idxstart2, "IDXSTARTS of shard at chunk", chunk0)
+
+    ant1 = bdc.BasebandFileIterator(files1,fileidx1,idxstart1,acclen,nchunks=nchunks-done,chanstart=chanstart,chanend=chanend)
+    ant2 = bdc.BasebandFileIterator(files2,fileidx2,idxstart2,acclen,nchunks=nchunks-done,chanstart=chanstart,chanend=chanend)
+    bit_mode=ant1.obj.bit_mode
+    if(bit_mode not in (1,4)):
+        raise NotImplementedError(f"BIT MODE {bit_mode} IS NOT SUPPORTED BY THIS SCRIPT.")
+    if(bit_mode==1 and delay_model is not None):
+        raise NotImplementedError("Delay model is only supported for 4 bit data.")
+    ncols=ant1.obj.chanend-ant1.obj.chanstart
+    if(writer is not None):
+        # rows already on disk past the last checkpoint are redone
+        writer.truncate(done)
+    pol00=np.zeros((1 if writer is not None else nchunks,ncols),dtype='complex64',order='c')
+    if(ckpt is not None and writer is None):
+        butils.load_checkpoint_rows(checkpoint, done, {'pol00':pol00})
+    saved = done
+    m1=spec1+chunk0*acclen
+    m2=spec2+chunk0*acclen
+    st=time.time()
+    if(delay_model is not None):
+        channels = ant1.obj.channels[ant1.obj.chanstart:ant1.obj.chanend]
+        blocklen = int(np.ceil(acclen/nsub))
+        tsub = (np.arange(nsub)+0.5)*blocklen*dt_spec
+    for i in range(done, nchunks):
+        t1=time.time()
+        ddelay=0
+        if(delay_model is not None):
+            # move antenna 1 to the delay at this chunk. ddelay is the change since the start of the run, so the
+            # pointer can go back across a file boundary. seek reopens the earlier file in that case.
+            ddelay = delay_model.get_delay((chunk0+i)*acclen*dt_spec) - delay
+            ant1.seek(m1 + i*acclen + ddelay)
+        chunk1 = next(ant1)
+        chunk2 = next(ant2)
+        k = 0 if writer is not None else i
+        if(bit_mode==1):
+            pol00[k,:] = cr.avg_xcorr_1bit_2ant(chunk2['pol0'], chunk1['pol0'],chunk2['specnums'],chunk1['specnums'],m2+i*acclen,m1+i*acclen,ncols)
+        elif(delay_model is None):
+            # pol00[i,:] = cr.avg_xcorr_4bit_2ant(chunk1['pol0'], chunk2['pol0'],chunk1['specnums'],chunk2['specnums'],m1+i*acclen,m2+i*acclen)
+            pol00[k,:] = cr.avg_xcorr_4bit_2ant(chunk2['pol0'], chunk1['pol0'],chunk2['specnums'],chunk1['specnums'],m2+i*acclen,m1+i*acclen)
+        else:
+            # model phase is phase of ant1 relative to ant2, kernel computes ant2 x conj(ant1)
+            rot = np.conj(delay_model.get_rot((chunk0+i)*acclen*dt_spec+tsub, channels))
+            pol00[k,:] = cr.avg_xcorr_4bit_2ant_rot(chunk2['pol0'], chunk1['pol0'],chunk2['specnums'],chunk1['specnums'],m2+i*acclen,m1+i*acclen+ddelay,rot,blocklen)
+        if(writer is not None):
+            writer.append(pol00=pol00)
+        t2=time.time()
+        print("time taken for one loop", t2-t1)
+        j=ant1.spec_num_start
+        print("After a loop spec_num start at:", j, "Expected at", m1+(i+1)*acclen+ddelay)
+        print(i+1,"CHUNK READ")
+        if(checkpoint and ((i+1)%ckpt_every==0 or i+1==nchunks)):
+            if(writer is not None):
+                writer.flush()
+            else:
+                butils.save_checkpoint_rows(checkpoint, saved, pol00=pol00[saved:i+1])
+            saved = i+1
+            butils.save_checkpoint(checkpoint, chunksdone=i+1, fileidx1=ant1.fileidx, fileidx2=ant2.fileidx,\
+                spec_num_start1=ant1.spec_num_start, spec_num_start2=ant2.spec_num_start, spec1=spec1, spec2=spec2, acclen=acclen, chunk0=chunk0, nchunks=nchunks)
+    print("Time taken final:", time.time()-st)
+    if(writer is not None):
+        return None,ant1.obj.channels,bit_mode
+    return pol00,ant1.obj.channels,bit_mode
+
+def _get_avg_shard(args):
+    return get_avg_shard(*args)
+
+def get_avg_fast(path1, path2, init_t, end_t, delay, acclen, nchunks, chanstart=0, chanend=None, delay_model=None, nsub=1, nproc=1,\
+    checkpoint=None, ckpt_every=100, stream=None):
+    '''
+    delay_model: optional DelayModel. It overrides delay and is evaluated once per chunk. The integer part moves
+    antenna 1's read pointer, and the phase is removed inside the kernel in nsub sub-blocks per chunk.
+    Both 4 bit and 1 bit data are supported. The delay model is only applied to 4 bit data.
+    nproc: number of worker processes. The run is split into nproc contiguous shards on chunk boundaries
+    and the partial outputs are stitched back in time order.
+    checkpoint: prefix for checkpoint files. Each shard checkpoints to checkpoint_<chunk0>.npz.
+    stream: product directory. Rows are written there as they are produced (see correlations/products.py)
+    and the returned array is memory-mapped from it. Needs nproc=1.
+    '''
+    if(delay_model is not None):
+        delay = delay_model.get_delay(0)
     
     idxstart1, fileidx1, files1 = butils.get_init_info(init_t, end_t, path1)
     idxstart2, fileidx2, files2 = butils.get_init_info(init_t, end_t, path2)
@@ -23,29 +137,33 @@ def get_avg_fast(path1, path2, init_t, end_t, delay, acclen, nchunks, chanstart=
         
 
     print(idxstart1,idxstart2)
-
-    # print("Starting at: ",idxstart, "in filenum: ",fileidx)
-    # print(files[fileidx])
-
-    ant1 = bdc.BasebandFileIterator(files1,fileidx1,idxstart1,acclen,nchunks=nchunks,chanstart=chanstart,chanend=chanend)
-    ant2 = bdc.BasebandFileIterator(files2,fileidx2,idxstart2,acclen,nchunks=nchunks,chanstart=chanstart,chanend=chanend)
-    ncols=ant1.obj.chanend-ant1.obj.chanstart
-    pol00=np.zeros((nchunks,ncols),dtype='complex64',order='c')
-    m1=ant1.spec_num_start
-    m2=ant2.spec_num_start
-    st=time.time()
-    for i, (chunk1,chunk2) in enumerate(zip(ant1,ant2)):
-        t1=time.time()
-        # pol00[i,:] = cr.avg_xcorr_4bit_2ant(chunk1['pol0'], chunk2['pol0'],chunk1['specnums'],chunk2['specnums'],m1+i*acclen,m2+i*acclen)
-        pol00[i,:] = cr.avg_xcorr_4bit_2ant(chunk2['pol0'], chunk1['pol0'],chunk2['specnums'],chunk1['specnums'],m2+i*acclen,m1+i*acclen)
-        t2=time.time()
-        print("time taken for one loop", t2-t1)
-        j=ant1.spec_num_start
-        print("After a loop spec_num start at:", j, "Expected at", m1+(i+1)*acclen)
-        print(i+1,"CHUNK READ")
-    print("Time taken final:", time.time()-st)
-    pol00 = np.ma.masked_invalid(pol00)
-    return pol00,ant1.obj.channels
+    spec1 = idxstart1 + bdc.get_specnum_bounds(files1[fileidx1])[0]
+    spec2 = idxstart2 + bdc.get_specnum_bounds(files2[fileidx2])[0]
+    if(stream):
+        if(nproc>1):
+            raise ValueError("Streaming output needs nproc=1")
+        hdr = bdc.get_header(files1[fileidx1],verbose=False)
+        channels = hdr['channels']
+        ncols = len(channels[chanstart:chanend])
+        meta = {'acclen':acclen, 'nchunks':nchunks, 'time_start':init_t, 't_acclen':acclen*butils.DT_SPEC, 'chans':[chanstart,chanend],\
+            'channels':channels[chanstart:chanend], 'delay':delay, 'bit_mode':hdr['bit_mode']}
+        ckpt_fname = butils.get_ckpt_fname(checkpoint, 0)
+        append = ckpt_fname is not None and os.path.exists(ckpt_fname)
+        with products.ProductWriter(stream, {'pol00':'complex64'}, ncols, meta, append=append) as writer:
+            _, channels, bit_mode = get_avg_shard(files1, files2, fileidx1, fileidx2, spec1, spec2, acclen, 0, nchunks, chanstart, chanend,\
+                delay_model, nsub, ckpt_fname, ckpt_every, writer)
+        return products.ProductReader(stream)['pol00'],channels,bit_mode
+    shards = butils.get_shard_bounds(nchunks, nproc)
+    jobs = [(files1, files2, fileidx1, fileidx2, spec1, spec2, acclen, chunk0, n, chanstart, chanend, delay_model, nsub,\
+        butils.get_ckpt_fname(checkpoint, chunk0), ckpt_every) for chunk0, n in shards]
+    if(len(jobs)==1):
+        results = [get_avg_shard(*jobs[0])]
+    else:
+        # spawn, not fork: the OpenMP runtime doesn't survive a fork once the parent has used it
+        with mp.get_context('spawn').Pool(len(jobs)) as pool:
+            results = pool.map(_get_avg_shard, jobs)
+    pol00 = np.ma.masked_invalid(np.concatenate([r[0] for r in results]))
+    return pol00,results[0][1],results[0][2]
 
 if __name__=="__main__":
 
@@ -59,12 +177,22 @@ if __name__=="__main__":
     parser.add_argument("-c", '--chans', type=int, nargs=2, help="Indices of start and end channels.")
     parser.add_argument('-o', '--outdir', dest='outdir',type=str, default='/project/s/sievers/mohanagr/',
               help='Output directory for data and plots')
+    parser.add_argument('-dr', '--delay_rate', dest='delay_rate', type=float, default=0., help='Change of delay in spectra per second')
+    parser.add_argument('-ps', '--phase_slope', dest='phase_slope', type=float, default=0., help='Phase slope across channels in radians per channel')
+    parser.add_argument('-psr', '--phase_slope_rate', dest='phase_slope_rate', type=float, default=0., help='Change of phase slope in radians per channel per second')
+    parser.add_argument('-ph', '--phase', dest='phase', type=float, default=0., help='Constant phase offset in radians')
+    parser.add_argument('-phr', '--phase_rate', dest='phase_rate', type=float, default=0., help='Fringe rate in radians per second')
+    parser.add_argument('-p', '--nproc', dest='nproc', type=int, default=1, help='Number of worker processes. The run is split into this many time shards.')
+    parser.add_argument('-ck', '--checkpoint_every', dest='ckpt_every', type=int, default=0, help='Checkpoint finished chunks every this many chunks. 0 disables checkpointing.')
+    parser.add_argument('-r', '--resume', action='store_true', help='Continue from the checkpoint of a previous run with the same arguments')
+    parser.add_argument('-s', '--stream', action='store_true', help='Write rows to a product directory as they are produced instead of one npz at the end')
+    parser.add_argument('-ns', '--nsub', dest='nsub', type=int, default=1, help='Number of sub-blocks per chunk in which the model phase is applied')
     args = parser.parse_args()
 
     if(args.time_stop):
-        args.nchunks = int(np.floor((args.time_stop-args.time_start)*250e6/4096/args.acclen))
+        args.nchunks = int(np.floor((args.time_stop-args.time_start)/butils.DT_SPEC/args.acclen))
     else:
-        args.time_stop = args.time_start + int(np.ceil(args.nchunks*args.acclen*4096/250e6))
+        args.time_stop = args.time_start + int(np.ceil(args.nchunks*args.acclen*butils.DT_SPEC))
     if(not args.chans):
         args.chans=[0,None]
 
@@ -73,15 +201,38 @@ if __name__=="__main__":
     print(path1,path2)
     init_t = args.time_start #c#1627441379 #1627441542 #1627439234
     acclen=args.acclen
-    t_acclen = acclen*4096/250e6
+    t_acclen = acclen*butils.DT_SPEC
     delay=args.delay #-34060 #-50110 #-963933
     nchunks=args.nchunks #2947 #1959
     end_t = int(init_t + nchunks*t_acclen)
-    pol00,channels=get_avg_fast(path1, path2, init_t, end_t, delay, acclen, nchunks, chanstart=args.chans[0], chanend=args.chans[1])
+    delay_model = DelayModel(delay, args.delay_rate, args.phase_slope, args.phase_slope_rate, args.phase, args.phase_rate)
+    tag = f"{str(args.time_start)}_{str(args.acclen)}_{str(args.nchunks)}_{str(args.delay)}_{args.chans[0]}_{args.chans[1]}"
+    if(delay_model.is_static()):
+        delay_model = None
+    else:
+        # runs with different models must not share outputs or checkpoints
+        tag += f"_dm_{args.delay_rate}_{args.phase_slope}_{args.phase_slope_rate}_{args.phase}_{args.phase_rate}_{args.nsub}"
+    checkpoint = None
+    if(args.ckpt_every>0 or args.resume):
+        checkpoint = os.path.join(args.outdir, f"ckpt_xcorr_pol00_{tag}")
+        if(not args.resume):
+            for f in glob.glob(checkpoint+"_*.npz"):
+                os.remove(f)
+    stream = None
+    if(args.stream):
+        stream = os.path.join(args.outdir, f"xcorr_pol00_{tag}")
+    pol00,channels,bit_mode=get_avg_fast(path1, path2, init_t, end_t, delay, acclen, nchunks, chanstart=args.chans[0], chanend=args.chans[1], delay_model=delay_model, nsub=args.nsub, nproc=args.nproc,\
+        checkpoint=checkpoint, ckpt_every=args.ckpt_every or 100, stream=stream)
 
-    fname = f"xcorr_pol00_4bit_{str(args.time_start)}_{str(args.acclen)}_{str(args.nchunks)}_{str(args.delay)}_{args.chans[0]}_{args.chans[1]}.npz"
-    fpath = os.path.join(args.outdir,fname)
-    np.savez_compressed(fpath,datap00=pol00.data,maskp00=pol00.mask,chans=channels)
+    if(stream):
+        print(stream)
+    else:
+        fname = f"xcorr_pol00_{bit_mode}bit_{tag}.npz"
+        fpath = os.path.join(args.outdir,fname)
+        np.savez_compressed(fpath,datap00=pol00.data,maskp00=pol00.mask,chans=channels)
+    if(checkpoint):
+        for f in glob.glob(checkpoint+"_*.npz"):
+            os.remove(f)
 
     from matplotlib import pyplot as plt
     plt.figure(figsize=(5,10), dpi=200)
@@ -98,7 +249,7 @@ if __name__=="__main__":
     plt.title('xcorr pol00 phase')
     plt.colorbar()
 
-    fname = f"xcorr_pol00_4bit_{str(args.time_start)}_{str(args.acclen)}_{str(args.nchunks)}_{str(args.delay)}_{args.chans[0]}_{args.chans[1]}.png"
+    fname = f"xcorr_pol00_{bit_mode}bit_{tag}.png"
     fpath = os.path.join(args.outdir,fname)
     plt.savefig(fpath)
     print(fpath)